@@ -1,5 +1,7 @@
 import os
 import json
+import time
+import threading
 from fastapi.templating import Jinja2Templates
 
 # ================= 路径配置 =================
@@ -49,12 +51,44 @@ DEFAULT_CONFIG = {
     "enable_notify": False,
     "enable_library_notify": False,
     "webhook_token": "embypulse",  # 🔥 新增：Webhook 安全验证令牌
-    "scheduled_tasks": []
+    "scheduled_tasks": [],
+    "report_workers": 0,  # 报表渲染进程数，0 = 自动 (CPU 核数，最多 4)
+    "report_poster_budget": 2.0,  # 海报墙封面抓取时间预算 (秒)，超时用占位图
+    "tg_delivery_workers": 2,  # Telegram 推送发送线程数
+    "library_notify_window": 60,  # 入库通知聚合窗口 (秒)，0 = 逐条推送
+    "geoip_db_path": "",  # 本地 IP 段库 (CSV)，留空则使用 config/geoip.csv (存在时)
+    "geoip_remote": True,  # 本地库未命中时是否查询远程服务
+    "geoip_remote_url": "http://ip-api.com/json/{ip}?lang=zh-CN",  # 远程查询地址，{ip} 为占位符
+    "bot_workers": 4,  # 机器人指令并发线程数
+    "tg_mode": "polling",  # 接收消息方式: polling 长轮询 / webhook
+    "tg_webhook_url": "",  # webhook 模式下本服务的公网地址 (https)
+    "tg_webhook_secret": "",  # webhook 校验密钥，留空自动生成
+    "tg_api_base": "https://api.telegram.org",  # Bot API 地址 (可用自建 Bot API 服务)
+    "playback_debounce": 30,  # 停止播放后等待续播的秒数，窗口内的停止/开始合并为一次观看，0 = 逐条推送
+    "emby_concurrency": 8,  # 批量调用 Emby API (停用到期用户等) 的并发数
+    "expire_notify_days": 3,  # 账号到期前多少天提醒管理员，0 = 不提醒
+    "webhook_workers": 4,  # Webhook 事件处理线程数
+    "webhook_queue_max": 10000,  # Webhook 未处理事件上限，超过后返回 503 让 Emby 稍后重试
+    "native_playback": False,  # 由 webhook 播放事件自行记录播放数据 (不依赖 Playback Reporting 插件)
+    "stats_source": "plugin",  # 统计数据来源: plugin 插件库 / native 自有记录 (native 时自动开启记录)
+    "config_hot_reload": False,  # 监视 config.json，外部编辑后自动生效 (无需重启)
+    "wallpaper_size": "w1280"  # 登录页壁纸下载尺寸 (TMDB 尺寸名: w780 / w1280 / original)
 }
 
 class ConfigManager:
+    """
+    配置读写
+    - update() 一次合并多个键，只写一次文件 (临时文件 + fsync + 原子替换)，写入成功后才生效
+    - version 每次变更递增；subscribe() 注册的回调只在关心的键真正变化时触发
+    - watch() 可选：检测到外部编辑 config.json 时热加载
+    """
     def __init__(self):
         self.config = DEFAULT_CONFIG.copy()
+        self.version = 0
+        self._lock = threading.RLock()
+        self._subscribers = []   # [(keys 或 None, callback)]
+        self._file_stat = None   # 最近一次读写时的 (mtime_ns, size)，用于识别外部修改
+        self._watching = False
         self.load()
 
     def load(self):
@@ -63,13 +97,35 @@ class ConfigManager:
                 with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
                     saved = json.load(f)
                     self.config.update(saved)
+                self._file_stat = self._stat()
             except Exception as e: 
                 print(f"⚠️ Config Load Error: {e}")
-    
+
+    @staticmethod
+    def _stat():
+        try:
+            st = os.stat(CONFIG_FILE)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError: return None
+
+    def _write(self, data):
+        """写临时文件并 fsync，再原子替换：任何时刻磁盘上都是完整的旧文件或新文件"""
+        tmp = f"{CONFIG_FILE}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, CONFIG_FILE)
+        try:
+            fd = os.open(CONFIG_DIR, os.O_RDONLY)
+            try: os.fsync(fd)
+            finally: os.close(fd)
+        except OSError: pass
+        self._file_stat = self._stat()
+
     def save(self):
         try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, indent=4, ensure_ascii=False)
+            with self._lock: self._write(self.config)
         except Exception as e: 
             print(f"⚠️ Config Save Error: {e}")
 
@@ -77,9 +133,66 @@ class ConfigManager:
         return self.config.get(key, DEFAULT_CONFIG.get(key))
     
     def set(self, key, value): 
-        self.config[key] = value
-        self.save()
-    
+        self.update({key: value})
+
+    def update(self, changes):
+        """
+        原子地修改多个键：值未变的键忽略；写盘失败时抛出异常且内存配置保持不变
+        返回实际变化的键集合
+        """
+        with self._lock:
+            changed = {k for k, v in changes.items() if k not in self.config or self.config[k] != v}
+            if not changed: return set()
+            new = {**self.config, **{k: changes[k] for k in changed}}
+            self._write(new)
+            self.config = new
+            self.version += 1
+        self._notify(changed)
+        return changed
+
+    def subscribe(self, keys, callback):
+        """keys 中任一键变化时调用 callback(changed_keys)；keys 为 None 表示任意变化"""
+        self._subscribers.append((set(keys) if keys else None, callback))
+
+    def _notify(self, changed):
+        for keys, callback in list(self._subscribers):
+            if keys is not None and not (keys & changed): continue
+            try: callback(changed)
+            except Exception as e: print(f"⚠️ Config Subscriber Error: {e}")
+
+    def reload(self):
+        """重新读取 config.json (外部修改后)；返回变化的键"""
+        with self._lock:
+            try:
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+            except Exception as e:
+                # 编辑器保存到一半 / 格式错误：保留当前配置，等下一次修改
+                print(f"⚠️ Config Reload Skipped: {e}")
+                self._file_stat = self._stat()
+                return set()
+            new = {**DEFAULT_CONFIG, **saved}
+            changed = {k for k in set(new) | set(self.config) if new.get(k) != self.config.get(k)}
+            self._file_stat = self._stat()
+            if not changed: return set()
+            self.config = new
+            self.version += 1
+        print(f"🔄 Config reloaded: {', '.join(sorted(changed))}")
+        self._notify(changed)
+        return changed
+
+    def watch(self, interval=2.0):
+        """后台轮询 config.json 的修改时间，外部编辑后热加载"""
+        if self._watching: return
+        self._watching = True
+
+        def loop():
+            while self._watching:
+                time.sleep(interval)
+                stat = self._stat()
+                if stat and stat != self._file_stat: self.reload()
+        threading.Thread(target=loop, name="config-watch", daemon=True).start()
+
     def get_all(self): 
         return self.config
 
@@ -1,6 +1,31 @@
 import sqlite3
 import os
-from app.core.config import cfg, DB_PATH
+import re
+import datetime
+from app.core.config import cfg, DB_PATH, CONFIG_DIR
+
+# EmbyPulse 自有数据 (推送队列、任务等) 的本地库，与插件库分离，避免争用插件库的锁
+LOCAL_DB_PATH = os.path.join(CONFIG_DIR, "embypulse.db")
+# 原生播放记录 (webhook 写入)，提供与插件同名的 PlaybackActivity 视图
+NATIVE_DB_PATH = os.path.join(CONFIG_DIR, "playback.db")
+
+def stats_db_path(query):
+    """stats_source = native 时，查询 PlaybackActivity 的语句改查原生库"""
+    if cfg.get("stats_source") == "native" and "PlaybackActivity" in query and os.path.exists(NATIVE_DB_PATH):
+        return NATIVE_DB_PATH
+    return DB_PATH
+
+# DateCreated 与 date('now', ...) 的比较；date() 只返回日期，DateCreated > 'D' 等价于 >= 当天 0 点
+_DATE_CMP = re.compile(r"DateCreated\s*(>=|<=|>|<)\s*(date\('now'[^()]*\))")
+_TS_OPS = {">": ">=", ">=": ">=", "<": "<", "<=": "<"}
+
+def native_sql(query):
+    """
+    原生库的 PlaybackActivity 是视图，DateCreated 由 ts 现算，直接比较会扫全部分表；
+    改写为 ts 与 epoch 秒比较 (本地时间 0 点)，条件下推到各分表走 ts 索引
+    """
+    query = _DATE_CMP.sub(lambda m: f"ts {_TS_OPS[m.group(1)]} CAST(strftime('%s', {m.group(2)}, 'utc') AS INTEGER)", query)
+    return query.replace("ORDER BY DateCreated", "ORDER BY ts")
 
 def init_db():
     # 确保数据库目录存在
@@ -21,21 +46,30 @@ def init_db():
                         note TEXT,
                         created_at TEXT
                     )''')
-        
+        # 到期处理状态：记录已处理 / 已提醒时对应的到期日，到期日被修改 (续期) 后自动重新生效
+        cols = {r[1] for r in c.execute("PRAGMA table_info(users_meta)")}
+        for col in ("expire_handled", "expire_notified"):
+            if col not in cols: c.execute(f"ALTER TABLE users_meta ADD COLUMN {col} TEXT")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_meta_expire ON users_meta(expire_date)")
+
         conn.commit()
         conn.close()
         print("✅ Database initialized (Plugin Read-Only Mode).")
+        return True
     except Exception as e: 
         print(f"❌ DB Init Error: {e}")
+        return False
 
 def query_db(query, args=(), one=False):
-    if not os.path.exists(DB_PATH): return None
+    path = stats_db_path(query)
+    if not os.path.exists(path): return None
+    if path == NATIVE_DB_PATH: query = native_sql(query)
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=20.0)
+        conn = sqlite3.connect(path, timeout=20.0)
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
         cur.execute(query, args)
-        if query.strip().upper().startswith("SELECT"):
+        if query.strip().upper().startswith(("SELECT", "WITH")):
             rv = cur.fetchall()
             conn.close()
             return (rv[0] if rv else None) if one else rv
@@ -47,6 +81,19 @@ def query_db(query, args=(), one=False):
         print(f"SQL Error: {e}")
         return None
 
+def execute_many(query, rows):
+    """同一语句批量执行，单个事务提交；返回是否成功"""
+    if not os.path.exists(DB_PATH): return False
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=20.0)
+        try:
+            with conn: conn.executemany(query, rows)
+        finally: conn.close()
+        return True
+    except Exception as e:
+        print(f"SQL Error: {e}")
+        return False
+
 def get_base_filter(user_id_filter):
     where = "WHERE 1=1"
     params = []
@@ -64,4 +111,27 @@ def get_base_filter(user_id_filter):
         where += f" AND UserId NOT IN ({placeholders})"
         params.extend(hidden)
         
-    return where, params
\ No newline at end of file
+    return where, params
+
+def get_data_version():
+    """
+    播放数据版本号：插件库文件 (含 WAL) 的修改时间与大小 + 当天日期
+    任何写入都会改变版本；日期用于让 date('now', ...) 这类相对区间按天失效
+    """
+    parts = [datetime.date.today().isoformat()]
+    db = NATIVE_DB_PATH if cfg.get("stats_source") == "native" else DB_PATH
+    for p in (db, db + "-wal"):
+        try:
+            st = os.stat(p)
+            parts.append(f"{st.st_mtime_ns}:{st.st_size}")
+        except OSError:
+            parts.append("-")
+    return "|".join(parts)
+
+def local_connect(path=LOCAL_DB_PATH):
+    """打开本地库连接：WAL 模式，读写互不阻塞；调用方自行管理生命周期"""
+    conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
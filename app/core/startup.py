@@ -0,0 +1,77 @@
+"""
+启动编排
+- 必需步骤 (数据库、推送队列、任务调度等本地组件) 在 lifespan 中同步执行，都是毫秒级
+- 预热步骤 (字体、GeoIP、搜索索引、壁纸、机器人等可能读大文件 / 访问网络的) 放到后台线程，不阻塞端口监听
+- /healthz 只表示进程存活；/readyz 在必需步骤全部成功后才返回 200，并列出各步骤状态与耗时
+- 启动完成与预热完成时各打印一次耗时明细 (含模块导入)
+"""
+import time
+import threading
+import logging
+
+logger = logging.getLogger("uvicorn")
+
+class Startup:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._steps = {}            # name -> {"required", "background", "status", "ms", "error"}
+        self._started = time.time()
+        self.import_ms = None
+
+    def imported(self, since):
+        """since: app.main 开始导入时的 perf_counter"""
+        self.import_ms = round((time.perf_counter() - since) * 1000, 1)
+
+    # ---------------- 执行 ----------------
+    def run(self, name, func, required=True):
+        """同步执行；失败只记录，不中断启动 (必需步骤失败时 /readyz 保持 503)"""
+        self._add(name, required, False)
+        self._exec(name, func)
+
+    def background(self, name, func, required=False):
+        self._add(name, required, True)
+        threading.Thread(target=self._exec, args=(name, func), name=f"startup-{name}", daemon=True).start()
+
+    def _add(self, name, required, background):
+        with self._lock:
+            self._steps[name] = {"required": required, "background": background, "status": "pending", "ms": None, "error": None}
+
+    def _exec(self, name, func):
+        step = self._steps[name]
+        step["status"] = "running"
+        start = time.perf_counter()
+        try:
+            # 返回 False 表示未完成：必需步骤视为失败，可选步骤视为跳过 (如未配置)
+            result = func()
+            step["status"] = "ok" if result is not False else ("error" if step["required"] else "skipped")
+            if step["status"] == "error": step["error"] = "failed"
+        except Exception as e:
+            step["status"] = "error"; step["error"] = str(e)[:200]
+            logger.error(f"Startup Step Error ({name}): {e}")
+        step["ms"] = round((time.perf_counter() - start) * 1000, 1)
+        if step["background"] and self._warmup_done(): logger.info(f"🔥 Warmup finished: {self._breakdown(True)}")
+
+    def _warmup_done(self):
+        with self._lock:
+            bg = [s for s in self._steps.values() if s["background"]]
+            return bool(bg) and all(s["status"] not in ("pending", "running") for s in bg)
+
+    # ---------------- 状态 ----------------
+    def ready(self):
+        with self._lock:
+            return bool(self._steps) and all(s["status"] == "ok" for s in self._steps.values() if s["required"])
+
+    def _breakdown(self, background):
+        with self._lock:
+            items = [(n, s) for n, s in self._steps.items() if s["background"] == background]
+        return ", ".join(f"{n} {s['ms']}ms" if s["ms"] is not None else f"{n} {s['status']}" for n, s in items)
+
+    def log_summary(self):
+        logger.info(f"⏱️ Startup: imports {self.import_ms}ms | {self._breakdown(False)} | warming up: {self._breakdown(True)}")
+
+    def report(self):
+        with self._lock:
+            steps = {n: dict(s) for n, s in self._steps.items()}
+        return {"ready": self.ready(), "uptime": round(time.time() - self._started), "import_ms": self.import_ms, "steps": steps}
+
+startup = Startup()
@@ -1,3 +1,5 @@
+import time
+_IMPORT_START = time.perf_counter()
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
@@ -6,26 +8,54 @@ from contextlib import asynccontextmanager
 import os
 from app.routers import insight
 
-from app.core.config import PORT, SECRET_KEY, CONFIG_DIR, FONT_DIR
+from app.core.config import cfg, PORT, SECRET_KEY, CONFIG_DIR, FONT_DIR
 from app.core.database import init_db
+from app.core.startup import startup
 from app.services.bot_service import bot
+from app.services.report_service import report_gen
+from app.services.font_manager import font_manager
+from app.services.tg_delivery import delivery
+from app.services.delayed_jobs import delayed_jobs
+from app.services.geoip import geoip
+from app.services.cron_scheduler import cron_scheduler
+from app.services.search_index import search_index
+from app.services.webhook_journal import webhook_journal
+from app.services.playback_store import playback_store
+from app.services.wallpaper_service import wallpapers
 # 🔥 引入新路由 webhook
-from app.routers import views, auth, users, stats, bot as bot_router, system, proxy, report, webhook,insight, tasks
+from app.routers import views, auth, users, stats, bot as bot_router, system, proxy, report, webhook,insight, tasks, schedule, search
 
-# 初始化目录和数据库
+# 初始化目录 (数据库在 lifespan 中初始化，导入本模块不做 IO)
 if not os.path.exists("static"): os.makedirs("static")
 if not os.path.exists("templates"): os.makedirs("templates")
 if not os.path.exists(CONFIG_DIR): os.makedirs(CONFIG_DIR)
 if not os.path.exists(FONT_DIR): os.makedirs(FONT_DIR)
-init_db()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("🚀 Starting EmbyPulse...")
-    bot.start()
+    # 必需步骤：本地组件，同步完成后 /readyz 才返回 200
+    startup.run("database", init_db)
+    if cfg.get("config_hot_reload"): startup.run("config_watch", cfg.watch, required=False)
+    startup.run("delivery", delivery.start)
+    startup.run("delayed_jobs", delayed_jobs.start)
+    startup.run("cron", cron_scheduler.start)
+    startup.run("webhook_journal", webhook_journal.start)
+    # 预热步骤：可能读大文件或访问网络，后台进行，不影响就绪
+    startup.background("playback_store", playback_store.ensure_ready)
+    startup.background("search_index", search_index.ensure_ready)
+    startup.background("geoip", geoip.load)
+    startup.background("fonts", font_manager.ensure)
+    startup.background("wallpapers", wallpapers.refresh_async)
+    startup.background("bot", bot.start)
+    startup.log_summary()
     yield
     print("🛑 Stopping EmbyPulse...")
+    webhook_journal.stop()
     bot.stop()
+    delivery.stop()
+    delayed_jobs.stop()
+    report_gen.pool.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -50,6 +80,10 @@ app.include_router(insight.router)
 app.include_router(webhook.router)
 # 🔥 注册 tasks 路由
 app.include_router(tasks.router)
+app.include_router(schedule.router)
+app.include_router(search.router)
+
+startup.imported(_IMPORT_START)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,7 +1,12 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, HTTPException
 from app.schemas.models import BotSettingsModel
 from app.core.config import cfg
 from app.services.bot_service import bot
+from app.services.tg_delivery import delivery, api_url
+from app.services.tg_file_ids import file_ids
+from app.services.playback_tracker import playback_tracker
+import hmac
+import asyncio
 import requests
 import threading
 
@@ -15,10 +20,13 @@ def api_get_bot_settings(request: Request):
 @router.post("/api/bot/settings")
 def api_save_bot_settings(data: BotSettingsModel, request: Request):
     if not request.session.get("user"): return {"status": "error"}
-    cfg.set("tg_bot_token", data.tg_bot_token); cfg.set("tg_chat_id", data.tg_chat_id)
-    cfg.set("enable_bot", data.enable_bot)
-    cfg.set("enable_notify", data.enable_notify)
-    cfg.set("enable_library_notify", data.enable_library_notify) # 🔥 新增
+    changes = {"tg_bot_token": data.tg_bot_token, "tg_chat_id": data.tg_chat_id,
+               "enable_bot": data.enable_bot, "enable_notify": data.enable_notify,
+               "enable_library_notify": data.enable_library_notify} # 🔥 新增
+    if data.tg_mode: changes["tg_mode"] = data.tg_mode
+    if data.tg_webhook_url is not None: changes["tg_webhook_url"] = data.tg_webhook_url.strip()
+    try: cfg.update(changes)
+    except Exception as e: return {"status": "error", "message": f"保存失败: {e}"}
     
     bot.stop()
     if data.enable_bot: threading.Timer(1.0, bot.start).start()
@@ -31,6 +39,44 @@ def api_test_bot(request: Request):
     if not token: return {"status": "error", "message": "请先保存配置"}
     try:
         proxies = {"http": proxy, "https": proxy} if proxy else None
-        res = requests.post(f"https://api.telegram.org/bot{token}/sendMessage", json={"chat_id": chat_id, "text": "🎉 测试消息"}, proxies=proxies, timeout=10)
+        res = requests.post(api_url("sendMessage", token), json={"chat_id": chat_id, "text": "🎉 测试消息"}, proxies=proxies, timeout=10)
         return {"status": "success"} if res.status_code == 200 else {"status": "error", "message": f"API Error: {res.text}"}
-    except Exception as e: return {"status": "error", "message": str(e)}
\ No newline at end of file
+    except Exception as e: return {"status": "error", "message": str(e)}
+
+@router.get("/api/bot/queue")
+def api_bot_queue(request: Request):
+    """推送队列深度、延迟与发送统计"""
+    if not request.session.get("user"): return {"status": "error"}
+    return {"status": "success", "data": {**delivery.metrics(), "file_ids": file_ids.stats, "playback": playback_tracker.stats}}
+
+@router.get("/api/bot/sessions")
+def api_bot_sessions(request: Request):
+    """会话跟踪器中的播放会话 (含等待续播的)"""
+    if not request.session.get("user"): return {"status": "error"}
+    return {"status": "success", "data": playback_tracker.active()}
+
+@router.get("/api/bot/commands")
+def api_bot_commands(request: Request):
+    """指令分发器：排队数与各指令耗时"""
+    if not request.session.get("user"): return {"status": "error"}
+    return {"status": "success", "data": bot.dispatcher.metrics()}
+
+@router.post("/api/bot/webhook")
+async def api_bot_webhook(request: Request):
+    """Telegram webhook 接收端：校验 secret token 后交给与轮询相同的处理流程"""
+    if not bot.running or bot.mode != "webhook": raise HTTPException(status_code=404)
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    secret = cfg.get("tg_webhook_secret") or ""
+    # secret 未生成时一律拒绝 (空串与空串比较会通过)
+    if not secret or not hmac.compare_digest(token, secret): raise HTTPException(status_code=403, detail="Invalid Token")
+    try: update = await request.json()
+    except Exception: raise HTTPException(status_code=400)
+    # 只做过滤和入队，指令在分发器线程池中执行，尽快返回 200 避免 Telegram 重投
+    await asyncio.get_running_loop().run_in_executor(None, bot.process_update, update)
+    return {"ok": True}
+
+@router.get("/api/bot/webhook/info")
+def api_bot_webhook_info(request: Request):
+    if not request.session.get("user"): return {"status": "error"}
+    try: return {"status": "success", "mode": bot.mode, "data": bot.webhook_info()}
+    except Exception as e: return {"status": "error", "message": str(e)}
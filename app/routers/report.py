@@ -1,21 +1,30 @@
 from fastapi import APIRouter, Request, Response
-from app.schemas.models import PushRequestModel
+from app.schemas.models import PushRequestModel, BatchReportModel
 from app.services.report_service import report_gen, HAS_PIL
 from app.services.bot_service import bot
+from app.services.batch_report_service import batch_reports
 import io
 
 router = APIRouter()
 
 @router.get("/api/report/preview")
-async def api_preview_report(request: Request, user_id: str = 'all', period: str = 'day'):
+async def api_preview_report(request: Request, user_id: str = 'all', period: str = 'day', theme: str = 'black_gold', layout: str = 'list', preset: str = 'web'):
     if not request.session.get("user"): return Response(status_code=403)
     if not HAS_PIL: return Response(content="Pillow not installed", status_code=500)
     
-    img_io = report_gen.generate_report(user_id, period)
-    if img_io:
-        return Response(content=img_io.read(), media_type="image/jpeg")
+    rendered = await report_gen.arender_report(user_id, period, theme, layout, preset)
+    if rendered:
+        payload, meta = rendered
+        headers = {"X-Encode-Ms": str(meta["encode_ms"]), "X-Image-Bytes": str(meta["bytes"]), "X-Image-Quality": str(meta["quality"])}
+        return Response(content=payload, media_type=meta["mime"], headers=headers)
     return Response(status_code=500)
 
+@router.get("/api/report/encode_stats")
+def api_report_encode_stats(request: Request):
+    """各编码预设的平均耗时与输出体积"""
+    if not request.session.get("user"): return {"status": "error"}
+    return {"status": "success", "data": report_gen.encode_stats.snapshot()}
+
 @router.post("/api/report/push")
 async def api_push_report(data: PushRequestModel, request: Request):
     if not request.session.get("user"): return {"status": "error"}
@@ -24,4 +33,20 @@ async def api_push_report(data: PushRequestModel, request: Request):
     success = bot.push_now(data.user_id, data.period, data.theme)
     if success:
         return {"status": "success"}
-    return {"status": "error", "message": "Bot not configured"}
\ No newline at end of file
+    return {"status": "error", "message": "Bot not configured"}
+
+@router.post("/api/report/batch")
+def api_batch_report(data: BatchReportModel, request: Request):
+    """批量生成全部活跃用户的个人报表 (后台执行)"""
+    if not request.session.get("user"): return {"status": "error"}
+    if not HAS_PIL: return {"status": "error", "message": "Pillow not installed"}
+    if data.target not in ["disk", "bot"]: return {"status": "error", "message": "target 仅支持 disk / bot"}
+    job_id = batch_reports.start(data.period, data.theme, data.target, data.user_ids, data.layout, data.preset)
+    return {"status": "success", "job_id": job_id}
+
+@router.get("/api/report/batch/{job_id}")
+def api_batch_report_status(job_id: str, request: Request):
+    if not request.session.get("user"): return {"status": "error"}
+    job = batch_reports.get(job_id)
+    if not job: return {"status": "error", "message": "任务不存在"}
+    return {"status": "success", "data": job}
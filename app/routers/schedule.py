@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Request
+from app.schemas.models import ScheduleRequestModel
+from app.services.cron_scheduler import cron_scheduler, CronExpr, TASK_TYPES
+import datetime
+
+router = APIRouter()
+
+@router.get("/api/schedule")
+def api_schedule_list(request: Request):
+    """计划任务列表 (含下次/上次执行时间)"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    return {"status": "success", "data": cron_scheduler.listing(), "types": TASK_TYPES}
+
+@router.post("/api/schedule")
+def api_schedule_save(data: ScheduleRequestModel, request: Request):
+    """新建或修改任务 (id 相同即覆盖)"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    task = {"id": data.id, "type": data.type, "cron": data.cron, "enabled": data.enabled, "catch_up": data.catch_up,
+            "params": {"user_id": data.user_id, "period": data.period, "theme": data.theme}}
+    existing = cron_scheduler.get(data.id) if data.id else None
+    if existing and existing.get("builtin"): task["params"] = existing.get("params") or {}
+    try: saved = cron_scheduler.save(task)
+    except ValueError as e: return {"status": "error", "message": str(e)}
+    return {"status": "success", "data": saved}
+
+@router.delete("/api/schedule/{task_id}")
+def api_schedule_delete(task_id: str, request: Request):
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    try: ok = cron_scheduler.delete(task_id)
+    except ValueError as e: return {"status": "error", "message": str(e)}
+    return {"status": "success"} if ok else {"status": "error", "message": "任务不存在"}
+
+@router.post("/api/schedule/{task_id}/run")
+def api_schedule_run(task_id: str, request: Request):
+    """立即执行一次 (不影响下次触发时间)"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    return {"status": "success"} if cron_scheduler.run_now(task_id) else {"status": "error", "message": "任务不存在"}
+
+@router.get("/api/schedule/preview")
+def api_schedule_preview(request: Request, cron: str, count: int = 5):
+    """预览 cron 表达式接下来的触发时间"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    try:
+        expr = CronExpr(cron); t = datetime.datetime.now(); runs = []
+        for _ in range(max(1, min(count, 20))):
+            t = expr.next_after(t); runs.append(t.strftime("%Y-%m-%d %H:%M"))
+    except ValueError as e: return {"status": "error", "message": str(e)}
+    return {"status": "success", "data": runs}
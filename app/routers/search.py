@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Request
+from app.services.search_index import search_index
+
+router = APIRouter()
+
+@router.get("/api/search")
+def api_search(request: Request, q: str = '', limit: int = 20, type: str = None):
+    """本地索引搜索：标题/原名/拼音/首字母，按匹配度排序"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    if type not in (None, "Movie", "Series"): type = None
+    rows, took = search_index.search(q, max(1, min(limit, 100)), type)
+    return {"status": "success", "data": rows, "took_ms": took, "total": len(rows)}
+
+@router.post("/api/search/sync")
+def api_search_sync(request: Request, full: bool = False):
+    """手动触发索引同步 (后台执行)"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    search_index.sync_async(full=full or None)
+    return {"status": "success"}
+
+@router.get("/api/search/status")
+def api_search_status(request: Request):
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    return {"status": "success", "data": {"items": search_index.count(), **search_index.stats}}
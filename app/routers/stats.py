@@ -2,6 +2,7 @@ from fastapi import APIRouter
 from typing import Optional
 from app.core.config import cfg
 from app.core.database import query_db, get_base_filter
+from app.services.playback_store import playback_store
 import requests
 
 router = APIRouter()
@@ -322,4 +323,10 @@ def api_monthly_stats(user_id: Optional[str] = None):
         if results: 
             for r in results: data[r['Month']] = int(r['Duration'])
         return {"status": "success", "data": data}
-    except: return {"status": "error", "data": {}}
\ No newline at end of file
+    except: return {"status": "error", "data": {}}
+
+@router.get("/api/stats/native/status")
+def api_native_status():
+    """原生播放记录状态：数据源、各月分表行数、字典规模、写入批次"""
+    try: return {"status": "success", "data": playback_store.status()}
+    except Exception as e: return {"status": "error", "message": str(e)}
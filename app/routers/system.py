@@ -1,40 +1,60 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
 from app.schemas.models import SettingsModel
 from app.core.config import cfg, FALLBACK_IMAGE_URL, TMDB_FALLBACK_POOL
-import requests
+from app.core.startup import startup
+from app.services.wallpaper_service import wallpapers
 import random
 
 router = APIRouter()
 
+# 探针无需登录：healthz 只看进程存活，readyz 看必需组件是否启动完成 (预热步骤仅展示进度)
+@router.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+@router.get("/readyz")
+def readyz():
+    report = startup.report()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
 @router.get("/api/settings")
 def api_get_settings(request: Request):
     if not request.session.get("user"): return {"status": "error"}
-    return {"status": "success", "data": cfg.get_all()}
+    return {"status": "success", "data": cfg.get_all(), "version": cfg.version}
 
 @router.post("/api/settings")
 def api_save_settings(data: SettingsModel, request: Request):
     if not request.session.get("user"): return {"status": "error"}
-    cfg.set("emby_host", data.emby_host.rstrip('/'))
-    cfg.set("emby_api_key", data.emby_api_key)
-    cfg.set("tmdb_api_key", data.tmdb_api_key)
-    cfg.set("proxy_url", data.proxy_url)
-    cfg.set("webhook_token", data.webhook_token) # 🔥 保存令牌
-    cfg.set("hidden_users", data.hidden_users)
-    return {"status": "success"}
+    # 一次写盘；相关缓存 (Emby 连接、用户名、报表) 由订阅者按变化的键失效
+    try:
+        changed = cfg.update({
+            "emby_host": data.emby_host.rstrip('/'),
+            "emby_api_key": data.emby_api_key,
+            "tmdb_api_key": data.tmdb_api_key,
+            "proxy_url": data.proxy_url,
+            "webhook_token": data.webhook_token, # 🔥 保存令牌
+            "hidden_users": data.hidden_users
+        })
+    except Exception as e: return {"status": "error", "message": f"保存失败: {e}"}
+    return {"status": "success", "changed": sorted(changed), "version": cfg.version}
 
 @router.get("/api/wallpaper")
 def api_get_wallpaper():
-    tmdb_key = cfg.get("tmdb_api_key"); proxy = cfg.get("proxy_url")
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    if tmdb_key:
-        try:
-            url = f"https://api.themoviedb.org/3/trending/all/week?api_key={tmdb_key}&language=zh-CN"
-            res = requests.get(url, timeout=8, proxies=proxies)
-            if res.status_code == 200:
-                data = res.json()
-                results = [i for i in data.get("results", []) if i.get("backdrop_path")]
-                if results:
-                    target = random.choice(results)
-                    return {"status": "success", "url": f"https://image.tmdb.org/t/p/original{target['backdrop_path']}", "title": target.get("title") or target.get("name")}
-        except: pass
-    return {"status": "success", "url": random.choice(TMDB_FALLBACK_POOL), "title": "Cinematic Collection"}
\ No newline at end of file
+    """登录页壁纸：从本地缓存随机取一张，不访问 TMDB (缓存过期时后台刷新)"""
+    item = wallpapers.pick()
+    if item: return {"status": "success", **item}
+    # 首次启动缓存尚未就绪
+    return {"status": "success", "url": random.choice(TMDB_FALLBACK_POOL).replace("/original/", "/w1280/"), "title": "Cinematic Collection"}
+
+@router.get("/api/wallpaper/img/{name}")
+def api_wallpaper_image(name: str):
+    path = wallpapers.path_of(name)
+    if not path: return Response(status_code=404)
+    # 文件名随图片内容而定，可以永久缓存
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@router.get("/api/wallpaper/status")
+def api_wallpaper_status(request: Request):
+    if not request.session.get("user"): return {"status": "error"}
+    return {"status": "success", "data": wallpapers.status()}
@@ -1,32 +1,49 @@
 from fastapi import APIRouter, Request
-from app.schemas.models import UserUpdateModel, NewUserModel
+from typing import Optional
+from app.schemas.models import UserUpdateModel, NewUserModel, ExpirationRunModel, BulkUserModel
 from app.core.config import cfg
-from app.core.database import query_db
+from app.core.database import query_db, execute_many
+from app.services.emby_client import emby, EmbyError
+from app.services.expiration_service import expiration
+from app.services.user_activity import user_activity
 import requests
 import datetime
 
 router = APIRouter()
 
+SORT_KEYS = {
+    "name": lambda u: (u["Name"] or "").lower(),
+    "last_play": lambda u: u["LastPlayDate"] or "",
+    "last_login": lambda u: u["LastLoginDate"] or "",
+    "recent_hours": lambda u: u["RecentHours"],
+    "plays": lambda u: u["Plays"],
+    "expire_date": lambda u: u["ExpireDate"] or "9999",
+    "device": lambda u: (u["TopDevice"] or "").lower()
+}
+
 @router.get("/api/manage/users")
-def api_manage_users(request: Request):
+def api_manage_users(request: Request, q: Optional[str] = None, status: Optional[str] = None, inactive_days: int = 0,
+                     sort: str = "name", order: str = "asc", offset: int = 0, limit: int = 0):
     """
-    获取用户列表及元数据
+    获取用户列表及元数据，附带播放活跃度 (最后播放、近 30 天时长、总播放、常用设备)
+    q: 按用户名/备注/设备筛选; status: enabled / disabled / expired / admin
+    inactive_days: 只看超过 N 天没有播放的用户; sort: SORT_KEYS 之一; limit 为 0 时返回全部
     """
     if not request.session.get("user"): return {"status": "error"}
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
     try:
-        res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=5)
-        if res.status_code != 200: return {"status": "error", "message": "Emby API Error"}
-        emby_users = res.json()
+        emby_users = emby.list_users()
         
         # 获取本地数据库中的扩展信息（过期时间、备注）
         meta_rows = query_db("SELECT * FROM users_meta")
         meta_map = {r['user_id']: dict(r) for r in meta_rows} if meta_rows else {}
+        # 播放活跃度：一次分组聚合，按数据版本缓存
+        activity = user_activity.get()
         
         final_list = []
         for u in emby_users:
             uid = u['Id']
             meta = meta_map.get(uid, {})
+            act = activity.get(uid, {})
             policy = u.get('Policy', {})
             final_list.append({
                 "Id": uid, 
@@ -36,9 +53,29 @@ def api_manage_users(request: Request):
                 "IsAdmin": policy.get('IsAdministrator', False),
                 "ExpireDate": meta.get('expire_date'), 
                 "Note": meta.get('note'), 
-                "PrimaryImageTag": u.get('PrimaryImageTag')
+                "PrimaryImageTag": u.get('PrimaryImageTag'),
+                "LastPlayDate": act.get('last_play'),
+                "Plays": act.get('plays', 0),
+                "RecentHours": act.get('recent_hours', 0),
+                "TopDevice": act.get('top_device')
             })
-        return {"status": "success", "data": final_list}
+
+        # 服务端筛选 / 排序 / 分页
+        if q:
+            kw = q.lower()
+            final_list = [u for u in final_list if any(kw in (u[k] or "").lower() for k in ("Name", "Note", "TopDevice"))]
+        if status:
+            today = datetime.date.today().isoformat()
+            match = {"enabled": lambda u: not u["IsDisabled"], "disabled": lambda u: u["IsDisabled"],
+                     "admin": lambda u: u["IsAdmin"], "expired": lambda u: bool(u["ExpireDate"]) and u["ExpireDate"] < today}.get(status)
+            if match: final_list = [u for u in final_list if match(u)]
+        if inactive_days > 0:
+            cutoff = (datetime.datetime.now() - datetime.timedelta(days=inactive_days)).strftime("%Y-%m-%d %H:%M:%S")
+            final_list = [u for u in final_list if (u["LastPlayDate"] or "") < cutoff]
+        final_list.sort(key=SORT_KEYS.get(sort, SORT_KEYS["name"]), reverse=order == "desc")
+        total = len(final_list)
+        if offset > 0 or limit > 0: final_list = final_list[max(0, offset):(max(0, offset) + limit) if limit > 0 else None]
+        return {"status": "success", "data": final_list, "total": total}
     except Exception as e: return {"status": "error", "message": str(e)}
 
 @router.post("/api/manage/user/update")
@@ -118,6 +155,67 @@ def api_manage_user_delete(user_id: str, request: Request):
         return {"status": "error", "message": "删除失败"}
     except Exception as e: return {"status": "error", "message": str(e)}
 
+BULK_LIMIT = 1000
+
+@router.post("/api/manage/users/bulk")
+def api_manage_users_bulk(data: BulkUserModel, request: Request):
+    """
+    批量操作：启用 / 停用 / 删除，可同时设置有效期
+    有效期在一个事务里批量写入；Emby 调用并发执行 (emby_concurrency)，逐个返回结果
+    """
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    ids = list(dict.fromkeys(i for i in data.user_ids if i))
+    if not ids: return {"status": "error", "message": "未选择用户"}
+    if len(ids) > BULK_LIMIT: return {"status": "error", "message": f"单次最多 {BULK_LIMIT} 个用户"}
+    if data.action not in (None, "enable", "disable", "delete"): return {"status": "error", "message": f"未知操作: {data.action}"}
+    if data.action is None and data.expire_date is None: return {"status": "error", "message": "没有要执行的操作"}
+    print(f"📝 Bulk User Request: {data.action or 'expire'} x {len(ids)}")
+    results = {uid: {"user_id": uid, "ok": True} for uid in ids}
+
+    try:
+        # 1. Emby 操作 (用户列表一次取回，策略在原有基础上合并修改)
+        if data.action in ("enable", "disable"):
+            users = {u["Id"]: u for u in emby.list_users()}
+            disable = data.action == "disable"
+            changes = {"IsDisabled": True} if disable else {"IsDisabled": False, "LoginAttemptsBeforeLockout": -1}
+
+            def apply(uid):
+                u = users.get(uid)
+                if not u: raise EmbyError(404, "用户不存在")
+                if (u.get("Policy") or {}).get("IsDisabled", False) == disable: return "unchanged"
+                emby.update_policy(uid, changes, user=u)
+                return "updated"
+            outcomes = emby.map_concurrent(apply, ids)
+        elif data.action == "delete":
+            outcomes = emby.map_concurrent(lambda uid: emby.delete_user(uid) or "deleted", ids)
+        else:
+            outcomes = [(uid, "unchanged", None) for uid in ids]
+
+        for uid, result, error in outcomes:
+            results[uid].update(ok=error is None, result=result)
+            if error: results[uid]["message"] = str(error)
+
+        # 2. 本地元数据 (单个事务)
+        done = [uid for uid in ids if results[uid]["ok"]]
+        if data.action == "delete":
+            if done and not execute_many("DELETE FROM users_meta WHERE user_id = ?", [(uid,) for uid in done]):
+                for uid in done: results[uid]["message"] = "Emby 已删除，本地记录清理失败"
+        elif data.expire_date is not None and done:
+            now = datetime.datetime.now().isoformat()
+            saved = execute_many("INSERT INTO users_meta (user_id, expire_date, created_at) VALUES (?, ?, ?) "
+                                 "ON CONFLICT(user_id) DO UPDATE SET expire_date = excluded.expire_date",
+                                 [(uid, data.expire_date, now) for uid in done])
+            for uid in done:
+                if saved: results[uid]["expire_date"] = data.expire_date
+                else: results[uid].update(ok=False, message="有效期保存失败")
+
+        items = [results[uid] for uid in ids]
+        failed = sum(1 for r in items if not r["ok"])
+        return {"status": "success", "data": items, "ok": len(items) - failed, "failed": failed}
+    except Exception as e:
+        print(f"❌ Bulk Error: {e}")
+        return {"status": "error", "message": str(e)}
+
 @router.get("/api/users")
 def api_get_users():
     """
@@ -133,4 +231,28 @@ def api_get_users():
             data.sort(key=lambda x: x['UserName'])
             return {"status": "success", "data": data}
         return {"status": "success", "data": []}
-    except Exception as e: return {"status": "error", "message": str(e)}
\ No newline at end of file
+    except Exception as e: return {"status": "error", "message": str(e)}
+
+@router.get("/api/manage/expiration/preview")
+def api_expiration_preview(request: Request):
+    """预演到期处理：会被停用的用户 + 即将到期的用户"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    try: return {"status": "success", "data": expiration.preview()}
+    except Exception as e: return {"status": "error", "message": str(e)}
+
+@router.post("/api/manage/expiration/run")
+def api_expiration_run(data: ExpirationRunModel, request: Request):
+    """立即执行到期检查 (dry_run 等同预演)"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    try:
+        if data.dry_run: return {"status": "success", "dry_run": True, "data": expiration.preview()}
+        result = expiration.run(notify=data.notify)
+        if result is None: return {"status": "error", "message": "到期检查正在执行中"}
+        return {"status": "success", "data": result}
+    except Exception as e: return {"status": "error", "message": str(e)}
+
+@router.get("/api/manage/expiration/log")
+def api_expiration_log(request: Request, limit: int = 200):
+    """到期处理日志 (最近在前)"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    return {"status": "success", "data": expiration.log(max(1, min(limit, 1000))), "last_run": expiration.last_run}
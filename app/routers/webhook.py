@@ -1,5 +1,11 @@
-from fastapi import APIRouter, Request, BackgroundTasks, HTTPException
-from app.services.bot_service import bot
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from app.services.media_aggregator import media_aggregator
+from app.services.search_index import search_index
+from app.services.playback_tracker import playback_tracker
+from app.services.playback_store import playback_store
+from app.services.webhook_journal import webhook_journal, QueueFull
 from app.core.config import cfg
 import json
 import logging
@@ -7,8 +13,34 @@ import logging
 logger = logging.getLogger("uvicorn")
 router = APIRouter()
 
+def process_event(event, data):
+    """由日志工作线程调用；抛出异常会退避重试"""
+    # 1. 入库通知 (按剧集/批次聚合后推送，原始 item 用于兜底)
+    if event in ["library.new", "item.added"]:
+        item = data.get("Item", {})
+        if item.get("Id") and item.get("Type") in ["Movie", "Episode", "Series"]:
+            media_aggregator.add(item)
+        # 搜索索引只收录电影/剧集本身，新集入库时刷新所属剧集 (集数变化)
+        target = item.get("SeriesId") if item.get("Type") == "Episode" else item.get("Id")
+        if target: search_index.index_item(target)
+
+    elif event == "library.deleted":
+        item = data.get("Item", {})
+        if item.get("Type") in ["Movie", "Series"]: search_index.remove([item.get("Id")])
+        elif item.get("SeriesId"): search_index.index_item(item.get("SeriesId"))
+
+    # 2. 播放状态
+    # 先写原生播放记录 (启用时，落盘失败抛出异常由日志重试)；
+    # 再经会话跟踪器去重/去抖：续播合并，停止时推送一条观看汇总
+    elif event in ["playback.start", "playback.stop", "playback.pause", "playback.unpause", "playback.progress"]:
+        action = event.split(".", 1)[1]
+        playback_store.record(action, data)
+        if action != "progress": playback_tracker.handle(data, action)
+
+webhook_journal.register(process_event)
+
 @router.post("/api/v1/webhook")
-async def emby_webhook(request: Request, background_tasks: BackgroundTasks):
+async def emby_webhook(request: Request):
     query_token = request.query_params.get("token")
     if query_token != cfg.get("webhook_token"):
         raise HTTPException(status_code=403, detail="Invalid Token")
@@ -22,26 +54,30 @@ async def emby_webhook(request: Request, background_tasks: BackgroundTasks):
             form = await request.form()
             raw_data = form.get("data")
             if raw_data: data = json.loads(raw_data)
+    except Exception as e:
+        # 请求体本身有问题，重发也不会成功
+        logger.error(f"Webhook Parse Error: {e}")
+        return {"status": "error", "message": str(e)}
+    if not data: return {"status": "error", "message": "Empty"}
 
-        if not data: return {"status": "error", "message": "Empty"}
-
-        event = data.get("Event", "").lower().strip()
-        if event: logger.info(f"🔔 Webhook: {event}")
-
-        # 1. 入库通知 (传递原始 item 用于兜底)
-        if event in ["library.new", "item.added"]:
-            item = data.get("Item", {})
-            if item.get("Id") and item.get("Type") in ["Movie", "Episode", "Series"]:
-                background_tasks.add_task(bot.push_new_media, item.get("Id"), item)
-
-        # 2. 播放状态
-        elif event == "playback.start":
-            background_tasks.add_task(bot.push_playback_event, data, "start")
-        elif event == "playback.stop":
-            background_tasks.add_task(bot.push_playback_event, data, "stop")
-            # 🔥 移除 save_playback_activity
+    event = data.get("Event", "").lower().strip()
+    if event: logger.info(f"🔔 Webhook: {event}")
 
-        return {"status": "success"}
+    # 先落盘再返回，处理交给工作线程 (重启不丢、突发不堵塞请求线程)
+    try:
+        event_id, duplicate = await run_in_threadpool(webhook_journal.append, event, data)
+    except QueueFull as e:
+        logger.warning(f"Webhook Rejected: {e}")
+        return JSONResponse(status_code=503, headers={"Retry-After": str(e.retry_after)},
+                            content={"status": "error", "message": "Too many pending events"})
     except Exception as e:
-        logger.error(f"Webhook Error: {e}")
-        return {"status": "error", "message": str(e)}
\ No newline at end of file
+        # 落盘失败 (库被锁、磁盘满等) 返回 5xx，让 Emby 重发，不能当作已送达
+        logger.error(f"Webhook Journal Error: {e}")
+        return JSONResponse(status_code=503, headers={"Retry-After": "30"}, content={"status": "error", "message": str(e)})
+    return JSONResponse(status_code=202, content={"status": "accepted", "id": event_id, "duplicate": duplicate})
+
+@router.get("/api/v1/webhook/metrics")
+def api_webhook_metrics(request: Request):
+    """接收日志积压、延迟与失败统计"""
+    if not request.session.get("user"): return {"status": "error", "message": "Unauthorized"}
+    return {"status": "success", "data": webhook_journal.metrics()}
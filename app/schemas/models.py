@@ -19,16 +19,31 @@ class BotSettingsModel(BaseModel):
     enable_bot: bool
     enable_notify: bool
     enable_library_notify: Optional[bool] = False
+    tg_mode: Optional[str] = None  # polling / webhook
+    tg_webhook_url: Optional[str] = None
 
 class PushRequestModel(BaseModel):
     user_id: str
     period: str
     theme: str
 
+class BatchReportModel(BaseModel):
+    period: str = "week"
+    theme: str = "black_gold"
+    target: str = "disk"  # disk | bot
+    layout: str = "list"  # list | poster
+    preset: Optional[str] = None  # jpeg | web | telegram | archive，默认 disk=archive, bot=telegram
+    user_ids: Optional[List[str]] = None
+
 class ScheduleRequestModel(BaseModel):
-    user_id: str
-    period: str
-    theme: str
+    id: Optional[str] = None
+    type: str = "report_push"  # report_push / daily_report / expiration_check / cache_warmup
+    cron: str = "0 9 * * *"
+    enabled: bool = True
+    catch_up: bool = True  # 停机错过的触发是否在启动后补跑
+    user_id: str = "all"
+    period: str = "day"
+    theme: str = "black_gold"
 
 class UserUpdateModel(BaseModel):
     user_id: str
@@ -36,6 +51,15 @@ class UserUpdateModel(BaseModel):
     is_disabled: Optional[bool] = None
     expire_date: Optional[str] = None 
 
+class BulkUserModel(BaseModel):
+    user_ids: List[str]
+    action: Optional[str] = None  # enable / disable / delete，只改有效期时留空
+    expire_date: Optional[str] = None  # 同时设置有效期，空字符串 = 清除
+
+class ExpirationRunModel(BaseModel):
+    dry_run: bool = False  # 只预演，不停用
+    notify: bool = True
+
 class NewUserModel(BaseModel):
     name: str
     password: Optional[str] = None 
@@ -0,0 +1,77 @@
+import os
+import io
+import re
+import time
+import uuid
+import datetime
+import threading
+import logging
+from app.core.config import cfg, CONFIG_DIR
+from app.services.report_service import report_gen
+from app.services.bot_service import bot
+
+logger = logging.getLogger("uvicorn")
+
+REPORT_OUTPUT_DIR = os.path.join(CONFIG_DIR, "reports")
+
+class BatchReportService:
+    """
+    全服个人报表批量生成：一次分组查询 + 进程池并行渲染
+    结果推送到 Telegram (target=bot) 或写入 config/reports 目录 (target=disk)
+    """
+    def __init__(self):
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def start(self, period="week", theme="black_gold", target="disk", user_ids=None, layout="list", preset=None):
+        job_id = uuid.uuid4().hex[:12]
+        if not preset: preset = "archive" if target == "disk" else "telegram"
+        job = {"id": job_id, "period": period, "theme": theme, "target": target, "layout": layout, "preset": preset, "state": "running",
+               "total": 0, "done": 0, "failed": 0, "files": [], "bytes": 0, "encode_ms": 0.0, "started_at": time.time(), "elapsed": None, "error": None}
+        with self._lock:
+            self.jobs[job_id] = job
+            # 只保留最近 20 个任务记录
+            for old in list(self.jobs)[:-20]: self.jobs.pop(old, None)
+        threading.Thread(target=self._run, args=(job, user_ids), daemon=True).start()
+        return job_id
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _run(self, job, user_ids):
+        try:
+            results = report_gen.generate_batch(job["period"], job["theme"], user_ids, job["layout"], job["preset"])
+            job["total"] = len(results)
+            out_dir = None
+            if job["target"] == "disk":
+                out_dir = os.path.join(REPORT_OUTPUT_DIR, f"{job['period']}-{datetime.date.today().strftime('%Y%m%d')}")
+                os.makedirs(out_dir, exist_ok=True)
+            chat_id = str(cfg.get("tg_chat_id") or "")
+
+            for uid, (data, payload, meta) in results.items():
+                job["bytes"] += meta["bytes"]; job["encode_ms"] = round(job["encode_ms"] + meta["encode_ms"], 1)
+                try:
+                    if out_dir:
+                        safe_name = re.sub(r'[\\/:*?"<>|\s]+', '_', data["user_name"])
+                        path = os.path.join(out_dir, f"{safe_name}_{uid[:8]}.{meta['ext']}")
+                        with open(path, 'wb') as f: f.write(payload)
+                        job["files"].append(path)
+                    elif chat_id:
+                        caption = (f"📊 <b>{data['user_name']} · {data['title_period']}</b>\n"
+                                   f"▶️ 播放 {data['plays']} 次 | ⏱️ {data['hours']} 小时")
+                        bot.send_photo(chat_id, io.BytesIO(payload), caption, filename=f"report.{meta['ext']}", mime=meta["mime"])
+                    else:
+                        raise Exception("Bot not configured")
+                    job["done"] += 1
+                except Exception as e:
+                    job["failed"] += 1
+                    logger.error(f"Batch Report Deliver Error ({uid}): {e}")
+            job["state"] = "finished"
+        except Exception as e:
+            job["state"] = "failed"; job["error"] = str(e)
+            logger.error(f"Batch Report Error: {e}")
+        finally:
+            job["elapsed"] = round(time.time() - job["started_at"], 2)
+            logger.info(f"📦 Batch Report {job['id']}: {job['done']}/{job['total']} in {job['elapsed']}s, {job['bytes'] // 1024}KB, encode {job['encode_ms']}ms")
+
+batch_reports = BatchReportService()
@@ -0,0 +1,142 @@
+"""
+机器人指令分发器
+轮询线程只负责收消息，指令交给线程池执行：
+- 同一聊天内按收到的顺序串行执行 (回复不会乱序)，不同聊天互不阻塞
+- 按指令分组限制并发 (如报表渲染同时只跑 1 个)：名额在占用线程之前判断，
+  分组已满的聊天挂到该组的等待队列，不占线程池，其他指令照常执行
+- 慢指令先回一条 "处理中" 提示
+- 记录每个指令的排队与执行耗时
+"""
+import time
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import cfg
+
+logger = logging.getLogger("uvicorn")
+
+class CommandStats:
+    def __init__(self):
+        self.count = 0; self.errors = 0
+        self.run_ms = deque(maxlen=200)
+        self.wait_ms = deque(maxlen=200)
+
+    def snapshot(self):
+        run = sorted(self.run_ms); wait = sorted(self.wait_ms)
+        pct = lambda arr, p: round(arr[min(len(arr) - 1, int(len(arr) * p))], 1) if arr else 0
+        return {"count": self.count, "errors": self.errors,
+                "run_p50_ms": pct(run, 0.5), "run_p95_ms": pct(run, 0.95), "run_max_ms": round(run[-1], 1) if run else 0,
+                "wait_p50_ms": pct(wait, 0.5), "wait_p95_ms": pct(wait, 0.95)}
+
+class CommandDispatcher:
+    def __init__(self, ack=None):
+        self._commands = {}                 # name -> (func, slow, group)
+        self._limits = {}                   # group -> 并发上限
+        self._running = {}                  # group -> 执行中的数量
+        self._waiting = {}                  # group -> deque[chat_id]：等待该组名额的聊天
+        self._queues = {}                   # chat_id -> deque[(name, text, 入队时间)]
+        self._active = set()                # 有指令在执行或等待名额的聊天
+        self._lock = threading.Lock()
+        self._executor = None
+        self._epoch = 0                     # shutdown 后递增，旧任务结束时不再调度
+        self._ack = ack                     # func(chat_id, name)：慢指令的即时回执
+        self.stats = {}
+
+    def register(self, name, func, slow=False, group=None):
+        """func(chat_id, text)；group 为并发分组名，同组共享 limit 设定的并发上限"""
+        self._commands[name] = (func, slow, group or name)
+        self.stats.setdefault(name, CommandStats())
+
+    def limit(self, group, n):
+        self._limits[group] = max(1, int(n))
+
+    def _get_executor(self):
+        if not self._executor:
+            workers = max(1, int(cfg.get("bot_workers") or 4))
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bot-cmd")
+        return self._executor
+
+    def parse(self, text):
+        """'/stats@MyBot 参数' -> 'stats'；'/search关键词' 这类不带空格的写法按前缀匹配已注册指令"""
+        text = (text or "").strip()
+        if not text.startswith("/"): return None
+        name = text.split()[0][1:].split("@")[0].lower()
+        if name in self._commands: return name
+        return next((n for n in self._commands if name.startswith(n)), None)
+
+    def submit(self, chat_id, text):
+        name = self.parse(text)
+        if name not in self._commands: return False
+        func, slow, group = self._commands[name]
+        if slow and self._ack:
+            try: self._ack(chat_id, name)
+            except Exception as e: logger.error(f"Bot Ack Error: {e}")
+        with self._lock:
+            self._queues.setdefault(chat_id, deque()).append((name, text, time.time()))
+            if chat_id in self._active: return True
+            self._active.add(chat_id)
+            task = self._next(chat_id)
+        if task: self._start(task)
+        return True
+
+    def _next(self, chat_id):
+        """持锁调用：取出该聊天的下一条指令并占用分组名额；分组已满时挂到等待队列，返回 None"""
+        queue = self._queues.get(chat_id)
+        if not queue:
+            self._queues.pop(chat_id, None)
+            self._active.discard(chat_id)
+            return None
+        group = self._commands[queue[0][0]][2]
+        limit = self._limits.get(group)
+        if limit is not None and self._running.get(group, 0) >= limit:
+            self._waiting.setdefault(group, deque()).append(chat_id)
+            return None
+        self._running[group] = self._running.get(group, 0) + 1
+        name, text, queued_at = queue.popleft()
+        return (self._epoch, chat_id, group, name, text, queued_at)
+
+    def _start(self, task):
+        if task[0] != self._epoch: return
+        self._get_executor().submit(self._run, *task)
+
+    def _run(self, epoch, chat_id, group, name, text, queued_at):
+        if epoch != self._epoch: return
+        func = self._commands[name][0]
+        stat = self.stats[name]
+        start = time.time()
+        try:
+            stat.wait_ms.append((start - queued_at) * 1000)
+            func(chat_id, text)
+        except Exception as e:
+            stat.errors += 1
+            logger.error(f"Bot Command Error (/{name}): {e}")
+        finally:
+            stat.count += 1
+            stat.run_ms.append((time.time() - start) * 1000)
+        tasks = []
+        with self._lock:
+            if epoch != self._epoch: return
+            self._running[group] -= 1
+            # 空出的名额先给等待该组的聊天，再继续本聊天的下一条
+            waiting = self._waiting.get(group)
+            if waiting: tasks.append(self._next(waiting.popleft()))
+            tasks.append(self._next(chat_id))
+        for task in tasks:
+            if task: self._start(task)
+
+    def metrics(self):
+        with self._lock:
+            pending = sum(len(q) for q in self._queues.values())
+            waiting = {g: len(q) for g, q in self._waiting.items() if q}
+        return {"pending": pending, "active_chats": len(self._active), "waiting": waiting,
+                "commands": {name: s.snapshot() for name, s in self.stats.items() if s.count}}
+
+    def shutdown(self):
+        """丢弃未执行的指令；执行中的指令结束后不再调度后续任务"""
+        with self._lock:
+            self._epoch += 1
+            self._queues.clear(); self._active.clear()
+            self._running.clear(); self._waiting.clear()
+            executor, self._executor = self._executor, None
+        if executor: executor.shutdown(wait=False, cancel_futures=True)
@@ -6,9 +6,17 @@ import io
 import logging
 import urllib.parse
 import json 
+import secrets
+from collections import deque
 from app.core.config import cfg, REPORT_COVER_URL, FALLBACK_IMAGE_URL
 from app.core.database import query_db, get_base_filter
 from app.services.report_service import report_gen, HAS_PIL
+from app.services.tg_delivery import delivery, api_url
+from app.services.delayed_jobs import delayed_jobs, Retry
+from app.services.geoip import geoip
+from app.services.tg_file_ids import file_ids
+from app.services.bot_dispatcher import CommandDispatcher
+from app.services.search_index import search_index, extract_tech_info
 
 logger = logging.getLogger("uvicorn")
 
@@ -16,23 +24,69 @@ class TelegramBot:
     def __init__(self):
         self.running = False
         self.poll_thread = None
-        self.schedule_thread = None 
         self.offset = 0
-        self.last_check_min = -1
+        self.mode = None
+        self._token = None                       # 启动时的令牌，stop 时据此注销 webhook
+        self._generation = 0                     # 每次 start 递增，旧轮询线程据此退出
+        self._recent_updates = deque(maxlen=500) # webhook 重投的 update 去重
         self.user_cache = {}
+        cfg.subscribe({"emby_host", "emby_api_key"}, lambda keys: self.user_cache.clear())
+        delayed_jobs.register("new_media", self._new_media_job)
+        delayed_jobs.register("tg_reupload", self._reupload_job)
+        delivery.add_listener(self._on_delivered)
+        delivery.add_failure_listener(self._on_delivery_failed)
+        self.dispatcher = self._build_dispatcher()
+
+    def _build_dispatcher(self):
+        d = CommandDispatcher(ack=self._ack_command)
+        d.register("search", self._cmd_search, slow=True)
+        for name, period in [("stats", 'day'), ("weekly", 'week'), ("monthly", 'month'), ("yearly", 'year')]:
+            d.register(name, lambda cid, text, p=period: self._cmd_stats(cid, p), slow=True, group="report")
+        d.register("latest", lambda cid, text: self._cmd_latest(cid), slow=True)
+        d.register("now", lambda cid, text: self._cmd_now(cid))
+        d.register("recent", lambda cid, text: self._cmd_recent(cid))
+        d.register("check", lambda cid, text: self._cmd_check(cid))
+        d.register("help", lambda cid, text: self._cmd_help(cid))
+        # 报表渲染占 CPU，同时只跑一个；搜索是多次串行 Emby 请求，限 2 个
+        d.limit("report", 1); d.limit("search", 2)
+        return d
+
+    def _ack_command(self, chat_id, name):
+        if name == "search" and search_index.count() > 0: return   # 本地索引毫秒级返回，无需提示
+        self.send_message(chat_id, "⏳ 正在处理，请稍候…")
         
     def start(self):
         if self.running: return
         if not cfg.get("tg_bot_token"): return
+        mode = "webhook" if cfg.get("tg_mode") == "webhook" and cfg.get("tg_webhook_url") else "polling"
+        if mode == "webhook":
+            # 切到 webhook 模式前先生成并保存 secret，否则接收端在此之前会接受不带 secret 的请求
+            try: self.webhook_secret()
+            except Exception as e:
+                logger.error(f"Webhook Secret Error, falling back to polling: {e}")
+                mode = "polling"
         self.running = True
-        self._set_commands()
-        self.poll_thread = threading.Thread(target=self._polling_loop, daemon=True)
-        self.poll_thread.start()
-        self.schedule_thread = threading.Thread(target=self._scheduler_loop, daemon=True)
-        self.schedule_thread.start()
-        print("🤖 Bot Service Started (Lite Mode)")
-
-    def stop(self): self.running = False
+        self._generation += 1
+        self.mode = mode
+        self._token = cfg.get("tg_bot_token")
+        # 注册指令要访问 Telegram (最长 10 秒)，放到后台，不阻塞启动
+        threading.Thread(target=self._set_commands, name="tg-commands", daemon=True).start()
+        if self.mode == "webhook":
+            threading.Thread(target=self._register_webhook, args=(self._generation,), daemon=True).start()
+        else:
+            self.poll_thread = threading.Thread(target=self._polling_loop, args=(self._generation,), daemon=True)
+            self.poll_thread.start()
+        print(f"🤖 Bot Service Started (Lite Mode, {self.mode})")
+
+    def stop(self):
+        mode, self.mode = self.mode, None
+        self.running = False
+        self._generation += 1
+        self.dispatcher.shutdown()
+        # 注销 webhook，否则 Telegram 会继续向已停用的机器人推送 (用启动时的令牌，配置可能已被改掉)
+        if mode == "webhook":
+            try: requests.post(api_url("deleteWebhook", self._token), json={"drop_pending_updates": False}, proxies=self._get_proxies(), timeout=5)
+            except Exception as e: logger.error(f"deleteWebhook Error: {e}")
 
     def _get_proxies(self):
         proxy = cfg.get("proxy_url")
@@ -65,15 +119,7 @@ class TelegramBot:
         return self.user_cache.get(user_id, "Unknown User")
 
     def _get_location(self, ip):
-        if not ip or ip in ['127.0.0.1', '::1', '0.0.0.0']: return "本地连接"
-        try:
-            res = requests.get(f"http://ip-api.com/json/{ip}?lang=zh-CN", timeout=3)
-            if res.status_code == 200:
-                d = res.json()
-                if d.get('status') == 'success':
-                    return f"{d.get('country')} {d.get('regionName')} {d.get('city')}"
-        except: pass
-        return "未知位置"
+        return geoip.lookup(ip)
 
     def _download_emby_image(self, item_id, img_type='Primary', image_tag=None):
         key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
@@ -88,35 +134,82 @@ class TelegramBot:
         except: pass
         return None
 
-    def send_photo(self, chat_id, photo_io, caption, parse_mode="HTML", reply_markup=None):
-        token = cfg.get("tg_bot_token")
-        if not token: return
+    def _emby_photo(self, item_id, img_type='Primary', image_tag=None):
+        """返回 (图片, file_key, reupload)：上传过的图片直接给 file_id，否则才去 Emby 下载"""
+        key = file_ids.emby_key(item_id, img_type, image_tag)
+        reupload = {"emby": [item_id, img_type, image_tag]}
+        file_id = file_ids.get(key)
+        if file_id: return file_id, key, reupload
+        return self._download_emby_image(item_id, img_type, image_tag), key, reupload
+
+    def send_photo(self, chat_id, photo_io, caption, parse_mode="HTML", reply_markup=None, filename="image.jpg", mime="image/jpeg", file_key=None, reupload=None):
+        """
+        入队发送图片 (实际发送/限速/重试由 delivery 队列负责)，图片最终失败时改发纯文字
+        file_key: 上传成功后记录 Telegram 返回的 file_id，下次同键直接引用
+        reupload: photo_io 为 file_id 时，file_id 失效后重新获取图片的方式
+        """
+        if not cfg.get("tg_bot_token"): return
         try:
-            url = f"https://api.telegram.org/bot{token}/sendPhoto"
-            data = {"chat_id": chat_id, "caption": caption, "parse_mode": parse_mode}
-            if reply_markup: data["reply_markup"] = json.dumps(reply_markup)
+            params = {"chat_id": chat_id, "caption": caption, "parse_mode": parse_mode}
+            if reply_markup: params["reply_markup"] = reply_markup
+            fallback = {"method": "sendMessage", "params": {"chat_id": chat_id, "text": caption, "parse_mode": parse_mode}}
             if isinstance(photo_io, str):
-                data['photo'] = photo_io
-                requests.post(url, data=data, proxies=self._get_proxies(), timeout=20)
+                upload = photo_io.startswith(("http://", "https://"))
+                if upload:
+                    # 网络图片同样记录 file_id，Telegram 不必每次重新抓取
+                    file_key = file_key or f"url:{photo_io}"
+                    cached = file_ids.get(file_key)
+                    if cached: reupload = {"url": photo_io}; photo_io = cached; upload = False
+                params['photo'] = photo_io
+                meta = {"file_key": file_key, "upload": upload, "reupload": reupload} if file_key else None
+                delivery.enqueue("sendPhoto", chat_id, params, fallback=fallback, meta=meta)
             else:
                 photo_io.seek(0)
-                files = {"photo": ("image.jpg", photo_io, "image/jpeg")}
-                requests.post(url, data=data, files=files, proxies=self._get_proxies(), timeout=30)
+                meta = {"file_key": file_key, "upload": True} if file_key else None
+                delivery.enqueue("sendPhoto", chat_id, params, files={"photo": (filename, photo_io.read(), mime)}, fallback=fallback, meta=meta)
         except Exception as e: 
             logger.error(f"Send Photo Error: {e}")
-            self.send_message(chat_id, caption)
+
+    def _on_delivered(self, method, meta, result):
+        """上传成功：记录 file_id"""
+        if not meta or not meta.get("upload"): return
+        if method == "sendPhoto":
+            file_ids.put(meta.get("file_key"), file_ids.largest_photo(result))
+        elif method == "sendMediaGroup":
+            for key, message in zip(meta.get("file_keys") or [], result or []):
+                if key: file_ids.put(key, file_ids.largest_photo(message))
+
+    def _on_delivery_failed(self, job, error):
+        """按 file_id 发送被拒 (失效/跨机器人)：作废映射并转为重新上传，而不是直接退化为纯文字"""
+        meta = job.get("meta") or {}
+        if not meta.get("reupload") or not error.startswith("HTTP 400"): return False
+        for key in [meta.get("file_key")] + (meta.get("reused_keys") or []):
+            if key: file_ids.forget(key)
+        params = {k: v for k, v in job["params"].items() if k not in ("photo", "media")}
+        delayed_jobs.schedule("tg_reupload", {"method": job["method"], "chat_id": job["chat_id"], "params": params,
+                                              "file_key": meta.get("file_key"), "reupload": meta["reupload"]})
+        logger.warning(f"TG file_id rejected, re-uploading: {meta.get('file_key') or job['method']}")
+        return True
+
+    def _reupload_job(self, payload, attempts):
+        source = payload["reupload"]; params = payload["params"]; cid = payload["chat_id"]
+        if "movies" in source: return self.push_new_movies(source["movies"])
+        photo = None
+        if "emby" in source: photo = self._download_emby_image(*source["emby"])
+        elif "report" in source: photo = report_gen.generate_report(*source["report"])
+        elif "url" in source: photo = source["url"]
+        if photo is None: return self.send_message(cid, params.get("caption", ""), params.get("parse_mode", "HTML"))
+        self.send_photo(cid, photo, params.get("caption", ""), params.get("parse_mode", "HTML"), params.get("reply_markup"), file_key=payload.get("file_key"))
 
     def send_message(self, chat_id, text, parse_mode="HTML"):
-        token = cfg.get("tg_bot_token")
-        if not token: return
-        try:
-            url = f"https://api.telegram.org/bot{token}/sendMessage"
-            requests.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": parse_mode}, proxies=self._get_proxies(), timeout=10)
+        if not cfg.get("tg_bot_token"): return
+        try: delivery.enqueue("sendMessage", chat_id, {"chat_id": chat_id, "text": text, "parse_mode": parse_mode})
         except Exception as e: logger.error(f"Send Message Error: {e}")
 
     # ================= 业务逻辑 =================
 
-    def push_playback_event(self, data, action="start"):
+    def push_playback_event(self, data, action="start", summary=None):
+        """summary: 停止时由会话跟踪器汇总的 {"watched", "segments", "progress", "completed"}"""
         if not cfg.get("enable_notify") or not cfg.get("tg_chat_id"): return
         try:
             chat_id = str(cfg.get("tg_chat_id"))
@@ -136,6 +229,7 @@ class TelegramBot:
             msg = (f"{emoji} <b>【{user.get('Name')}】{act}</b>\n"
                    f"📺 {title}\n"
                    f"📚 类型：{type_cn}\n"
+                   f"{self._format_playback_summary(summary) if summary else ''}"
                    f"🌐 地址：{ip} ({loc})\n"
                    f"📱 设备：{session.get('Client')} on {session.get('DeviceName')}\n"
                    f"🕒 时间：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -143,27 +237,46 @@ class TelegramBot:
             target_id = item.get("Id")
             if item.get("Type") == "Episode" and item.get("SeriesId"): target_id = item.get("SeriesId")
             
-            img_io = self._download_emby_image(target_id, 'Primary') 
-            if not img_io: img_io = self._download_emby_image(item.get("Id"), 'Backdrop')
+            photo, file_key, src = self._emby_photo(target_id, 'Primary')
+            if not photo: photo, file_key, src = self._emby_photo(item.get("Id"), 'Backdrop')
             
-            if img_io: self.send_photo(chat_id, img_io, msg)
+            if photo: self.send_photo(chat_id, photo, msg, file_key=file_key, reupload=src)
             else: self.send_message(chat_id, msg)
         except Exception as e:
             logger.error(f"Playback Push Error: {e}")
 
-    def push_new_media(self, item_id, fallback_item=None):
+    @staticmethod
+    def _format_playback_summary(summary):
+        minutes = int(summary.get("watched") or 0) // 60
+        watched = f"{minutes // 60} 小时 {minutes % 60} 分钟" if minutes >= 60 else f"{max(minutes, 1) if summary.get('watched') else 0} 分钟"
+        if summary.get("segments", 1) > 1: watched += f" (中断 {summary['segments'] - 1} 次)"
+        progress = "已看完 ✅" if summary.get("completed") else (f"{summary['progress']}%" if summary.get("progress") is not None else "未知")
+        return f"⏱️ 观看：{watched}\n📊 进度：{progress}\n"
+
+    def push_new_media(self, item_id, fallback_item=None, delay=10):
+        """
+        入库后 Emby 需要一段时间生成封面：登记延迟任务 (10s 后首检，之后 25s/40s 重试)，
+        等待期间不占用任何线程
+        """
         if not cfg.get("enable_library_notify") or not cfg.get("tg_chat_id"): return
-        cid = str(cfg.get("tg_chat_id")); host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
-        item = None
-        for i in range(3):
-            time.sleep(10 + i*15)
-            try:
-                res = requests.get(f"{host}/emby/Items/{item_id}?api_key={key}", timeout=10)
-                if res.status_code == 200:
-                    item = res.json()
-                    if item.get("ImageTags", {}).get("Primary"): break
-            except: pass
-        final = item if item else fallback_item
+        delayed_jobs.schedule("new_media", {"item_id": item_id, "fallback": fallback_item}, delay=delay, key=f"new_media:{item_id}")
+
+    def _new_media_job(self, payload, attempts):
+        item_id = payload["item_id"]
+        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        item = payload.get("item")
+        try:
+            res = requests.get(f"{host}/emby/Items/{item_id}?api_key={key}", timeout=10)
+            if res.status_code == 200: item = res.json()
+        except: pass
+        # 封面未就绪且还有重试次数：稍后再查 (沿用原 10s/25s/40s 节奏)
+        if not (item and item.get("ImageTags", {}).get("Primary")) and attempts < 2:
+            raise Retry(25 + attempts * 15, payload={**payload, "item": item})
+        self._send_new_media(item_id, item if item else payload.get("fallback"))
+
+    def _send_new_media(self, item_id, final):
+        if not cfg.get("enable_library_notify") or not cfg.get("tg_chat_id"): return
+        cid = str(cfg.get("tg_chat_id"))
         if not final: return
         try:
             name = final.get("Name", "未知"); type_raw = final.get("Type", "Movie")
@@ -180,11 +293,90 @@ class TelegramBot:
             caption = (f"📺 <b>新入库 {type_cn}</b>\n{display_title} ({year})\n\n⭐ 评分：{rating}/10\n🕒 时间：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n📝 剧情：{overview}")
             target_id = item_id; use_tag = final.get("ImageTags", {}).get("Primary")
             if type_raw == "Episode" and final.get("SeriesId"): target_id = final.get("SeriesId"); use_tag = None 
-            img_io = self._download_emby_image(target_id, 'Primary', image_tag=use_tag)
-            if img_io: self.send_photo(cid, img_io, caption)
+            photo, file_key, src = self._emby_photo(target_id, 'Primary', image_tag=use_tag)
+            if photo: self.send_photo(cid, photo, caption, file_key=file_key, reupload=src)
             else: self.send_photo(cid, REPORT_COVER_URL, caption)
         except: pass
 
+    @staticmethod
+    def _format_episode_ranges(items):
+        """[S02E01..S02E20, S02E22] -> "S02E01–E20, E22"，多季用分号分隔"""
+        seasons = {}
+        for it in items:
+            seasons.setdefault(it.get("ParentIndexNumber") or 1, set()).add(it.get("IndexNumber") or 0)
+        parts = []
+        for season in sorted(seasons):
+            eps = sorted(seasons[season]); runs = []
+            start = prev = eps[0]
+            for e in eps[1:]:
+                if e == prev + 1: prev = e; continue
+                runs.append((start, prev)); start = prev = e
+            runs.append((start, prev))
+            segs = [f"E{str(a).zfill(2)}" if a == b else f"E{str(a).zfill(2)}–E{str(b).zfill(2)}" for a, b in runs]
+            parts.append(f"S{str(season).zfill(2)}" + ", ".join(segs))
+        return "; ".join(parts)
+
+    def push_new_episodes(self, series_id, items):
+        """同一剧集批量入库：合并为一条海报通知"""
+        if not cfg.get("enable_library_notify") or not cfg.get("tg_chat_id"): return
+        cid = str(cfg.get("tg_chat_id")); host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        series = {}
+        try:
+            res = requests.get(f"{host}/emby/Items/{series_id}?api_key={key}", timeout=10)
+            if res.status_code == 200: series = res.json()
+        except: pass
+        try:
+            episodes = [i for i in items if i.get("Type") == "Episode"]
+            name = series.get("Name") or next((i.get("SeriesName") for i in items if i.get("SeriesName")), "未知剧集")
+            year = series.get("ProductionYear", ""); rating = series.get("CommunityRating", "N/A")
+            overview = series.get("Overview", "暂无简介...")
+            if len(overview) > 150: overview = overview[:140] + "..."
+            new_line = f"🆕 {self._format_episode_ranges(episodes)} 共 {len(episodes)} 集" if episodes else "🆕 新剧集入库"
+            caption = (f"📺 <b>新入库 剧集</b>\n{name} ({year})\n{new_line}\n\n⭐ 评分：{rating}/10\n🕒 时间：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n📝 剧情：{overview}")
+            photo, file_key, src = self._emby_photo(series_id, 'Primary', image_tag=series.get("ImageTags", {}).get("Primary"))
+            if photo: self.send_photo(cid, photo, caption, file_key=file_key, reupload=src)
+            else: self.send_photo(cid, REPORT_COVER_URL, caption)
+        except Exception as e:
+            logger.error(f"Episodes Push Error: {e}")
+
+    def push_new_movies(self, items):
+        """批量入库电影：每 10 部合并为一组相册 (sendMediaGroup)"""
+        if not cfg.get("enable_library_notify") or not cfg.get("tg_chat_id"): return
+        cid = str(cfg.get("tg_chat_id"))
+        for chunk_start in range(0, len(items), 10):
+            chunk = items[chunk_start:chunk_start + 10]
+            try:
+                lines = [f"{i + 1}. {m.get('Name', '未知')} ({m.get('ProductionYear', '')})" for i, m in enumerate(chunk)]
+                caption = f"🎬 <b>新入库 电影 ×{len(chunk)}</b>\n" + "\n".join(lines)
+                caption += f"\n\n🕒 时间：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
+                if len(caption) > 1000: caption = caption[:990] + "..."
+                photos = []
+                for m in chunk:
+                    photo, file_key, src = self._emby_photo(m.get("Id"), 'Primary', image_tag=m.get("ImageTags", {}).get("Primary"))
+                    if photo: photos.append((photo, file_key, src))
+                if len(photos) < 2:
+                    # 相册至少两张图，不足时退化为单图消息
+                    if photos: self.send_photo(cid, photos[0][0], caption, file_key=photos[0][1], reupload=photos[0][2])
+                    else: self.send_message(cid, caption)
+                    continue
+                media = []; files = {}; file_keys = []; reused = False
+                for photo, file_key, _ in photos:
+                    if isinstance(photo, str):
+                        # 已上传过的海报直接引用 file_id
+                        media.append({"type": "photo", "media": photo}); file_keys.append(None); reused = True
+                        continue
+                    field = f"p{len(media)}"
+                    files[field] = (f"{field}.jpg", photo.getvalue(), "image/jpeg")
+                    media.append({"type": "photo", "media": f"attach://{field}"}); file_keys.append(file_key)
+                media[0]["caption"] = caption; media[0]["parse_mode"] = "HTML"
+                fallback = {"method": "sendMessage", "params": {"chat_id": cid, "text": caption, "parse_mode": "HTML"}}
+                meta = {"upload": bool(files), "file_keys": file_keys,
+                        "reupload": {"movies": chunk} if reused else None,
+                        "reused_keys": [p[1] for p in photos if isinstance(p[0], str)]}
+                delivery.enqueue("sendMediaGroup", cid, {"chat_id": cid, "media": media}, files=files or None, fallback=fallback, meta=meta)
+            except Exception as e:
+                logger.error(f"Movies Push Error: {e}")
+
     # ================= 指令系统 =================
 
     def _set_commands(self):
@@ -199,36 +391,75 @@ class TelegramBot:
                 {"command": "recent", "description": "📜 播放历史"},
                 {"command": "check", "description": "📡 系统检查"},
                 {"command": "help", "description": "🤖 帮助菜单"}]
-        try: requests.post(f"https://api.telegram.org/bot{token}/setMyCommands", json={"commands": cmds}, proxies=self._get_proxies(), timeout=10)
+        try: requests.post(api_url("setMyCommands", token), json={"commands": cmds}, proxies=self._get_proxies(), timeout=10)
         except: pass
 
-    def _polling_loop(self):
-        token = cfg.get("tg_bot_token"); admin_id = str(cfg.get("tg_chat_id"))
-        while self.running:
+    # ================= 接收更新 (轮询 / webhook) =================
+    def webhook_secret(self):
+        secret = cfg.get("tg_webhook_secret")
+        if not secret:
+            secret = secrets.token_urlsafe(32)
+            cfg.set("tg_webhook_secret", secret)
+        return secret
+
+    def webhook_endpoint(self):
+        return cfg.get("tg_webhook_url").rstrip("/") + "/api/bot/webhook"
+
+    def _register_webhook(self, generation):
+        params = {"url": self.webhook_endpoint(), "secret_token": self.webhook_secret(), "allowed_updates": ["message"], "max_connections": 10}
+        for attempt in range(5):
+            # 重试期间机器人已停止 / 重启时放弃，避免把注销掉的 webhook 又注册回去
+            if not self.running or generation != self._generation: return
+            try:
+                res = requests.post(api_url("setWebhook", self._token), json=params, proxies=self._get_proxies(), timeout=10)
+                if res.status_code == 200 and res.json().get("ok"):
+                    return logger.info(f"🤖 Telegram webhook registered: {params['url']}")
+                logger.error(f"setWebhook Failed: {res.text}")
+            except Exception as e:
+                logger.error(f"setWebhook Error: {e}")
+            time.sleep(min(60, 5 * 2 ** attempt))
+
+    def webhook_info(self):
+        res = requests.get(api_url("getWebhookInfo"), proxies=self._get_proxies(), timeout=10)
+        return res.json().get("result", {})
+
+    def process_update(self, u):
+        """轮询与 webhook 共用：过滤非管理员聊天后交给指令分发器"""
+        if not self.running: return False
+        update_id = u.get("update_id")
+        if update_id is not None:
+            if update_id in self._recent_updates: return False
+            self._recent_updates.append(update_id)
+        msg = u.get("message")
+        if not msg: return False
+        cid = str(msg["chat"]["id"]); admin_id = str(cfg.get("tg_chat_id") or "")
+        if admin_id and cid != admin_id: return False
+        self._handle_message(msg, cid)
+        return True
+
+    def _polling_loop(self, generation):
+        token = cfg.get("tg_bot_token"); backoff = 1
+        # 之前若注册过 webhook，getUpdates 会返回 409，先注销
+        try: requests.post(api_url("deleteWebhook", token), json={"drop_pending_updates": False}, proxies=self._get_proxies(), timeout=10)
+        except: pass
+        while self.running and generation == self._generation:
             try:
-                res = requests.get(f"https://api.telegram.org/bot{token}/getUpdates", params={"offset": self.offset, "timeout": 30}, proxies=self._get_proxies(), timeout=35)
+                res = requests.get(api_url("getUpdates", token), params={"offset": self.offset, "timeout": 30, "allowed_updates": json.dumps(["message"])}, proxies=self._get_proxies(), timeout=35)
                 if res.status_code == 200:
+                    backoff = 1
                     for u in res.json().get("result", []):
                         self.offset = u["update_id"] + 1
-                        if "message" in u:
-                            cid = str(u["message"]["chat"]["id"]); 
-                            if admin_id and cid != admin_id: continue
-                            self._handle_message(u["message"], cid)
-                else: time.sleep(5)
-            except: time.sleep(5)
+                        self.process_update(u)
+                    continue
+                if res.status_code == 409:
+                    requests.post(api_url("deleteWebhook", token), proxies=self._get_proxies(), timeout=10)
+            except Exception: pass
+            # 出错时指数退避，最长 30 秒
+            time.sleep(backoff); backoff = min(30, backoff * 2)
 
     def _handle_message(self, msg, cid):
-        text = msg.get("text", "").strip()
-        if text.startswith("/search"): self._cmd_search(cid, text)
-        elif text.startswith("/stats"): self._cmd_stats(cid, 'day')
-        elif text.startswith("/weekly"): self._cmd_stats(cid, 'week')
-        elif text.startswith("/monthly"): self._cmd_stats(cid, 'month')
-        elif text.startswith("/yearly"): self._cmd_stats(cid, 'year')
-        elif text.startswith("/now"): self._cmd_now(cid)
-        elif text.startswith("/latest"): self._cmd_latest(cid)
-        elif text.startswith("/recent"): self._cmd_recent(cid)
-        elif text.startswith("/check"): self._cmd_check(cid)
-        elif text.startswith("/help"): self._cmd_help(cid)
+        # 指令交给分发器在线程池中执行，轮询线程立即继续拉取下一批消息
+        self.dispatcher.submit(cid, msg.get("text", ""))
 
     def _cmd_latest(self, cid):
         key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
@@ -263,44 +494,15 @@ class TelegramBot:
 
     # 🔥 核心增强：解析详细技术信息（分辨率/HDR/码率）
     def _extract_tech_info(self, item):
-        sources = item.get("MediaSources", [])
-        if not sources: return "📼 未知信息"
-        
-        info_parts = []
-        # 1. 视频流信息
-        video = next((s for s in sources[0].get("MediaStreams", []) if s.get("Type") == "Video"), None)
-        if video:
-            w = video.get("Width", 0)
-            # 分辨率判断
-            if w >= 3800: res = "4K"
-            elif w >= 1900: res = "1080P"
-            elif w >= 1200: res = "720P"
-            else: res = "SD"
-            
-            # 特效判断 (HDR/DoVi)
-            extra = []
-            v_range = video.get("VideoRange", "")
-            title = video.get("DisplayTitle", "").upper()
-            if "HDR" in v_range or "HDR" in title: extra.append("HDR")
-            if "DOVI" in title or "DOLBY VISION" in title: extra.append("DoVi")
-            
-            res_str = f"{res}"
-            if extra: res_str += f" {' '.join(extra)}"
-            info_parts.append(res_str)
-            
-            # 码率判断
-            bitrate = sources[0].get("Bitrate", 0)
-            if bitrate > 0:
-                mbps = round(bitrate / 1000000, 1)
-                info_parts.append(f"{mbps}Mbps")
-                
-        return " | ".join(info_parts) if info_parts else "📼 未知信息"
+        return extract_tech_info(item)
 
     # 🔥 核心修复：搜索功能 (两步走策略)
     def _cmd_search(self, chat_id, text):
         parts = text.split(' ', 1)
         if len(parts) < 2: return self.send_message(chat_id, "🔍 <b>搜索格式错误</b>\n请使用: <code>/search 关键词</code>")
         keyword = parts[1].strip()
+        # 本地索引已建立时直接查索引，只有海报需要访问 Emby
+        if search_index.count() > 0: return self._search_local(chat_id, keyword)
         key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
         
         try:
@@ -361,46 +563,63 @@ class TelegramBot:
                 tech_info_str = "暂无技术信息"
 
             # 3️⃣ 组装消息
-            name = details.get("Name", top.get("Name"))
-            year = details.get("ProductionYear", top.get("ProductionYear"))
-            year_str = f"({year})" if year else ""
-            rating = details.get("CommunityRating", "N/A")
-            genres = " / ".join(details.get("Genres", [])[:3]) or "未分类"
-            overview = details.get("Overview", "暂无简介")
-            if len(overview) > 120: overview = overview[:120] + "..."
-            
-            type_icon = "🎬" if type_raw == "Movie" else "📺"
             info_line = tech_info_str
             if type_raw == "Series": info_line = f"{ep_count_str} | {tech_info_str}"
+            self._send_search_result(chat_id, {**top, **details}, info_line, items[1:])
             
-            caption = (f"{type_icon} <b>{name}</b> {year_str}\n"
-                       f"⭐️ {rating}  |  🎭 {genres}\n"
-                       f"{info_line}\n"
-                       f"───────────────\n"
-                       f"📝 <b>简介</b>: {overview}\n")
-            
-            # 其他结果列表
-            if len(items) > 1:
-                caption += "\n🔎 <b>其他结果:</b>\n"
-                for i, sub in enumerate(items[1:]):
-                    sub_year = f"({sub.get('ProductionYear')})" if sub.get('ProductionYear') else ""
-                    sub_type = "📺" if sub.get("Type") == "Series" else "🎬"
-                    caption += f"{sub_type} {sub.get('Name')} {sub_year}\n"
-            
-            base_url = cfg.get("emby_public_host") or host
-            if base_url.endswith('/'): base_url = base_url[:-1]
-            play_url = f"{base_url}/web/index.html#!/item?id={top.get('Id')}&serverId={top.get('ServerId')}"
-            keyboard = {"inline_keyboard": [[{"text": "▶️ 立即播放", "url": play_url}]]}
-            
-            img_io = self._download_emby_image(top.get("Id"), 'Primary')
-            if img_io: self.send_photo(chat_id, img_io, caption, reply_markup=keyboard)
-            else: self.send_photo(chat_id, REPORT_COVER_URL, caption, reply_markup=keyboard)
-            
         except Exception as e:
             logger.error(f"Search Error: {e}")
             self.send_message(chat_id, "❌ 搜索时发生错误")
 
-    def _cmd_stats(self, chat_id, period='day'):
+    def _search_local(self, chat_id, keyword):
+        try:
+            rows, took = search_index.search(keyword, limit=5)
+            if not rows: return self.send_message(chat_id, f"📭 未找到与 <b>{keyword}</b> 相关的资源")
+            items = [{"Id": r["item_id"], "ServerId": r["server_id"], "Type": r["type"], "Name": r["name"], "ProductionYear": r["year"],
+                      "CommunityRating": r["rating"], "Genres": r["genres"], "Overview": r["overview"], "ImageTag": r["image_tag"]} for r in rows]
+            top = rows[0]
+            tech = top["tech"] or "暂无技术信息"
+            info_line = f"📊 共 {top['episode_count'] or 0} 集 | {tech}" if top["type"] == "Series" else tech
+            logger.info(f"🔎 Search '{keyword}': {len(rows)} hits in {took}ms (local index)")
+            self._send_search_result(chat_id, items[0], info_line, items[1:])
+        except Exception as e:
+            logger.error(f"Search Error: {e}")
+            self.send_message(chat_id, "❌ 搜索时发生错误")
+
+    def _send_search_result(self, chat_id, top, info_line, others):
+        name = top.get("Name")
+        year = top.get("ProductionYear")
+        year_str = f"({year})" if year else ""
+        rating = top.get("CommunityRating") or "N/A"
+        genres = " / ".join((top.get("Genres") or [])[:3]) or "未分类"
+        overview = top.get("Overview") or "暂无简介"
+        if len(overview) > 120: overview = overview[:120] + "..."
+        
+        type_icon = "🎬" if top.get("Type") == "Movie" else "📺"
+        caption = (f"{type_icon} <b>{name}</b> {year_str}\n"
+                   f"⭐️ {rating}  |  🎭 {genres}\n"
+                   f"{info_line}\n"
+                   f"───────────────\n"
+                   f"📝 <b>简介</b>: {overview}\n")
+        
+        # 其他结果列表
+        if others:
+            caption += "\n🔎 <b>其他结果:</b>\n"
+            for sub in others:
+                sub_year = f"({sub.get('ProductionYear')})" if sub.get('ProductionYear') else ""
+                sub_type = "📺" if sub.get("Type") == "Series" else "🎬"
+                caption += f"{sub_type} {sub.get('Name')} {sub_year}\n"
+        
+        base_url = cfg.get("emby_public_host") or cfg.get("emby_host")
+        if base_url.endswith('/'): base_url = base_url[:-1]
+        play_url = f"{base_url}/web/index.html#!/item?id={top.get('Id')}&serverId={top.get('ServerId')}"
+        keyboard = {"inline_keyboard": [[{"text": "▶️ 立即播放", "url": play_url}]]}
+        
+        photo, file_key, src = self._emby_photo(top.get("Id"), 'Primary', image_tag=top.get("ImageTag"))
+        if photo: self.send_photo(chat_id, photo, caption, reply_markup=keyboard, file_key=file_key, reupload=src)
+        else: self.send_photo(chat_id, REPORT_COVER_URL, caption, reply_markup=keyboard)
+
+    def _cmd_stats(self, chat_id, period='day', theme='black_gold'):
         where, params = get_base_filter('all') 
         titles = {'day': '今日日报', 'yesterday': '昨日日报', 'week': '本周周报', 'month': '本月月报', 'year': '年度报告'}
         title_cn = titles.get(period, '数据报表')
@@ -439,9 +658,15 @@ class TelegramBot:
             title_display = f"{title_cn} ({yesterday_date})" if period == 'yesterday' else title_cn
             caption = (f"📊 <b>EmbyPulse {title_display}</b>\n───────────────\n📈 <b>数据大盘</b>\n▶️ 总播放量: {plays} 次\n⏱️ 活跃时长: {hours} 小时\n👥 活跃人数: {users} 人\n───────────────\n🏆 <b>活跃用户 Top 5</b>\n{user_str}───────────────\n🔥 <b>热门内容 Top 10</b>\n{top_content}")
             if HAS_PIL:
-                img = report_gen.generate_report('all', period)
-                if img: self.send_photo(chat_id, img, caption)
-                else: self.send_message(chat_id, caption)
+                # 同一数据版本的报表已上传过时直接引用 file_id，连渲染也省掉
+                file_key = file_ids.report_key(report_gen.cache_key('all', period, theme, preset='telegram'))
+                file_id = file_ids.get(file_key)
+                if file_id:
+                    self.send_photo(chat_id, file_id, caption, file_key=file_key, reupload={"report": ['all', period, theme, 'list', 'telegram']})
+                else:
+                    img = report_gen.generate_report('all', period, theme, preset='telegram')
+                    if img: self.send_photo(chat_id, img, caption, file_key=file_key)
+                    else: self.send_message(chat_id, caption)
             else: self.send_photo(chat_id, REPORT_COVER_URL, caption)
         except Exception as e:
             logger.error(f"Stats Error: {e}")
@@ -502,33 +727,9 @@ class TelegramBot:
     def _cmd_help(self, cid):
         self.send_message(cid, "🤖 /search, /stats, /weekly, /monthly, /now, /latest, /recent, /check")
 
-    def _scheduler_loop(self):
-        while self.running:
-            try:
-                now = datetime.datetime.now()
-                if now.minute != self.last_check_min:
-                    self.last_check_min = now.minute
-                    if now.hour == 9 and now.minute == 0:
-                        self._check_user_expiration()
-                        if cfg.get("tg_chat_id"): self._daily_report_task()
-                time.sleep(5)
-            except: time.sleep(60)
-
-    def _check_user_expiration(self):
-        try:
-            users = query_db("SELECT user_id, expire_date FROM users_meta WHERE expire_date IS NOT NULL AND expire_date != ''")
-            if not users: return
-            today = datetime.datetime.now().strftime("%Y-%m-%d")
-            key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-            for u in users:
-                if u['expire_date'] < today:
-                    try: requests.post(f"{host}/emby/Users/{u['user_id']}/Policy?api_key={key}", json={"IsDisabled": True})
-                    except: pass
-        except: pass
-    
     def push_now(self, user_id, period, theme):
         if not cfg.get("tg_chat_id"): return False
-        self._cmd_stats(str(cfg.get("tg_chat_id")), period)
+        self._cmd_stats(str(cfg.get("tg_chat_id")), period, theme)
         return True
 
 bot = TelegramBot()
\ No newline at end of file
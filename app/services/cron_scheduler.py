@@ -0,0 +1,247 @@
+"""
+Cron 计划任务
+任务定义保存在配置 scheduled_tasks 中 (内置任务可改时间/停用，不能删除)
+每个任务在延迟任务堆里只有一个条目 (键 cron:{id})，执行时间即下一次触发时间：
+- 调度线程睡到最早的触发时间，不再每 5 秒轮询
+- 条目持久化，停机期间错过的触发在启动后补跑一次 (catch_up=False 的任务直接跳到下一次)
+"""
+import time
+import datetime
+import threading
+import logging
+from app.core.config import cfg
+from app.core.database import local_connect
+from app.services.delayed_jobs import delayed_jobs
+from app.services.bot_service import bot
+from app.services.report_service import report_gen, HAS_PIL
+from app.services.batch_report_service import batch_reports
+from app.services.search_index import search_index
+from app.services.expiration_service import expiration
+
+logger = logging.getLogger("uvicorn")
+
+ALIASES = {"@hourly": "0 * * * *", "@daily": "0 0 * * *", "@weekly": "0 0 * * 0", "@monthly": "0 0 1 * *", "@yearly": "0 0 1 1 *"}
+TASK_TYPES = {
+    "report_push": "推送报表",
+    "daily_report": "昨日日报",
+    "expiration_check": "到期用户检查",
+    "cache_warmup": "报表缓存预热",
+    "search_sync": "搜索索引同步"
+}
+# 内置任务：沿用原来每天 09:00 的日报与到期检查
+BUILTIN_TASKS = [
+    {"id": "expiration_check", "type": "expiration_check", "cron": "0 9 * * *", "enabled": True, "catch_up": True, "params": {}},
+    {"id": "daily_report", "type": "daily_report", "cron": "0 9 * * *", "enabled": True, "catch_up": True, "params": {}},
+    {"id": "search_sync", "type": "search_sync", "cron": "*/30 * * * *", "enabled": True, "catch_up": True, "params": {}}
+]
+MISSED_GRACE = 300   # 晚于计划时间超过此秒数视为 "错过"
+
+class CronExpr:
+    """标准 5 段 cron：分 时 日 月 周，支持 * , - / 以及 @daily 等别名；周日可写 0 或 7"""
+    BOUNDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr):
+        self.expr = expr.strip()
+        parts = ALIASES.get(self.expr, self.expr).split()
+        if len(parts) != 5: raise ValueError(f"cron 表达式需要 5 段: {expr}")
+        self.minutes, self.hours, self.days, self.months, dows = [self._field(p, lo, hi) for p, (lo, hi) in zip(parts, self.BOUNDS)]
+        self.dows = {d % 7 for d in dows}
+        self.any_day = parts[2] == "*"; self.any_dow = parts[4] == "*"
+
+    @staticmethod
+    def _field(text, lo, hi):
+        values = set()
+        for part in text.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1); step = int(step)
+                if step < 1: raise ValueError(f"步长无效: {text}")
+            if part == "*": a, b = lo, hi
+            elif "-" in part: a, b = (int(x) for x in part.split("-", 1))
+            else: a = int(part); b = hi if step > 1 else a
+            if a < lo or b > hi or a > b: raise ValueError(f"取值超出范围 {lo}-{hi}: {text}")
+            values.update(range(a, b + 1, step))
+        return values
+
+    def _day_ok(self, t):
+        dom = t.day in self.days; dow = (t.weekday() + 1) % 7 in self.dows
+        # 与 cron 一致：日、周都有限定时满足其一即可
+        if not self.any_day and not self.any_dow: return dom or dow
+        return dom and dow
+
+    def next_after(self, dt):
+        t = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t.year + 5
+        while t.year <= limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1); continue
+            if not self._day_ok(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1); continue
+            if t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1); continue
+            if t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1); continue
+            return t
+        raise ValueError(f"cron 表达式永远不会触发: {self.expr}")
+
+class CronScheduler:
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+        delayed_jobs.register("cron", self._fire)
+
+    # ---------------- 运行记录 ----------------
+    def _db(self):
+        if not self._conn:
+            self._conn = local_connect()
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS cron_runs (
+                                    task_id TEXT PRIMARY KEY,
+                                    last_run REAL,
+                                    last_status TEXT,
+                                    last_error TEXT,
+                                    duration_ms REAL,
+                                    run_count INTEGER NOT NULL DEFAULT 0
+                                )''')
+            self._conn.commit()
+        return self._conn
+
+    def _record(self, task_id, started, status, error=None):
+        with self._lock:
+            self._db().execute('''INSERT INTO cron_runs (task_id, last_run, last_status, last_error, duration_ms, run_count) VALUES (?, ?, ?, ?, ?, 1)
+                                  ON CONFLICT(task_id) DO UPDATE SET last_run = excluded.last_run, last_status = excluded.last_status,
+                                  last_error = excluded.last_error, duration_ms = excluded.duration_ms, run_count = run_count + 1''',
+                               (task_id, started, status, error, round((time.time() - started) * 1000, 1)))
+            self._db().commit()
+
+    # ---------------- 任务定义 ----------------
+    @staticmethod
+    def normalize(task):
+        task = {"enabled": True, "catch_up": True, "params": {}, **task}
+        if task.get("type") not in TASK_TYPES: raise ValueError(f"未知任务类型: {task.get('type')}")
+        CronExpr(task.get("cron") or "").next_after(datetime.datetime.now())   # 校验能否触发
+        task["id"] = str(task.get("id") or f"{task['type']}_{int(time.time())}")
+        return task
+
+    def tasks(self):
+        custom = {t.get("id"): t for t in (cfg.get("scheduled_tasks") or []) if t.get("id")}
+        merged = []
+        for t in BUILTIN_TASKS:
+            merged.append({**t, **custom.pop(t["id"], {}), "builtin": True})
+        merged.extend({**t, "builtin": False} for t in custom.values())
+        return merged
+
+    def get(self, task_id):
+        return next((t for t in self.tasks() if t["id"] == task_id), None)
+
+    def save(self, task):
+        task = self.normalize(task)
+        task.pop("builtin", None)
+        saved = [t for t in (cfg.get("scheduled_tasks") or []) if t.get("id") != task["id"]]
+        cfg.set("scheduled_tasks", saved + [task])
+        self.sync()
+        return task
+
+    def delete(self, task_id):
+        if any(t["id"] == task_id for t in BUILTIN_TASKS): raise ValueError("内置任务不能删除，可以停用")
+        saved = cfg.get("scheduled_tasks") or []
+        if not any(t.get("id") == task_id for t in saved): return False
+        cfg.set("scheduled_tasks", [t for t in saved if t.get("id") != task_id])
+        self.sync()
+        return True
+
+    # ---------------- 调度 ----------------
+    def start(self):
+        self.sync()
+        logger.info(f"⏰ Cron scheduler: {sum(1 for t in self.tasks() if t.get('enabled'))} active tasks")
+
+    def sync(self):
+        """让延迟任务堆与任务定义一致：新增/改期/移除；表达式未变的保留原触发时间 (以便补跑)"""
+        active = set()
+        for task in self.tasks():
+            key = f"cron:{task['id']}"
+            try: expr = CronExpr(task.get("cron") or "")
+            except ValueError as e:
+                logger.error(f"Cron Task {task['id']}: {e}"); continue
+            if not task.get("enabled"): continue
+            active.add(key)
+
+            def merge(old, task=task, expr=expr):
+                if old and old.get("cron") == expr.expr: return old, old["run_at"]
+                run_at = expr.next_after(datetime.datetime.now()).timestamp()
+                return {"id": task["id"], "cron": expr.expr, "run_at": run_at}, run_at
+
+            delayed_jobs.upsert("cron", key, merge)
+        for job in delayed_jobs.pending():
+            if job["kind"] == "cron" and job["key"] not in active: delayed_jobs.cancel(job["key"])
+
+    def _schedule_next(self, task):
+        expr = CronExpr(task["cron"])
+        run_at = expr.next_after(datetime.datetime.now()).timestamp()
+        delayed_jobs.schedule("cron", {"id": task["id"], "cron": expr.expr, "run_at": run_at}, delay=run_at - time.time(), key=f"cron:{task['id']}")
+
+    def _fire(self, payload, attempts):
+        task = self.get(payload["id"])
+        if not task or not task.get("enabled"): return
+        try:
+            late = time.time() - payload["run_at"]
+            if late > MISSED_GRACE and not task.get("catch_up", True):
+                logger.info(f"⏰ Cron {task['id']}: missed run skipped ({int(late)}s late)")
+                self._record(task["id"], time.time(), "skipped")
+            else:
+                self.run(task)
+        finally:
+            self._schedule_next(task)
+
+    def run(self, task):
+        started = time.time()
+        try:
+            self._execute(task)
+            self._record(task["id"], started, "ok")
+        except Exception as e:
+            logger.error(f"Cron Task Error ({task['id']}): {e}")
+            self._record(task["id"], started, "error", str(e))
+
+    def run_now(self, task_id):
+        task = self.get(task_id)
+        if not task: return False
+        threading.Thread(target=self.run, args=(task,), daemon=True).start()
+        return True
+
+    def _execute(self, task):
+        kind = task["type"]; p = task.get("params") or {}
+        if kind == "expiration_check":
+            expiration.run(notify=p.get("notify", True))
+        elif kind == "daily_report":
+            if cfg.get("tg_chat_id"): bot._daily_report_task()
+        elif kind == "report_push":
+            user_id = p.get("user_id") or "all"; period = p.get("period") or "day"; theme = p.get("theme") or "black_gold"
+            if user_id == "all":
+                if not bot.push_now(user_id, period, theme): raise Exception("Bot not configured")
+            else:
+                # 个人报表 ("*" 为全部活跃用户) 走批量生成管线
+                batch_reports.start(period, theme, target="bot", user_ids=None if user_id == "*" else [user_id])
+        elif kind == "search_sync":
+            # 增量同步，距上次全量超过一天时自动全量对账
+            search_index.sync(full=p.get("full"))
+        elif kind == "cache_warmup":
+            if not HAS_PIL: return
+            theme = p.get("theme") or "black_gold"
+            for period in p.get("periods") or ["day", "week", "month"]:
+                report_gen.render_report(p.get("user_id") or "all", period, theme, preset=p.get("preset") or "telegram")
+
+    def listing(self):
+        pending = {j["key"]: j for j in delayed_jobs.pending() if j["kind"] == "cron"}
+        with self._lock:
+            runs = {r["task_id"]: dict(r) for r in self._db().execute("SELECT * FROM cron_runs")}
+        result = []
+        for t in self.tasks():
+            job = pending.get(f"cron:{t['id']}")
+            run = runs.get(t["id"], {})
+            result.append({**t, "name": TASK_TYPES.get(t["type"], t["type"]),
+                           "next_run": datetime.datetime.fromtimestamp(job["run_at"]).strftime("%Y-%m-%d %H:%M") if job else None,
+                           "last_run": datetime.datetime.fromtimestamp(run["last_run"]).strftime("%Y-%m-%d %H:%M:%S") if run.get("last_run") else None,
+                           "last_status": run.get("last_status"), "last_error": run.get("last_error"),
+                           "duration_ms": run.get("duration_ms"), "run_count": run.get("run_count", 0)})
+        return result
+
+cron_scheduler = CronScheduler()
@@ -0,0 +1,185 @@
+"""
+延迟任务调度器
+替代 "开线程 + time.sleep" 的等待方式：待执行任务只是堆里的一个 (时间, 序号) 条目，
+单个定时线程睡到最早的到期时间，到期后交给小线程池执行，任务本身不占用线程
+任务持久化在本地库，重启后继续按原定时间执行 (已过期的立即补跑)
+"""
+import json
+import time
+import heapq
+import itertools
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app.core.database import local_connect
+
+logger = logging.getLogger("uvicorn")
+
+class Retry(Exception):
+    """处理函数抛出/返回此对象表示稍后重试：Retry(秒数, 可选的新 payload)"""
+    def __init__(self, delay, payload=None):
+        super().__init__(f"retry in {delay}s")
+        self.delay = delay
+        self.payload = payload
+
+class DelayedJobScheduler:
+    def __init__(self, workers=4):
+        self._handlers = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._conn = None
+        self._jobs = {}            # id -> {"kind", "key", "payload", "run_at", "attempts"}
+        self._keys = {}            # key -> id
+        self._workers = workers
+        self._executor = None
+        self._thread = None
+        self.running = False
+
+    # ---------------- 存储 ----------------
+    def _db(self):
+        if not self._conn:
+            self._conn = local_connect()
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS delayed_jobs (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    job_key TEXT,
+                                    kind TEXT NOT NULL,
+                                    payload TEXT,
+                                    run_at REAL NOT NULL,
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    created_at REAL NOT NULL
+                                )''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_delayed_jobs_key ON delayed_jobs(job_key)")
+            self._conn.commit()
+            self._load()
+        return self._conn
+
+    def _load(self):
+        rows = self._db().execute("SELECT * FROM delayed_jobs").fetchall()
+        for r in rows:
+            job = {"kind": r['kind'], "key": r['job_key'], "payload": json.loads(r['payload']) if r['payload'] else None,
+                   "run_at": r['run_at'], "attempts": r['attempts']}
+            self._jobs[r['id']] = job
+            if job["key"]: self._keys[job["key"]] = r['id']
+            heapq.heappush(self._heap, (job["run_at"], next(self._seq), r['id']))
+        if rows: logger.info(f"⏰ Restored {len(rows)} delayed jobs")
+
+    # ---------------- 对外接口 ----------------
+    def register(self, kind, func):
+        """func(payload, attempts) -> None 完成 / Retry(...) 重试"""
+        self._handlers[kind] = func
+
+    def schedule(self, kind, payload=None, delay=0, key=None):
+        """新建任务；key 已存在时替换其 payload 与执行时间"""
+        return self.upsert(kind, key, lambda old: (payload, time.time() + delay))
+
+    def upsert(self, kind, key, func):
+        """
+        原子地读改写同 key 的待执行任务：func(旧 payload 或 None) -> (新 payload, 执行时间戳)
+        与到期出队在同一把锁内，不会出现 "刚读到旧数据，任务就已执行" 的重复
+        """
+        with self._cond:
+            job_id = self._keys.get(key) if key else None
+            old = self._jobs.get(job_id) if job_id else None
+            payload, run_at = func(old["payload"] if old else None)
+            data = json.dumps(payload, ensure_ascii=False) if payload is not None else None
+            conn = self._db()
+            prev_run_at = old["run_at"] if old else None
+            if old:
+                conn.execute("UPDATE delayed_jobs SET payload = ?, run_at = ? WHERE id = ?", (data, run_at, job_id))
+                old["payload"] = payload; old["run_at"] = run_at
+            else:
+                cur = conn.execute("INSERT INTO delayed_jobs (job_key, kind, payload, run_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                                   (key, kind, data, run_at, time.time()))
+                job_id = cur.lastrowid
+                self._jobs[job_id] = {"kind": kind, "key": key, "payload": payload, "run_at": run_at, "attempts": 0}
+                if key: self._keys[key] = job_id
+            conn.commit()
+            # 旧的堆条目不删除，出队时比对 run_at 作废 (惰性删除)；时间未变时不重复入堆
+            if prev_run_at != run_at:
+                heapq.heappush(self._heap, (run_at, next(self._seq), job_id))
+            self._cond.notify()
+            return job_id
+
+    def cancel(self, key):
+        with self._cond:
+            job_id = self._keys.pop(key, None)
+            if not job_id: return False
+            self._jobs.pop(job_id, None)
+            self._db().execute("DELETE FROM delayed_jobs WHERE id = ?", (job_id,))
+            self._db().commit()
+            return True
+
+    def pending(self):
+        with self._cond:
+            return [{"id": i, "kind": j["kind"], "key": j["key"], "run_at": j["run_at"], "attempts": j["attempts"]} for i, j in self._jobs.items()]
+
+    # ---------------- 调度循环 ----------------
+    def start(self):
+        if self.running: return
+        with self._cond:
+            self._db()   # 首次打开时恢复持久化的任务
+        self.running = True
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="delayed-job")
+        self._thread = threading.Thread(target=self._loop, name="delayed-jobs", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        with self._cond: self._cond.notify_all()
+        if self._executor: self._executor.shutdown(wait=False)
+
+    def _loop(self):
+        while self.running:
+            with self._cond:
+                due = None
+                while self._heap:
+                    run_at, _, job_id = self._heap[0]
+                    job = self._jobs.get(job_id)
+                    if not job or job["run_at"] != run_at or job.get("running"):
+                        heapq.heappop(self._heap); continue   # 已取消/已改期/正在执行的旧条目
+                    if run_at > time.time(): break
+                    heapq.heappop(self._heap)
+                    job["running"] = True
+                    due = (job_id, job)
+                    # 出队即从 key 索引移除：执行期间的 upsert 会创建新任务而不是修改正在执行的这个
+                    if job["key"] and self._keys.get(job["key"]) == job_id: del self._keys[job["key"]]
+                    break
+                if not due:
+                    timeout = (self._heap[0][0] - time.time()) if self._heap else None
+                    self._cond.wait(timeout=timeout)
+                    continue
+            self._executor.submit(self._run, *due)
+
+    def _run(self, job_id, job):
+        handler = self._handlers.get(job["kind"])
+        result = None
+        if not handler:
+            logger.warning(f"Delayed Job: no handler for {job['kind']}, retry in 60s")
+            result = Retry(60)
+        else:
+            try:
+                result = handler(job["payload"], job["attempts"])
+            except Retry as r:
+                result = r
+            except Exception as e:
+                logger.error(f"Delayed Job Error ({job['kind']}): {e}")
+
+        with self._cond:
+            if isinstance(result, Retry):
+                if result.payload is not None: job["payload"] = result.payload
+                job["attempts"] += 1
+                job["run_at"] = time.time() + result.delay
+                job["running"] = False
+                # 执行期间若有同 key 的新任务，则本任务不再重新登记 key
+                if job["key"] and job["key"] not in self._keys: self._keys[job["key"]] = job_id
+                self._db().execute("UPDATE delayed_jobs SET payload = ?, run_at = ?, attempts = ? WHERE id = ?",
+                                   (json.dumps(job["payload"], ensure_ascii=False) if job["payload"] is not None else None, job["run_at"], job["attempts"], job_id))
+                heapq.heappush(self._heap, (job["run_at"], next(self._seq), job_id))
+                self._cond.notify()
+            else:
+                self._jobs.pop(job_id, None)
+                self._db().execute("DELETE FROM delayed_jobs WHERE id = ?", (job_id,))
+            self._db().commit()
+
+delayed_jobs = DelayedJobScheduler()
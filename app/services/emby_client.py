@@ -0,0 +1,88 @@
+"""
+Emby API 客户端
+复用同一个 requests.Session (连接池 + keep-alive)，所有请求都带超时；
+批量操作通过 map_concurrent 限制并发，避免一次性打满 Emby
+"""
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import cfg
+
+logger = logging.getLogger("uvicorn")
+
+DEFAULT_TIMEOUT = (5, 15)   # (连接, 读取) 秒
+
+class EmbyError(Exception):
+    def __init__(self, status, message=""):
+        super().__init__(f"Emby HTTP {status}: {message}"[:300])
+        self.status = status
+
+class EmbyClient:
+    def __init__(self):
+        self._session = None
+        self._pool_size = 0
+        cfg.subscribe({"emby_host", "emby_api_key", "emby_concurrency"}, lambda keys: self.reset())
+
+    def concurrency(self):
+        try: return max(1, int(cfg.get("emby_concurrency") or 8))
+        except (TypeError, ValueError): return 8
+
+    def session(self):
+        size = self.concurrency()
+        if not self._session or self._pool_size != size:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            s.mount("http://", adapter); s.mount("https://", adapter)
+            self._session = s; self._pool_size = size
+        return self._session
+
+    def reset(self):
+        """地址 / 密钥变更后丢弃旧连接"""
+        s, self._session = self._session, None
+        if s:
+            try: s.close()
+            except Exception: pass
+
+    def request(self, method, path, params=None, json=None, timeout=DEFAULT_TIMEOUT):
+        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        if not host or not key: raise EmbyError(0, "Emby 未配置")
+        res = self.session().request(method, f"{host}/emby{path}", params={**(params or {}), "api_key": key}, json=json, timeout=timeout)
+        if res.status_code >= 400: raise EmbyError(res.status_code, res.text)
+        return res
+
+    def get(self, path, **params):
+        return self.request("GET", path, params=params).json()
+
+    def get_user(self, user_id):
+        return self.get(f"/Users/{user_id}")
+
+    def list_users(self):
+        return self.get("/Users")
+
+    def update_policy(self, user_id, changes, user=None):
+        """
+        修改用户策略：Emby 的 Policy 接口会整体覆盖，必须先取回完整策略再合并修改
+        user 为已取到的用户对象时可省一次请求；返回合并后的策略
+        """
+        policy = dict(((user or self.get_user(user_id)).get("Policy")) or {})
+        policy.update(changes)
+        self.request("POST", f"/Users/{user_id}/Policy", json=policy)
+        return policy
+
+    def delete_user(self, user_id):
+        self.request("DELETE", f"/Users/{user_id}")
+
+    def map_concurrent(self, func, items, workers=None):
+        """并发执行 func(item)，返回 [(item, result, error)]，顺序与输入一致"""
+        items = list(items)
+        if not items: return []
+
+        def call(item):
+            try: return item, func(item), None
+            except Exception as e: return item, None, e
+
+        with ThreadPoolExecutor(max_workers=min(workers or self.concurrency(), len(items)), thread_name_prefix="emby") as pool:
+            return list(pool.map(call, items))
+
+emby = EmbyClient()
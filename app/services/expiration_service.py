@@ -0,0 +1,175 @@
+"""
+账号到期处理
+- 只查询 "到期且尚未处理" 的用户 (expire_date 有索引)，处理后记下对应的到期日；续期修改到期日后自动重新生效
+- 用户列表一次取回 (含完整 Policy)，停用请求并发执行 (emby_concurrency)，只修改 IsDisabled，不覆盖其它策略
+- 已停用 / Emby 中已删除的用户不再发请求；失败的留待下次重试
+- 支持预演 (dry-run)、即将到期提醒、处理日志
+"""
+import time
+import sqlite3
+import datetime
+import threading
+import logging
+from app.core.config import cfg, DB_PATH
+from app.core.database import query_db, local_connect
+from app.services.emby_client import emby, EmbyError
+from app.services.bot_service import bot
+
+logger = logging.getLogger("uvicorn")
+
+LOG_KEEP_DAYS = 180
+
+class ExpirationEngine:
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self.last_run = None
+
+    # ---------------- 日志 ----------------
+    def _db(self):
+        if not self._conn:
+            self._conn = local_connect()
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS expiration_log (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    run_at REAL NOT NULL,
+                                    user_id TEXT NOT NULL,
+                                    user_name TEXT,
+                                    expire_date TEXT,
+                                    action TEXT NOT NULL,
+                                    error TEXT
+                                )''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_expiration_log_run ON expiration_log(run_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _write_log(self, run_at, entries):
+        if not entries: return
+        with self._lock:
+            db = self._db()
+            db.executemany("INSERT INTO expiration_log (run_at, user_id, user_name, expire_date, action, error) VALUES (?, ?, ?, ?, ?, ?)",
+                           [(run_at, e["user_id"], e.get("name"), e["expire_date"], e["action"], e.get("error")) for e in entries])
+            db.execute("DELETE FROM expiration_log WHERE run_at < ?", (run_at - LOG_KEEP_DAYS * 86400,))
+            db.commit()
+
+    def log(self, limit=200):
+        with self._lock:
+            rows = self._db().execute("SELECT * FROM expiration_log ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [{**dict(r), "run_at": datetime.datetime.fromtimestamp(r["run_at"]).strftime("%Y-%m-%d %H:%M:%S")} for r in rows]
+
+    # ---------------- 查询 ----------------
+    @staticmethod
+    def _today():
+        return datetime.date.today().isoformat()
+
+    def due(self, today=None):
+        """已过期 (到期日早于今天) 且该到期日尚未处理的用户"""
+        rows = query_db('''SELECT user_id, expire_date FROM users_meta
+                           WHERE expire_date > '' AND expire_date < ?
+                           AND (expire_handled IS NULL OR expire_handled != expire_date)''', (today or self._today(),))
+        return [dict(r) for r in rows or []]
+
+    def upcoming(self, days=None, today=None, only_new=True):
+        """今天起 days 天内到期的用户；only_new 时排除该到期日已提醒过的"""
+        days = self._notify_days() if days is None else days
+        today = today or self._today()
+        until = (datetime.date.fromisoformat(today) + datetime.timedelta(days=days)).isoformat()
+        sql = "SELECT user_id, expire_date FROM users_meta WHERE expire_date >= ? AND expire_date <= ?"
+        if only_new: sql += " AND (expire_notified IS NULL OR expire_notified != expire_date)"
+        rows = query_db(sql + " ORDER BY expire_date", (today, until))
+        return [dict(r) for r in rows or []]
+
+    @staticmethod
+    def _notify_days():
+        try: return max(0, int(cfg.get("expire_notify_days") or 0))
+        except (TypeError, ValueError): return 0
+
+    @staticmethod
+    def _mark(column, rows):
+        """批量记录处理状态 (单个事务)"""
+        if not rows: return
+        conn = sqlite3.connect(DB_PATH, timeout=20.0)
+        try:
+            with conn:
+                conn.executemany(f"UPDATE users_meta SET {column} = ? WHERE user_id = ? AND expire_date = ?",
+                                 [(r["expire_date"], r["user_id"], r["expire_date"]) for r in rows])
+        finally: conn.close()
+
+    @staticmethod
+    def _user_map():
+        return {u["Id"]: u for u in emby.list_users()}
+
+    # ---------------- 执行 ----------------
+    def preview(self):
+        """预演：列出本次会停用的用户与即将到期的用户，不做任何修改"""
+        today = self._today(); users = self._user_map()
+        expired = []
+        for r in self.due(today):
+            u = users.get(r["user_id"])
+            action = "missing" if not u else "already_disabled" if (u.get("Policy") or {}).get("IsDisabled") else "disable"
+            expired.append({**r, "name": (u or {}).get("Name"), "action": action})
+        upcoming = [{**r, "name": (users.get(r["user_id"]) or {}).get("Name")}
+                    for r in self.upcoming(today=today, only_new=False)]
+        return {"today": today, "expired": expired, "upcoming": upcoming, "notify_days": self._notify_days()}
+
+    def _disable(self, row, users):
+        u = users.get(row["user_id"])
+        if not u: return "missing"
+        if (u.get("Policy") or {}).get("IsDisabled"): return "already_disabled"
+        try: emby.update_policy(row["user_id"], {"IsDisabled": True}, user=u)
+        except EmbyError as e:
+            if e.status == 404: return "missing"
+            raise
+        return "disabled"
+
+    def run(self, notify=True):
+        """停用已到期用户并发送提醒；返回本次统计。已有任务在跑时直接返回 None"""
+        if not self._run_lock.acquire(blocking=False): return None
+        try:
+            started = time.time(); today = self._today()
+            due = self.due(today)
+            users = self._user_map() if due or (notify and self._notify_days()) else {}
+            results = emby.map_concurrent(lambda r: self._disable(r, users), due)
+            entries = []
+            for row, action, error in results:
+                entries.append({**row, "name": (users.get(row["user_id"]) or {}).get("Name"),
+                                "action": "error" if error else action, "error": str(error) if error else None})
+            self._mark("expire_handled", [e for e in entries if e["action"] != "error"])
+            self._write_log(started, entries)
+
+            reminded = self._notify(users, today, entries) if notify else 0
+            counts = {}
+            for e in entries: counts[e["action"]] = counts.get(e["action"], 0) + 1
+            self.last_run = {"at": datetime.datetime.fromtimestamp(started).strftime("%Y-%m-%d %H:%M:%S"),
+                             "checked": len(due), "counts": counts, "reminded": reminded,
+                             "took_ms": round((time.time() - started) * 1000, 1)}
+            if due: logger.info(f"⏳ Expiration: {counts} in {self.last_run['took_ms']}ms")
+            return self.last_run
+        finally:
+            self._run_lock.release()
+
+    def _notify(self, users, today, entries):
+        """管理员提醒：本次停用的账号 + 即将到期的账号 (每个到期日只提醒一次)"""
+        cid = cfg.get("tg_chat_id")
+        if not cid or not cfg.get("tg_bot_token"): return 0
+        name = lambda r: r.get("name") or (users.get(r["user_id"]) or {}).get("Name") or r["user_id"]
+        lines = []
+        disabled = [e for e in entries if e["action"] == "disabled"]
+        if disabled:
+            lines.append(f"⛔ <b>已停用 {len(disabled)} 个到期账号</b>")
+            lines += [f"· {name(e)} (到期 {e['expire_date']})" for e in disabled[:30]]
+            if len(disabled) > 30: lines.append(f"… 另有 {len(disabled) - 30} 个")
+        soon = self.upcoming(today=today) if self._notify_days() else []
+        if soon:
+            if lines: lines.append("")
+            lines.append(f"⏰ <b>{len(soon)} 个账号即将到期</b>")
+            for r in soon[:30]:
+                left = (datetime.date.fromisoformat(r["expire_date"][:10]) - datetime.date.fromisoformat(today)).days
+                lines.append(f"· {name(r)}：{r['expire_date']} ({'今天' if left == 0 else f'{left} 天后'})")
+            if len(soon) > 30: lines.append(f"… 另有 {len(soon) - 30} 个")
+        if not lines: return 0
+        bot.send_message(str(cid), "\n".join(lines))
+        self._mark("expire_notified", soon)
+        return len(soon)
+
+expiration = ExpirationEngine()
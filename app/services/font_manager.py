@@ -0,0 +1,124 @@
+"""
+字体管理：后台按需下载 CJK 字体，并裁剪出只含实际会渲染字形的子集
+- 启动不再同步下载 16MB 字体 (原先 import 时最长阻塞 30 秒)
+- 子集 (GB2312 常用汉字 + ASCII + 常用符号) 缓存到磁盘，渲染只解析几 MB 的子集
+- 子集未覆盖的字符 (生僻字用户名/片名) 自动回退到完整字体
+"""
+import os
+import json
+import threading
+import logging
+import importlib.util
+import requests
+from app.core.config import FONT_DIR, FONT_PATH, FONT_URL
+
+# fontTools 只在后台裁剪子集时才导入，不拖慢启动
+HAS_FONTTOOLS = importlib.util.find_spec("fontTools") is not None
+
+logger = logging.getLogger("uvicorn")
+
+SUBSET_VERSION = 1
+SUBSET_PATH = os.path.join(FONT_DIR, f"NotoSansCJKsc-Bold.subset-v{SUBSET_VERSION}.otf")
+SUBSET_CMAP_PATH = SUBSET_PATH + ".json"
+
+def subset_text():
+    """子集字符表：ASCII + 常用标点/全角符号 + GB2312 一二级汉字"""
+    chars = [chr(c) for c in range(0x20, 0x7F)]
+    chars += [chr(c) for c in range(0x2000, 0x206F)]   # 通用标点
+    chars += [chr(c) for c in range(0x3000, 0x303F)]   # CJK 标点
+    chars += [chr(c) for c in range(0xFF00, 0xFFEF)]   # 全角字符
+    for hi in range(0xA1, 0xF8):
+        for lo in range(0xA1, 0xFF):
+            try: chars.append(bytes([hi, lo]).decode("gb2312"))
+            except UnicodeDecodeError: pass
+    return "".join(chars)
+
+def _needs_glyph(ch):
+    # Emoji / 杂项符号两份字体都没有字形，不因它们回退到完整字体
+    cp = ord(ch)
+    return not (cp >= 0x1F000 or 0x2600 <= cp <= 0x27BF or 0xFE00 <= cp <= 0xFE0F or cp == 0x200D)
+
+class FontManager:
+    def __init__(self):
+        self._thread = None
+        self._lock = threading.Lock()
+        self._subset_cmap = None
+        self._subset_ready = False
+
+    # ---------------- 准备 (后台) ----------------
+    def ensure_async(self):
+        """启动后台准备线程 (幂等)，不阻塞调用方"""
+        if self._subset_ready: return
+        with self._lock:
+            if self._thread and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._provision, name="font-provision", daemon=True)
+            self._thread.start()
+
+    def ensure(self):
+        """准备完成后返回 (启动编排的后台步骤中调用)"""
+        self.ensure_async()
+        thread = self._thread
+        if thread: thread.join()
+
+    def _provision(self):
+        try:
+            if not os.path.exists(FONT_PATH): self._download()
+            if os.path.exists(FONT_PATH) and HAS_FONTTOOLS and not os.path.exists(SUBSET_CMAP_PATH):
+                self._build_subset()
+        except Exception as e:
+            logger.error(f"Font Provision Error: {e}")
+
+    def _download(self):
+        logger.info("🔤 Downloading CJK font...")
+        tmp = FONT_PATH + ".part"
+        with requests.get(FONT_URL, timeout=30, stream=True) as res:
+            if res.status_code != 200: raise Exception(f"HTTP {res.status_code}")
+            with open(tmp, 'wb') as f:
+                for chunk in res.iter_content(chunk_size=1 << 16): f.write(chunk)
+        # 下载完整后再原子替换，避免半截文件被当作可用字体
+        os.replace(tmp, FONT_PATH)
+
+    def _build_subset(self):
+        from fontTools import subset as ft_subset
+        from fontTools.ttLib import TTFont
+        logger.info("🔤 Building font subset...")
+        options = ft_subset.Options()
+        options.layout_features = ["*"]
+        options.name_IDs = ["*"]
+        options.notdef_outline = True
+        font = TTFont(FONT_PATH, lazy=True)
+        subsetter = ft_subset.Subsetter(options)
+        subsetter.populate(text=subset_text())
+        subsetter.subset(font)
+        tmp = SUBSET_PATH + ".part"
+        font.save(tmp)
+        cmap = sorted(font.getBestCmap().keys())
+        font.close()
+        os.replace(tmp, SUBSET_PATH)
+        # 子集实际覆盖的码位清单，运行时据此判断是否需要回退 (不依赖 fontTools)
+        with open(SUBSET_CMAP_PATH + ".part", 'w') as f: json.dump(cmap, f)
+        os.replace(SUBSET_CMAP_PATH + ".part", SUBSET_CMAP_PATH)
+        logger.info(f"🔤 Font subset ready: {os.path.getsize(SUBSET_PATH) // 1024}KB, {len(cmap)} glyphs")
+
+    # ---------------- 查询 (渲染时) ----------------
+    def _load_subset(self):
+        if self._subset_ready: return True
+        if not (os.path.exists(SUBSET_PATH) and os.path.exists(SUBSET_CMAP_PATH)): return False
+        try:
+            with open(SUBSET_CMAP_PATH) as f: self._subset_cmap = frozenset(json.load(f))
+            self._subset_ready = True
+        except Exception: return False
+        return True
+
+    def ready(self):
+        return self._subset_ready or os.path.exists(FONT_PATH)
+
+    def path_for(self, text=None):
+        """返回能渲染 text 的最小字体文件路径；字体尚未就绪返回 None"""
+        if self._load_subset():
+            if not text or all(ord(ch) in self._subset_cmap or not _needs_glyph(ch) for ch in text):
+                return SUBSET_PATH
+        if os.path.exists(FONT_PATH): return FONT_PATH
+        return SUBSET_PATH if self._subset_ready else None
+
+font_manager = FontManager()
@@ -0,0 +1,186 @@
+"""
+IP 归属地查询
+1. 进程内 LRU + TTL 缓存：同一 IP 的开始/停止播放只查一次
+2. 可选的本地 IP 段库 (CSV)：载入为有序整数数组，bisect 二分查找，微秒级且无需联网
+3. 远程服务 (默认 ip-api.com) 仅作为可配置的兜底
+
+本地库格式 (每行一个 IP 段，# 开头为注释，兼容 IP2Location LITE CSV)：
+    起始IP,结束IP,位置字段...    (IP 可为点分/冒号格式或整数)
+    CIDR,位置字段...
+"""
+import os
+import csv
+import time
+import bisect
+import threading
+import ipaddress
+import logging
+import requests
+from array import array
+from collections import OrderedDict
+from app.core.config import cfg, CONFIG_DIR
+
+logger = logging.getLogger("uvicorn")
+
+DEFAULT_DB_PATH = os.path.join(CONFIG_DIR, "geoip.csv")
+
+class RangeTable:
+    """不重叠 IP 段的有序表：starts/ends 整数数组 + 位置标签下标"""
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.starts = []; self.ends = []; self.labels = []
+
+    def freeze(self):
+        order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+        if self.typecode:
+            self.starts = array(self.typecode, (self.starts[i] for i in order))
+            self.ends = array(self.typecode, (self.ends[i] for i in order))
+        else:
+            # IPv6 为 128 位整数，超出 array 能力，用普通列表
+            self.starts = [self.starts[i] for i in order]
+            self.ends = [self.ends[i] for i in order]
+        self.labels = array('I', (self.labels[i] for i in order))
+
+    def find(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]: return self.labels[i]
+        return None
+
+class GeoIPService:
+    def __init__(self, cache_size=4096, ttl=86400):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._v4 = None; self._v6 = None; self._names = []
+        self._loaded_path = None
+        self.stats = {"hits": 0, "local": 0, "remote": 0, "miss": 0}
+        cfg.subscribe({"geoip_db_path"}, lambda keys: self.load_async())
+
+    # ---------------- 本地库 ----------------
+    def _db_path(self):
+        return cfg.get("geoip_db_path") or DEFAULT_DB_PATH
+
+    def load_async(self):
+        threading.Thread(target=self.load, name="geoip-load", daemon=True).start()
+
+    def load(self):
+        path = self._db_path()
+        if not os.path.exists(path): return False
+        start = time.time()
+        v4 = RangeTable('L'); v6 = RangeTable(None)
+        names = []; name_idx = {}
+        try:
+            with open(path, newline='', encoding='utf-8', errors='ignore') as f:
+                for row in csv.reader(f):
+                    if not row or row[0].startswith('#'): continue
+                    parsed = self._parse_row(row)
+                    if not parsed: continue
+                    lo, hi, label, version = parsed
+                    idx = name_idx.get(label)
+                    if idx is None:
+                        idx = name_idx[label] = len(names); names.append(label)
+                    table = v4 if version == 4 else v6
+                    table.starts.append(lo); table.ends.append(hi); table.labels.append(idx)
+            v4.freeze(); v6.freeze()
+        except Exception as e:
+            logger.error(f"GeoIP Load Error: {e}")
+            return False
+        with self._lock:
+            self._v4, self._v6, self._names = v4, v6, names
+            self._loaded_path = path
+            self._cache.clear()
+        logger.info(f"🌐 GeoIP loaded: {len(v4.starts)} IPv4 / {len(v6.starts)} IPv6 ranges in {time.time() - start:.1f}s")
+        return True
+
+    @staticmethod
+    def _to_int(value):
+        value = value.strip()
+        if value.isdigit():
+            n = int(value)
+            return n, (4 if n <= 0xFFFFFFFF else 6)
+        addr = ipaddress.ip_address(value)
+        return int(addr), addr.version
+
+    @staticmethod
+    def _label(fields):
+        fields = [x.strip() for x in fields if x.strip() and x.strip() != '-']
+        # IP2Location 首列是两位国家代码，有更完整的字段时去掉
+        if len(fields) > 1 and len(fields[0]) == 2 and fields[0].isupper(): fields = fields[1:]
+        return " ".join(fields)
+
+    def _parse_row(self, row):
+        try:
+            if '/' in row[0]:
+                net = ipaddress.ip_network(row[0].strip(), strict=False)
+                return int(net.network_address), int(net.broadcast_address), self._label(row[1:]), net.version
+            lo, version = self._to_int(row[0]); hi, _ = self._to_int(row[1])
+            # IP2Location IPv6 库用整数存 IPv4 映射地址 (::ffff:a.b.c.d)，这里还原为 IPv4
+            if version == 6 and 0xFFFF00000000 <= lo <= 0xFFFFFFFFFFFF and hi <= 0xFFFFFFFFFFFF:
+                lo -= 0xFFFF00000000; hi -= 0xFFFF00000000; version = 4
+            return lo, hi, self._label(row[2:]), version
+        except (ValueError, IndexError):
+            return None
+
+    def _lookup_local(self, addr):
+        table = self._v4 if addr.version == 4 else self._v6
+        if not table: return None
+        idx = table.find(int(addr))
+        return self._names[idx] if idx is not None else None
+
+    # ---------------- 远程兜底 ----------------
+    def _lookup_remote(self, ip):
+        if not cfg.get("geoip_remote"): return None
+        url = (cfg.get("geoip_remote_url") or "http://ip-api.com/json/{ip}?lang=zh-CN").replace("{ip}", ip)
+        try:
+            res = requests.get(url, timeout=3)
+            if res.status_code == 200:
+                d = res.json()
+                if d.get('status') == 'success':
+                    return f"{d.get('country')} {d.get('regionName')} {d.get('city')}"
+        except: pass
+        return None
+
+    # ---------------- 查询 ----------------
+    @staticmethod
+    def _normalize(ip):
+        ip = (ip or "").strip()
+        if ip.startswith('['): ip = ip[1:].split(']')[0]              # [v6]:port
+        elif ip.count(':') == 1: ip = ip.split(':')[0]                # v4:port
+        return ip
+
+    def lookup(self, ip):
+        ip = self._normalize(ip)
+        if not ip or ip in ['127.0.0.1', '::1', '0.0.0.0']: return "本地连接"
+        try: addr = ipaddress.ip_address(ip)
+        except ValueError: return "未知位置"
+        if addr.version == 6 and addr.ipv4_mapped: addr = addr.ipv4_mapped
+        if addr.is_loopback: return "本地连接"
+        if addr.is_private or addr.is_link_local: return "局域网"
+
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(ip)
+            if entry and now - entry[0] < self.ttl:
+                self._cache.move_to_end(ip)
+                self.stats["hits"] += 1
+                return entry[1]
+
+        loc = self._lookup_local(addr)
+        if loc: self.stats["local"] += 1
+        else:
+            loc = self._lookup_remote(str(addr))
+            if loc: self.stats["remote"] += 1
+        ts = now
+        if not loc:
+            self.stats["miss"] += 1
+            loc = "未知位置"
+            ts = now - self.ttl + 300   # 查不到的结果只缓存 5 分钟
+
+        with self._lock:
+            self._cache[ip] = (ts, loc)
+            self._cache.move_to_end(ip)
+            while len(self._cache) > self.cache_size: self._cache.popitem(last=False)
+        return loc
+
+geoip = GeoIPService()
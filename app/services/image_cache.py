@@ -0,0 +1,99 @@
+import io
+import time
+import threading
+import importlib.util
+import requests
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from app.core.config import cfg
+
+# Pillow 在首次缩放封面时才导入
+HAS_PIL = importlib.util.find_spec("PIL") is not None
+
+logger = logging.getLogger("uvicorn")
+
+class ImageCache:
+    """
+    Emby 封面共享缓存
+    每张图只下载、解码、缩放一次，缓存缩放后的 JPEG 字节 (可直接传给渲染进程)
+    并发抓取 + 时间预算：超时未完成的返回 None (调用方画占位)，后台任务继续完成并回填缓存
+    没有封面 (无 ID / 404) 属于确定结果，返回 b""；超时与临时失败 (网络错误、5xx) 返回 None
+    """
+    def __init__(self, max_entries=256, ttl=3600, workers=8):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="img-cache")
+
+    def _get_cached(self, key):
+        entry = self._data.get(key)
+        if not entry: return None
+        ts, payload = entry
+        if time.time() - ts > self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return payload
+
+    def _put(self, key, payload, ts=None):
+        self._data[key] = (ts or time.time(), payload)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def _fetch(self, key):
+        item_id, img_type, size = key
+        payload = None
+        try:
+            key_ = cfg.get("emby_api_key"); host = cfg.get("emby_host")
+            if key_ and host:
+                url = f"{host}/emby/Items/{item_id}/Images/{img_type}?maxHeight={size[1] * 2}&maxWidth={size[0] * 2}&quality=90&api_key={key_}"
+                res = requests.get(url, timeout=10)
+                if res.status_code == 404: payload = b""
+                elif res.status_code == 200:
+                    from PIL import Image, ImageOps
+                    # 居中裁切到目标尺寸，重新编码为小体积 JPEG
+                    img = ImageOps.fit(Image.open(io.BytesIO(res.content)).convert('RGB'), size)
+                    out = io.BytesIO()
+                    img.save(out, format='JPEG', quality=90)
+                    payload = out.getvalue()
+        except Exception as e:
+            logger.warning(f"Image Cache Fetch Error ({item_id}): {e}")
+        with self._lock:
+            # 临时失败记为 False (1 分钟后过期)，避免短时间内反复请求坏图
+            if payload is not None: self._put(key, payload)
+            else: self._put(key, False, ts=time.time() - self.ttl + 60)
+            self._inflight.pop(key, None)
+        return payload
+
+    def get_many(self, item_ids, size, img_type='Primary', budget=2.0):
+        """按顺序返回缩放后的图片字节列表：没有封面的位置为 b""，预算内未取到的位置为 None"""
+        if not HAS_PIL: return [None] * len(item_ids)
+        results = [None] * len(item_ids)
+        pending = {}
+        with self._lock:
+            for i, item_id in enumerate(item_ids):
+                if not item_id:
+                    results[i] = b""
+                    continue
+                key = (item_id, img_type, tuple(size))
+                cached = self._get_cached(key)
+                if cached is not None:
+                    results[i] = cached if cached is not False else None
+                    continue
+                future = self._inflight.get(key)
+                if not future:
+                    future = self._executor.submit(self._fetch, key)
+                    self._inflight[key] = future
+                pending[i] = future
+
+        if pending:
+            done, _ = wait(list(pending.values()), timeout=budget)
+            for i, future in pending.items():
+                if future in done: results[i] = future.result()
+        return results
+
+image_cache = ImageCache()
@@ -0,0 +1,61 @@
+import time
+import logging
+from app.core.config import cfg
+from app.services.bot_service import bot
+from app.services.delayed_jobs import delayed_jobs
+
+logger = logging.getLogger("uvicorn")
+
+class MediaAggregator:
+    """
+    入库通知聚合：整季/批量入库时 Emby 会逐集触发 library.new
+    同一剧集 (SeriesId) 的新集、同一批电影在窗口期内合并为一条通知：
+    - 剧集: 一条海报消息 "S02E01–E20 新增 20 集"
+    - 电影: 一组相册 (sendMediaGroup)
+    窗口内持续有新事件则顺延，最长不超过 5 个窗口，保证通知延迟有上限
+    待发送的分组以延迟任务形式持久化，重启后不会丢失
+    """
+    MAX_WINDOWS = 5
+
+    def __init__(self):
+        delayed_jobs.register("media_group", self._flush)
+
+    def _window(self):
+        try: return max(0, float(cfg.get("library_notify_window") or 0))
+        except (TypeError, ValueError): return 60.0
+
+    @staticmethod
+    def group_key(item):
+        if item.get("Type") == "Episode" and item.get("SeriesId"): return f"series:{item['SeriesId']}"
+        if item.get("Type") == "Series": return f"series:{item['Id']}"
+        return "movies"
+
+    def add(self, item):
+        if not cfg.get("enable_library_notify") or not cfg.get("tg_chat_id"): return
+        window = self._window()
+        if window <= 0:
+            # 关闭聚合：保持逐条推送
+            return bot.push_new_media(item.get("Id"), item)
+        key = self.group_key(item)
+        now = time.time()
+
+        def merge(group):
+            group = group or {"key": key, "first": now, "items": {}}
+            group["items"][item["Id"]] = item
+            return group, min(now + window, group["first"] + window * self.MAX_WINDOWS)
+
+        delayed_jobs.upsert("media_group", f"media_group:{key}", merge)
+
+    def _flush(self, group, attempts):
+        key = group["key"]
+        items = list(group["items"].values())
+        if len(items) == 1:
+            # 聚合窗口已等待过，立即做首次封面检查
+            bot.push_new_media(items[0]["Id"], items[0], delay=0)
+        elif key == "movies":
+            bot.push_new_movies(items)
+        else:
+            bot.push_new_episodes(key.split(":", 1)[1], items)
+        logger.info(f"📦 Library notify flushed: {key} ({len(items)} items)")
+
+media_aggregator = MediaAggregator()
@@ -0,0 +1,243 @@
+"""
+原生播放记录
+由 webhook 的 playback.* 事件写入，不依赖 Playback Reporting 插件：
+- 用户 / 条目 / 设备编码为整数 (字典表)，时间为 epoch 秒，行很小
+- 事件按月分表 (events_YYYYMM)，只追加；旧月份可整表删除
+- 写入线程合并提交 (一个事务写一批)，调用方等到落盘后才返回，配合 webhook 日志保证不丢
+- 视图 PlaybackActivity 与插件表同名同列 (一次停止 = 一条播放记录)，stats_source = native 时统计接口直接查询本库；
+  视图只是兼容层，另外暴露整数列 ts，query_db 会把 DateCreated 的日期条件改写到 ts 上 (见 database.native_sql)，
+  条件下推到各月分表走 ts 索引，不在范围内的月份只做一次索引探测
+"""
+import re
+import time
+import datetime
+import threading
+import logging
+from app.core.config import cfg
+from app.core.database import local_connect, NATIVE_DB_PATH
+
+logger = logging.getLogger("uvicorn")
+
+KINDS = {"start": 1, "progress": 2, "stop": 3, "pause": 4, "unpause": 5}
+FLUSH_INTERVAL = 0.05       # 合并提交的最长等待 (秒)
+MAX_BATCH = 1000
+MAX_DURATION = 86400        # 单次播放时长上限，防止漏收 stop 时算出离谱的值
+
+def partition_name(ts):
+    return "events_" + datetime.datetime.fromtimestamp(ts).strftime("%Y%m")
+
+class PlaybackStore:
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()             # 保护连接
+        self._cond = threading.Condition()        # 保护缓冲区
+        self._buffer = []                         # [{"ts", "event", "data", "done", "error"}]
+        self._thread = None
+        self._dims = {"user": {}, "item": {}, "client": {}}
+        self._partitions = set()
+        self._open = {}                           # 会话键 -> {"start", "paused_at", "paused"}
+        self.stats = {"recorded": 0, "batches": 0, "last_batch": 0, "errors": 0}
+        cfg.subscribe({"native_playback", "stats_source"}, lambda keys: self.ensure_ready())
+
+    def enabled(self):
+        return bool(cfg.get("native_playback")) or cfg.get("stats_source") == "native"
+
+    # ---------------- 存储 ----------------
+    def _db(self):
+        if not self._conn:
+            conn = local_connect(NATIVE_DB_PATH)
+            conn.execute("CREATE TABLE IF NOT EXISTS dim_users (id INTEGER PRIMARY KEY, emby_id TEXT NOT NULL UNIQUE, name TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS dim_items (id INTEGER PRIMARY KEY, emby_id TEXT NOT NULL UNIQUE, name TEXT, type TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS dim_clients (id INTEGER PRIMARY KEY, device TEXT NOT NULL, client TEXT NOT NULL, UNIQUE(device, client))")
+            conn.commit()
+            self._partitions = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'events_%'")}
+            for kind, table, cols in (("user", "dim_users", "emby_id"), ("item", "dim_items", "emby_id"), ("client", "dim_clients", "device || char(31) || client")):
+                self._dims[kind] = {r[1]: r[0] for r in conn.execute(f"SELECT id, {cols} FROM {table}")}
+            self._rebuild_view(conn); conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _ensure_partition(self, conn, name):
+        if name in self._partitions: return
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS {name} (
+                            ts INTEGER NOT NULL,
+                            kind INTEGER NOT NULL,
+                            user INTEGER NOT NULL,
+                            item INTEGER NOT NULL,
+                            client INTEGER NOT NULL,
+                            position INTEGER,
+                            duration INTEGER
+                        )''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_ts ON {name}(ts)")
+        self._partitions.add(name)
+        self._rebuild_view(conn)
+
+    def _rebuild_view(self, conn):
+        """插件兼容视图：各月分表 UNION ALL，只取停止事件；ts 列供日期条件下推"""
+        conn.execute("DROP VIEW IF EXISTS PlaybackActivity")
+        union = " UNION ALL ".join(f"SELECT ts, user, item, client, duration FROM {p} WHERE kind = {KINDS['stop']}" for p in sorted(self._partitions))
+        # 还没有任何分表时给一个空结果，统计接口照常返回 0
+        union = union or "SELECT 0 AS ts, 0 AS user, 0 AS item, 0 AS client, 0 AS duration WHERE 0"
+        conn.execute(f'''CREATE VIEW PlaybackActivity AS
+                         SELECT e.ts AS ts, datetime(e.ts, 'unixepoch', 'localtime') AS DateCreated,
+                                u.emby_id AS UserId, i.emby_id AS ItemId, i.name AS ItemName, i.type AS ItemType,
+                                e.duration AS PlayDuration, c.device AS DeviceName, c.client AS ClientName
+                         FROM ({union}) e
+                         JOIN dim_users u ON u.id = e.user
+                         JOIN dim_items i ON i.id = e.item
+                         JOIN dim_clients c ON c.id = e.client''')
+
+    def _dim(self, conn, kind, key, insert, params):
+        cache = self._dims[kind]
+        if key not in cache:
+            cache[key] = conn.execute(insert, params).lastrowid
+        return cache[key]
+
+    def ensure_ready(self):
+        """启用时在启动阶段建库，切换到 native 数据源后立即可查"""
+        if not self.enabled(): return
+        try:
+            with self._lock: self._db()
+            self._start_writer()
+        except Exception as e: logger.error(f"Playback Store Init Error: {e}")
+
+    # ---------------- 写入 ----------------
+    def record(self, event, data, wait=True):
+        """event: start / progress / stop / pause / unpause；wait 时阻塞到本条落盘"""
+        if event not in KINDS or not self.enabled(): return
+        item = data.get("Item") or {}; user = data.get("User") or {}
+        if not item.get("Id") or not user.get("Id"): return
+        self._start_writer()
+        entry = {"ts": self.event_time(data), "event": event, "data": data, "done": False, "error": None}
+        with self._cond:
+            self._buffer.append(entry)
+            self._cond.notify_all()
+            if not wait: return
+            deadline = time.time() + 10
+            while not entry["done"] and time.time() < deadline:
+                self._cond.wait(timeout=0.5)
+        if not entry["done"]: raise Exception("playback store flush timeout")
+        if entry["error"]: raise Exception(f"playback store write failed: {entry['error']}")
+
+    def _start_writer(self):
+        if self._thread and self._thread.is_alive(): return
+        with self._lock:
+            if self._thread and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._writer_loop, name="playback-store", daemon=True)
+            self._thread.start()
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                while not self._buffer: self._cond.wait(timeout=5)
+                # 第一条到达后再等一小段时间，把并发到达的事件合并成一个事务
+                deadline = time.time() + FLUSH_INTERVAL
+                while len(self._buffer) < MAX_BATCH:
+                    left = deadline - time.time()
+                    if left <= 0: break
+                    self._cond.wait(timeout=left)
+                batch, self._buffer = self._buffer[:MAX_BATCH], self._buffer[MAX_BATCH:]
+            error = None
+            try: self._write(batch)
+            except Exception as e:
+                # 写失败：等待中的调用方收到异常，由 webhook 日志重试
+                error = str(e); self.stats["errors"] += 1
+                logger.error(f"Playback Store Error: {e}")
+            with self._cond:
+                for entry in batch: entry["done"] = True; entry["error"] = error
+                self._cond.notify_all()
+
+    def _session_key(self, data):
+        session = data.get("Session") or {}
+        return f"{session.get('Id') or session.get('DeviceId')}:{(data.get('Item') or {}).get('Id')}"
+
+    def _duration(self, key, kind, ts, last_start):
+        """
+        根据会话内的 start / pause / unpause 推算实际观看秒数 (只在 stop 时返回)
+        内存里没有会话 (如服务重启) 时用 last_start() 从库里找最近一次 start
+        """
+        state = self._open.get(key)
+        if kind == KINDS["start"]:
+            self._open[key] = {"start": ts, "paused_at": None, "paused": 0}
+        elif state and kind == KINDS["pause"] and not state["paused_at"]:
+            state["paused_at"] = ts
+        elif state and kind == KINDS["unpause"] and state["paused_at"]:
+            state["paused"] += ts - state["paused_at"]; state["paused_at"] = None
+        elif kind == KINDS["stop"]:
+            if not state:
+                start = last_start()
+                return int(min(MAX_DURATION, ts - start)) if start else 0
+            self._open.pop(key, None)
+            end = state["paused_at"] or ts
+            return int(max(0, min(MAX_DURATION, end - state["start"] - state["paused"])))
+        return None
+
+    def _write(self, batch):
+        with self._lock:
+            conn = self._db()
+            rows = {}
+            try:
+                for entry in batch:
+                    ts, event, data = entry["ts"], entry["event"], entry["data"]
+                    item = data.get("Item") or {}; user = data.get("User") or {}; session = data.get("Session") or {}
+                    uid = self._dim(conn, "user", user["Id"], "INSERT INTO dim_users (emby_id, name) VALUES (?, ?)", (user["Id"], user.get("Name")))
+                    iid = self._dim(conn, "item", item["Id"], "INSERT INTO dim_items (emby_id, name, type) VALUES (?, ?, ?)",
+                                    (item["Id"], self._item_name(item), item.get("Type")))
+                    device = session.get("DeviceName") or ""; client = session.get("Client") or ""
+                    cid = self._dim(conn, "client", f"{device}\x1f{client}", "INSERT INTO dim_clients (device, client) VALUES (?, ?)", (device, client))
+                    kind = KINDS[event]
+                    position = (data.get("PlaybackInfo") or {}).get("PositionTicks")
+                    duration = self._duration(self._session_key(data), kind, ts, lambda: self._last_start(conn, ts, uid, iid, cid))
+                    name = partition_name(ts)
+                    self._ensure_partition(conn, name)
+                    rows.setdefault(name, []).append((int(ts), kind, uid, iid, cid, int(position / 10_000_000) if position else None, duration))
+                for name, values in rows.items():
+                    conn.executemany(f"INSERT INTO {name} (ts, kind, user, item, client, position, duration) VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                # 字典缓存可能含有已回滚的 id，整体重新加载
+                self._conn = None; conn.close()
+                raise
+        self.stats["recorded"] += len(batch); self.stats["batches"] += 1; self.stats["last_batch"] = len(batch)
+
+    def _last_start(self, conn, ts, uid, iid, cid):
+        found = []
+        for name in {partition_name(ts), partition_name(ts - MAX_DURATION)} & self._partitions:
+            found.append(conn.execute(f"SELECT MAX(ts) FROM {name} WHERE ts > ? AND kind = ? AND user = ? AND item = ? AND client = ?",
+                                      (int(ts - MAX_DURATION), KINDS["start"], uid, iid, cid)).fetchone()[0])
+        return max([t for t in found if t] or [0])
+
+    @staticmethod
+    def event_time(data):
+        """优先用 Emby 载荷里的事件时间 (积压后处理时也准确)，解析失败用当前时间"""
+        raw = data.get("Date")
+        if raw:
+            m = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]\d{2}:?\d{2})?$", str(raw).strip())
+            if m:
+                tz = (m.group(3) or "Z").replace("Z", "+00:00")
+                if ":" not in tz: tz = tz[:3] + ":" + tz[3:]
+                try:
+                    ts = datetime.datetime.fromisoformat(m.group(1) + (m.group(2) or "")[:7] + tz).timestamp()
+                    if abs(ts - time.time()) < 7 * 86400: return ts
+                except ValueError: pass
+        return time.time()
+
+    @staticmethod
+    def _item_name(item):
+        """剧集按插件的习惯记为 "剧名 - s01e02 - 标题"，便于按名称聚合"""
+        if item.get("Type") == "Episode" and item.get("SeriesName"):
+            return f"{item['SeriesName']} - s{item.get('ParentIndexNumber') or 0:02d}e{item.get('IndexNumber') or 0:02d} - {item.get('Name')}"
+        return item.get("Name")
+
+    # ---------------- 状态 ----------------
+    def status(self):
+        with self._lock:
+            conn = self._db()
+            parts = {p: conn.execute(f"SELECT COUNT(*) FROM {p}").fetchone()[0] for p in sorted(self._partitions)}
+        with self._cond: buffered = len(self._buffer)
+        return {"enabled": self.enabled(), "source": cfg.get("stats_source") or "plugin", "partitions": parts,
+                "users": len(self._dims["user"]), "items": len(self._dims["item"]), "clients": len(self._dims["client"]),
+                "buffered": buffered, "open_sessions": len(self._open), **self.stats}
+
+playback_store = PlaybackStore()
@@ -0,0 +1,136 @@
+"""
+播放会话跟踪
+客户端网络抖动、拖动进度时会连续触发 stop/start，原来每个事件都推送一条带图消息
+这里按 (会话, 条目) 维护内存状态：
+- 会话内重复的 start / stop 直接丢弃
+- stop 后不立即推送，等待去抖窗口 (playback_debounce 秒)；窗口内同一会话重新 start 视为续播，合并为同一次观看
+- 窗口结束仍未续播，推送一条汇总：观看时长、中断次数、进度
+待发送的汇总以延迟任务持久化，重启不会丢失
+事件经 webhook 日志异步处理 (可能积压、重试、重启后补处理)，时长与去抖窗口一律按载荷中的事件时间计算
+"""
+import time
+import threading
+import logging
+from app.core.config import cfg
+from app.services.bot_service import bot
+from app.services.delayed_jobs import delayed_jobs
+from app.services.playback_store import playback_store
+
+logger = logging.getLogger("uvicorn")
+
+STALE_AFTER = 6 * 3600      # 只有 start 没有 stop 的会话 (客户端崩溃) 超过此时长后清理
+
+class PlaybackTracker:
+    def __init__(self):
+        self._sessions = {}     # key -> {"data", "started", "watched", "segments", "playing", "paused_at", "stopped_at", "seen"}
+        self._lock = threading.Lock()
+        self.stats = {"events": 0, "starts_sent": 0, "summaries_sent": 0, "duplicates": 0, "resumes": 0}
+        delayed_jobs.register("playback_summary", self._flush)
+
+    def _window(self):
+        try: return max(0, float(cfg.get("playback_debounce") or 0))
+        except (TypeError, ValueError): return 30.0
+
+    @staticmethod
+    def session_key(data):
+        session = data.get("Session") or {}; item = data.get("Item") or {}
+        sid = session.get("Id") or f"{(data.get('User') or {}).get('Id')}:{session.get('DeviceId') or session.get('DeviceName')}"
+        return f"{sid}:{item.get('Id')}"
+
+    @staticmethod
+    def _slim(data):
+        """只保留推送所需字段，避免把整个 webhook 包写进延迟任务"""
+        item = data.get("Item") or {}; session = data.get("Session") or {}
+        return {
+            "User": {"Id": (data.get("User") or {}).get("Id"), "Name": (data.get("User") or {}).get("Name")},
+            "Item": {k: item.get(k) for k in ("Id", "Name", "Type", "SeriesName", "SeriesId", "IndexNumber", "ParentIndexNumber", "RunTimeTicks")},
+            "Session": {k: session.get(k) for k in ("Id", "RemoteEndPoint", "Client", "DeviceName", "DeviceId")},
+            "PlaybackInfo": data.get("PlaybackInfo") or {}
+        }
+
+    def _prune(self, now):
+        for key in [k for k, s in self._sessions.items() if s["playing"] and now - s["seen"] > STALE_AFTER]:
+            self._sessions.pop(key, None)
+
+    def handle(self, data, event):
+        """event: start / stop / pause / unpause"""
+        self.stats["events"] += 1
+        key = self.session_key(data); now = playback_store.event_time(data)
+        if self._window() <= 0:
+            # 关闭去抖：保持逐条推送
+            if event in ("start", "stop"): bot.push_playback_event(data, event)
+            return
+        send_start = False; flush = None
+        with self._lock:
+            self._prune(now)
+            state = self._sessions.get(key)
+            if event == "start":
+                if state and state["playing"]:
+                    self.stats["duplicates"] += 1
+                elif state and now - (state["stopped_at"] or now) <= self._window():
+                    # 去抖窗口内重新开始：续播，撤销待发送的汇总
+                    delayed_jobs.cancel(f"playback:{key}")
+                    state.update(playing=True, started=now, paused_at=None, segments=state["segments"] + 1)
+                    self.stats["resumes"] += 1
+                else:
+                    if state:
+                        # 按事件时间已超出去抖窗口 (积压后集中处理)：上一次观看立即结算，这是新的一次播放
+                        delayed_jobs.cancel(f"playback:{key}")
+                        flush = (state["data"], self._summary(state))
+                    state = self._sessions[key] = {"data": self._slim(data), "started": now, "watched": 0.0, "segments": 1,
+                                                   "playing": True, "paused_at": None, "stopped_at": None, "seen": now}
+                    send_start = True
+            elif event == "pause" and state and state["playing"] and not state["paused_at"]:
+                state["watched"] += max(0.0, now - state["started"]); state["paused_at"] = now
+            elif event == "unpause" and state and state["paused_at"]:
+                state["started"] = now; state["paused_at"] = None
+            elif event == "stop":
+                if state and not state["playing"]:
+                    self.stats["duplicates"] += 1
+                else:
+                    if not state:
+                        # 没收到过 start (如服务重启)：观看时长未知，只汇报进度
+                        state = self._sessions[key] = {"data": self._slim(data), "started": now, "watched": 0.0, "segments": 1,
+                                                       "playing": False, "paused_at": None, "stopped_at": None, "seen": now}
+                    elif not state["paused_at"]: state["watched"] += max(0.0, now - state["started"])
+                    state.update(playing=False, paused_at=None, stopped_at=now)
+                # 最后一次 stop 的进度最准确
+                state["data"] = self._slim(data)
+                summary = self._summary(state)
+                # 窗口从 stop 的事件时间算起，积压后处理的 stop 不再额外等满一个窗口
+                delayed_jobs.schedule("playback_summary", {"key": key, "data": state["data"], "summary": summary},
+                                      delay=max(0.0, now + self._window() - time.time()), key=f"playback:{key}")
+            if state: state["seen"] = now
+        if flush:
+            self.stats["summaries_sent"] += 1
+            bot.push_playback_event(flush[0], "stop", summary=flush[1])
+        if send_start:
+            self.stats["starts_sent"] += 1
+            bot.push_playback_event(data, "start")
+
+    @staticmethod
+    def _summary(state):
+        info = state["data"].get("PlaybackInfo") or {}
+        runtime = state["data"]["Item"].get("RunTimeTicks") or 0
+        position = info.get("PositionTicks")
+        progress = round(position / runtime * 100) if runtime and position is not None else None
+        return {"watched": round(state["watched"]), "segments": state["segments"],
+                "progress": min(progress, 100) if progress is not None else None,
+                "completed": bool(info.get("PlayedToCompletion")) or (progress or 0) >= 95}
+
+    def _flush(self, payload, attempts):
+        with self._lock:
+            state = self._sessions.get(payload["key"])
+            # 窗口到期时若已续播 (理论上任务已被撤销)，不发送
+            if state and state["playing"]: return
+            self._sessions.pop(payload["key"], None)
+        self.stats["summaries_sent"] += 1
+        bot.push_playback_event(payload["data"], "stop", summary=payload["summary"])
+
+    def active(self):
+        with self._lock:
+            return [{"key": k, "user": s["data"]["User"].get("Name"), "item": s["data"]["Item"].get("Name"),
+                     "playing": s["playing"], "watched": round(s["watched"] + (time.time() - s["started"] if s["playing"] and not s["paused_at"] else 0)),
+                     "segments": s["segments"]} for k, s in self._sessions.items()]
+
+playback_tracker = PlaybackTracker()
@@ -0,0 +1,255 @@
+"""
+报表渲染 (纯绘制，无数据库/网络依赖)
+既在主进程中调用，也作为渲染进程池的 worker 入口：输入为普通 dict，输出为图片字节
+"""
+import io
+import time
+import threading
+import importlib.util
+from app.core.config import THEMES
+from app.services.font_manager import font_manager
+
+# Pillow 推迟到首次绘制时导入，启动与不出图的进程不加载
+HAS_PIL = importlib.util.find_spec("PIL") is not None
+Image = ImageDraw = ImageFont = None
+
+def _load_pil():
+    global Image, ImageDraw, ImageFont
+    if ImageFont is None:
+        from PIL import Image as _Image, ImageDraw as _ImageDraw, ImageFont as _ImageFont
+        Image, ImageDraw, ImageFont = _Image, _ImageDraw, _ImageFont
+
+REPORT_SIZE = (800, 1200)
+FONT_SIZES = {"lg": 60, "md": 40, "sm": 28, "xs": 22}
+
+# ================= 字体缓存 =================
+# 字体文件由 font_manager 提供 (优先磁盘上的子集)，按 (文件, 字号) 全局复用 (每个进程一份)
+_FONT_CACHE = {}
+_FONT_LOCK = threading.Lock()
+
+def get_font(size, text=None):
+    """text 含子集未覆盖的字符时返回完整字体"""
+    _load_pil()
+    path = font_manager.path_for(text)
+    if not path: return ImageFont.load_default()
+    key = (path, size)
+    font = _FONT_CACHE.get(key)
+    if font: return font
+    with _FONT_LOCK:
+        font = _FONT_CACHE.get(key)
+        if font: return font
+        try:
+            font = ImageFont.truetype(path, size)
+            _FONT_CACHE[key] = font
+        except Exception:
+            return ImageFont.load_default()
+        return font
+
+def draw_rounded_rect(draw, xy, color, radius=15):
+    draw.rounded_rectangle(xy, radius=radius, fill=color)
+
+def fonts_ready():
+    return font_manager.path_for() is not None
+
+# ================= 静态底图 (主题图层) =================
+# 背景、统计卡片、固定标签、页脚与榜单行卡片与数据无关，
+# 按 (主题, 布局, 尺寸) 预先合成一次，每次渲染只在副本上绘制动态文字
+LIST_TOP = 490
+ROW_HEIGHT = 70
+ROW_SIZE = (720, 60)
+ROW_STRIP = (ROW_SIZE[0] + 1, ROW_SIZE[1] + 1)  # rounded_rectangle 的右/下边界是闭区间
+POSTER_SIZE = (220, 280)
+POSTER_SLOTS = [(40 + c * 250, 490 + r * 320) for r in range(2) for c in range(3)]
+_LAYER_CACHE = {}
+_LAYER_LOCK = threading.Lock()
+
+def _draw_static(draw, theme):
+    font_md = get_font(FONT_SIZES["md"]); font_sm = get_font(FONT_SIZES["sm"]); font_xs = get_font(FONT_SIZES["xs"])
+    draw_rounded_rect(draw, (40, 220, 390, 370), theme['card'])
+    draw.text((70, 320), "播放次数", font=font_sm, fill=theme['text'])
+    draw_rounded_rect(draw, (410, 220, 760, 370), theme['card'])
+    draw.text((440, 320), "专注时长(H)", font=font_sm, fill=theme['text'])
+    draw.text((40, 420), "🏆 内容风云榜", font=font_md, fill=theme['text'])
+    draw.text((250, 1150), "Generated by EmbyPulse", font=font_xs, fill=(80, 80, 80))
+
+def _draw_poster_slot(draw, theme, rank, x, y, with_card=True):
+    # 海报位：占位卡片 + 左上角名次徽标
+    font_sm = get_font(FONT_SIZES["sm"])
+    if with_card:
+        draw_rounded_rect(draw, (x, y, x + POSTER_SIZE[0], y + POSTER_SIZE[1]), theme['card'], radius=12)
+        draw.text((x + POSTER_SIZE[0] // 2 - 20, y + POSTER_SIZE[1] // 2 - 30), "🎬", font=get_font(FONT_SIZES["md"]), fill=theme['text'])
+    draw.ellipse((x + 8, y + 8, x + 48, y + 48), fill=theme['highlight'])
+    draw.text((x + 20 if rank < 10 else x + 12, y + 10), str(rank), font=font_sm, fill=theme['bg'])
+
+def _draw_row(draw, theme, rank, y, x=40):
+    # 榜单行卡片 + 名次 (名次与数据无关，可预合成)
+    draw_rounded_rect(draw, (x, y, x + ROW_SIZE[0], y + ROW_SIZE[1]), theme['card'], radius=10)
+    draw.text((x + 20, y + 15), str(rank), font=get_font(FONT_SIZES["sm"]), fill=theme['highlight'])
+
+def _build_layer(theme_name, layout, size):
+    _load_pil()
+    theme = THEMES[theme_name]
+    if layout == "list":
+        img = Image.new('RGB', size, theme['bg'])
+        _draw_static(ImageDraw.Draw(img), theme)
+        return img
+    if layout == "poster":
+        # 海报墙与列表共用顶部统计区与页脚
+        img = Image.new('RGB', size, theme['bg'])
+        _draw_static(ImageDraw.Draw(img), theme)
+        return img
+    if layout.startswith("row:"):
+        img = Image.new('RGB', size, theme['bg'])
+        _draw_row(ImageDraw.Draw(img), theme, int(layout[4:]), 0, x=0)
+        return img
+    raise ValueError(f"unknown layout: {layout}")
+
+def get_layer(theme_name, layout, size=REPORT_SIZE):
+    # 字体文件 (完整 -> 子集) 切换后图层随之重建
+    key = (theme_name, layout, size, font_manager.path_for())
+    layer = _LAYER_CACHE.get(key)
+    if layer: return layer
+    with _LAYER_LOCK:
+        layer = _LAYER_CACHE.get(key)
+        if layer: return layer
+        layer = _build_layer(theme_name, layout, size)
+        # 字体未就绪时合成的图层不缓存
+        if fonts_ready(): _LAYER_CACHE[key] = layer
+        return layer
+
+def preload():
+    """进程池 worker 初始化：预加载全部字号与默认主题图层，避免首个任务承担解析开销"""
+    if not HAS_PIL: return
+    for size in FONT_SIZES.values(): get_font(size)
+    get_layer("black_gold", "list")
+
+def _render_posters(img, draw, theme, data):
+    """海报墙：Top 6 封面 3x2 网格，缺图 (超出时间预算/下载失败) 用占位卡片"""
+    top_list = (data.get("top_list") or [])[:len(POSTER_SLOTS)]
+    posters = data.get("posters") or []
+    for i, item in enumerate(top_list):
+        x, y = POSTER_SLOTS[i]
+        poster = posters[i] if i < len(posters) else None
+        pasted = False
+        if poster:
+            try:
+                img.paste(Image.open(io.BytesIO(poster)).convert('RGB').resize(POSTER_SIZE), (x, y))
+                pasted = True
+            except Exception: pass
+        _draw_poster_slot(draw, theme, i + 1, x, y, with_card=not pasted)
+        name = (item.get('ItemName') or '')[:9]
+        draw.text((x, y + POSTER_SIZE[1] + 6), name, font=get_font(FONT_SIZES["xs"], name), fill=theme['text'])
+    if not top_list:
+        draw.text((300, LIST_TOP + 50), "暂无数据", font=get_font(FONT_SIZES["md"]), fill=(100,100,100))
+
+def render_report(data, theme_name="black_gold", use_layers=True, layout="list", preset="jpeg"):
+    """
+    data: {"user_name", "title_period", "plays", "hours", "top_list": [{"ItemName", ...}], "posters": [bytes|b""|None]}
+    layout: list (文字榜单) | poster (海报墙)
+    preset: 编码预设，见 ENCODE_PRESETS
+    返回 (图片字节, 编码信息)；use_layers=False 时整图从零绘制 (用于基准对比)
+    """
+    if not HAS_PIL: return None
+    _load_pil()
+    if theme_name not in THEMES: theme_name = "black_gold"
+    if layout == "poster": img = _render_poster_report(data, theme_name)
+    else: img = _draw_list_report(data, theme_name, use_layers)
+    return encode_image(img, preset)
+
+def _draw_list_report(data, theme_name, use_layers):
+    theme = THEMES[theme_name]
+    plays = data.get("plays", 0); hours = data.get("hours", 0)
+    top_list = data.get("top_list") or []
+
+    font_lg = get_font(FONT_SIZES["lg"]); font_md = get_font(FONT_SIZES["md"]); font_sm = get_font(FONT_SIZES["sm"])
+
+    if use_layers:
+        img = get_layer(theme_name, "list").copy()
+        draw = ImageDraw.Draw(img)
+        for i in range(len(top_list)):
+            img.paste(get_layer(theme_name, f"row:{i+1}", ROW_STRIP), (40, LIST_TOP + i * ROW_HEIGHT))
+    else:
+        img = Image.new('RGB', REPORT_SIZE, theme['bg'])
+        draw = ImageDraw.Draw(img)
+        _draw_static(draw, theme)
+        for i in range(len(top_list)): _draw_row(draw, theme, i + 1, LIST_TOP + i * ROW_HEIGHT)
+
+    # 动态内容
+    user_name = data.get("user_name", "")
+    draw.text((40, 60), user_name, font=get_font(FONT_SIZES["lg"], user_name), fill=theme['text'])
+    draw.text((40, 140), f"{data.get('title_period', '')}", font=font_sm, fill=theme['text'])
+    draw.text((70, 250), str(plays), font=font_lg, fill=theme['highlight'])
+    draw.text((440, 250), str(hours), font=font_lg, fill=theme['highlight'])
+
+    if top_list:
+        for i, item in enumerate(top_list):
+            name = (item.get('ItemName') or '')[:20]
+            draw.text((120, LIST_TOP + i * ROW_HEIGHT + 15), name, font=get_font(FONT_SIZES["sm"], name), fill=theme['text'])
+    else:
+        draw.text((300, LIST_TOP + 50), "暂无数据", font=font_md, fill=(100,100,100))
+
+    return img
+
+def _render_poster_report(data, theme_name):
+    theme = THEMES[theme_name]
+    font_lg = get_font(FONT_SIZES["lg"]); font_sm = get_font(FONT_SIZES["sm"])
+    img = get_layer(theme_name, "poster").copy()
+    draw = ImageDraw.Draw(img)
+    user_name = data.get("user_name", "")
+    draw.text((40, 60), user_name, font=get_font(FONT_SIZES["lg"], user_name), fill=theme['text'])
+    draw.text((40, 140), f"{data.get('title_period', '')}", font=font_sm, fill=theme['text'])
+    draw.text((70, 250), str(data.get("plays", 0)), font=font_lg, fill=theme['highlight'])
+    draw.text((440, 250), str(data.get("hours", 0)), font=font_lg, fill=theme['highlight'])
+    _render_posters(img, draw, theme, data)
+    return img
+
+# ================= 编码预设 =================
+# jpeg:     兼容旧行为的高质量 JPEG
+# web:      网页预览，WebP 体积约为同画质 JPEG 的 1/3
+# telegram: 渐进式 JPEG，自动选择不超过字节预算的最高画质 (慢代理批量推送更快)
+# archive:  无损 PNG 归档
+ENCODE_PRESETS = {
+    "jpeg":     {"format": "JPEG", "mime": "image/jpeg", "ext": "jpg", "quality": 95},
+    "web":      {"format": "WEBP", "mime": "image/webp", "ext": "webp", "quality": 80, "method": 4},
+    "telegram": {"format": "JPEG", "mime": "image/jpeg", "ext": "jpg", "progressive": True, "target_bytes": 300 * 1024, "min_quality": 50, "max_quality": 90},
+    "archive":  {"format": "PNG",  "mime": "image/png", "ext": "png", "lossless": True},
+}
+
+def _save(img, preset, quality=None):
+    out = io.BytesIO()
+    fmt = preset["format"]
+    if fmt == "JPEG":
+        img.save(out, format="JPEG", quality=quality or preset.get("quality", 85), optimize=True, progressive=preset.get("progressive", False))
+    elif fmt == "WEBP":
+        img.save(out, format="WEBP", quality=quality or preset.get("quality", 80), method=preset.get("method", 4))
+    else:
+        img.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+def encode_image(img, preset_name="jpeg"):
+    """按预设编码，返回 (字节, {"preset", "mime", "ext", "bytes", "quality", "encode_ms", "attempts"})"""
+    preset = ENCODE_PRESETS.get(preset_name) or ENCODE_PRESETS["jpeg"]
+    start = time.perf_counter()
+    quality = preset.get("quality"); attempts = 1
+    target = preset.get("target_bytes")
+    if target:
+        # 画质二分：找不超过字节预算的最高画质；全部超标则取最低画质
+        lo, hi = preset["min_quality"], preset["max_quality"]
+        payload = None; attempts = 0
+        while lo <= hi:
+            q = (lo + hi) // 2
+            candidate = _save(img, preset, q); attempts += 1
+            if len(candidate) <= target:
+                payload, quality = candidate, q
+                lo = q + 1
+            else:
+                hi = q - 1
+        if payload is None:
+            quality = preset["min_quality"]
+            payload = _save(img, preset, quality); attempts += 1
+    else:
+        payload = _save(img, preset, quality)
+    meta = {"preset": preset_name if preset_name in ENCODE_PRESETS else "jpeg", "mime": preset["mime"], "ext": preset["ext"],
+            "bytes": len(payload), "quality": quality, "attempts": attempts,
+            "encode_ms": round((time.perf_counter() - start) * 1000, 1)}
+    return payload, meta
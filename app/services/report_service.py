@@ -1,17 +1,25 @@
 import os
 import io
+import time
+import asyncio
 import requests
 import datetime
-from app.core.config import cfg, FONT_PATH, FONT_URL, THEMES
-from app.core.database import query_db, get_base_filter
+import threading
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from app.core.config import cfg, THEMES
+from app.core.database import query_db, get_base_filter, get_data_version
 from app.core.database import DB_PATH # check existence
+from app.services import report_render
+from app.services.image_cache import image_cache
+from app.services.font_manager import font_manager
 
-try:
-    from PIL import Image, ImageDraw, ImageFont, ImageFilter
-    HAS_PIL = True
-except ImportError:
-    HAS_PIL = False
-    print("⚠️ Pillow not found. Report generation disabled.")
+logger = logging.getLogger("uvicorn")
+
+HAS_PIL = report_render.HAS_PIL
+if not HAS_PIL: print("⚠️ Pillow not found. Report generation disabled.")
 
 def get_user_map_internal():
     # 简单的内部获取，避免循环引用
@@ -25,60 +33,168 @@ def get_user_map_internal():
         except: pass
     return user_map
 
+# ================= 渲染结果缓存 =================
+class RenderCache:
+    """
+    已渲染报表的 LRU 缓存
+    键: (user_id, period, theme, layout, preset, 数据版本)，值: (图片字节, 编码信息)
+    """
+    def __init__(self, max_entries=32, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if not entry: return None
+            ts, payload = entry
+            if time.time() - ts > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return payload
+
+    def put(self, key, payload):
+        with self._lock:
+            self._data[key] = (time.time(), payload)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock: self._data.clear()
+
+# ================= 渲染进程池 =================
+class RenderPool:
+    """
+    Pillow 绘制 + JPEG 编码是纯 CPU 任务，放到独立进程执行：
+    不占用事件循环 / 机器人线程，多份报表可跨核并行
+    worker 启动时预加载字体，任务只传输普通 dict，结果以字节返回
+    """
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _workers(self):
+        n = cfg.get("report_workers")
+        if n: return max(1, int(n))
+        return max(1, min(4, os.cpu_count() or 1))
+
+    def _get_executor(self):
+        if self._executor: return self._executor
+        with self._lock:
+            if not self._executor:
+                # spawn: 主进程有机器人/调度线程，fork 可能继承被占用的锁
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._workers(),
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=report_render.preload
+                )
+            return self._executor
+
+    def submit(self, data, theme_name, layout="list", preset="jpeg"):
+        try:
+            return self._get_executor().submit(report_render.render_report, data, theme_name, True, layout, preset)
+        except Exception as e:
+            # 进程池不可用 (已损坏/受限环境) 时重建，本次交给调用方回退到进程内渲染
+            print(f"⚠️ Render Pool Error: {e}")
+            self.shutdown()
+            return None
+
+    def render(self, data, theme_name, layout="list", preset="jpeg"):
+        future = self.submit(data, theme_name, layout, preset)
+        if future:
+            try: return future.result(timeout=60)
+            except Exception as e: print(f"⚠️ Render Worker Error: {e}")
+        return report_render.render_report(data, theme_name, True, layout, preset)
+
+    async def render_async(self, data, theme_name, layout="list", preset="jpeg"):
+        future = self.submit(data, theme_name, layout, preset)
+        if future:
+            try: return await asyncio.wait_for(asyncio.wrap_future(future), timeout=60)
+            except Exception as e: print(f"⚠️ Render Worker Error: {e}")
+        return await asyncio.get_running_loop().run_in_executor(None, report_render.render_report, data, theme_name, True, layout, preset)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+class EncodeStats:
+    """按编码预设累计编码耗时与输出体积"""
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def record(self, meta):
+        with self._lock:
+            st = self._data.setdefault(meta["preset"], {"count": 0, "total_ms": 0.0, "total_bytes": 0, "last": None})
+            st["count"] += 1; st["total_ms"] += meta["encode_ms"]; st["total_bytes"] += meta["bytes"]; st["last"] = meta
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {"count": st["count"], "avg_ms": round(st["total_ms"] / st["count"], 1),
+                           "avg_bytes": st["total_bytes"] // st["count"], "last": st["last"]}
+                    for name, st in self._data.items()}
+
+def period_filter(period):
+    """周期 -> (SQL 日期条件, 报表标题)"""
+    # 🔥 修改点：增加 yesterday 逻辑
+    if period == 'week': 
+        return " AND DateCreated > date('now', '-7 days')", "本周观影周报"
+    elif period == 'month': 
+        return " AND DateCreated > date('now', '-30 days')", "本月观影月报"
+    elif period == 'year': 
+        return " AND DateCreated > date('now', '-1 year')", "年度观影报告"
+    elif period == 'day': 
+        return " AND DateCreated > date('now', 'start of day')", "今日日报"
+    elif period == 'yesterday':
+        # 昨天全天：大于等于昨天0点，且小于今天0点
+        yesterday_str = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%m-%d")
+        return " AND DateCreated >= date('now', '-1 day', 'start of day') AND DateCreated < date('now', 'start of day')", f"昨日日报 ({yesterday_str})"
+    return "", "全量观影报告"
+
 class ReportGenerator:
     def __init__(self):
-        if HAS_PIL: self.check_font()
-    
-    def check_font(self):
-        if not os.path.exists(FONT_PATH):
-            try:
-                res = requests.get(FONT_URL, timeout=30)
-                if res.status_code == 200:
-                    with open(FONT_PATH, 'wb') as f: f.write(res.content)
-            except: pass
-
-    def draw_rounded_rect(self, draw, xy, color, radius=15):
-        if not HAS_PIL: return
-        draw.rounded_rectangle(xy, radius=radius, fill=color)
-
-    def generate_report(self, user_id, period, theme_name="black_gold"):
-        if not HAS_PIL: return None
-        theme = THEMES.get(theme_name, THEMES["black_gold"])
-        width, height = 800, 1200
-        
-        where_base, params = get_base_filter(user_id)
-        date_filter = ""
-        title_period = "全量"
-        
-        # 🔥 修改点：增加 yesterday 逻辑
-        if period == 'week': 
-            date_filter = " AND DateCreated > date('now', '-7 days')"
-            title_period = "本周观影周报"
-        elif period == 'month': 
-            date_filter = " AND DateCreated > date('now', '-30 days')"
-            title_period = "本月观影月报"
-        elif period == 'year': 
-            date_filter = " AND DateCreated > date('now', '-1 year')"
-            title_period = "年度观影报告"
-        elif period == 'day': 
-            date_filter = " AND DateCreated > date('now', 'start of day')"
-            title_period = "今日日报"
-        elif period == 'yesterday':
-            # 昨天全天：大于等于昨天0点，且小于今天0点
-            date_filter = " AND DateCreated >= date('now', '-1 day', 'start of day') AND DateCreated < date('now', 'start of day')"
-            # 获取昨天的日期字符串
-            yesterday_str = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%m-%d")
-            title_period = f"昨日日报 ({yesterday_str})"
-        else: 
-            title_period = "全量观影报告"
+        self.cache = RenderCache()
+        self.pool = RenderPool()
+        self.encode_stats = EncodeStats()
+        # 隐藏用户、服务器变化后旧的渲染结果不再有效
+        cfg.subscribe({"hidden_users", "emby_host", "stats_source"}, lambda keys: self.cache.clear())
 
+    def cache_key(self, user_id, period, theme_name, layout="list", preset="jpeg"):
+        # 全服报表受隐藏用户影响，一并纳入键
+        hidden = tuple(sorted(cfg.get("hidden_users") or [])) if user_id == 'all' else ()
+        return (user_id, period, theme_name, layout, preset, hidden, get_data_version())
+
+    @staticmethod
+    def _poster_ids(data):
+        return [item.get("ItemId") for item in (data.get("top_list") or [])[:len(report_render.POSTER_SLOTS)]]
+
+    def attach_posters(self, *datas):
+        """
+        海报墙布局：并发抓取 Top 封面 (共享图片缓存)，超出时间预算的位置留空画占位
+        传入多份数据 (批量生成) 时合并去重后只抓一轮，共用一个时间预算
+        """
+        ids = list(dict.fromkeys(i for d in datas for i in self._poster_ids(d) if i))
+        budget = float(cfg.get("report_poster_budget") or 2.0)
+        posters = dict(zip(ids, image_cache.get_many(ids, report_render.POSTER_SIZE, budget=budget)))
+        for d in datas: d["posters"] = [posters.get(i) if i else b"" for i in self._poster_ids(d)]
+
+    def collect_data(self, user_id, period):
+        """数据库聚合：返回可直接交给渲染进程的普通 dict"""
+        where_base, params = get_base_filter(user_id)
+        date_filter, title_period = period_filter(period)
         full_where = where_base + date_filter
         
         plays_res = query_db(f"SELECT COUNT(*) as c FROM PlaybackActivity {full_where}", params)
         plays = plays_res[0]['c'] if plays_res else 0
         
         dur_res = query_db(f"SELECT SUM(PlayDuration) as c FROM PlaybackActivity {full_where}", params)
-        dur = dur_res[0]['c'] or 0
+        dur = (dur_res[0]['c'] if dur_res else 0) or 0
         hours = round(dur / 3600, 1)
         
         user_name = "Emby Server"
@@ -87,44 +203,119 @@ class ReportGenerator:
         top_list = []
         if plays > 0:
             sql = f"SELECT ItemName, ItemId, COUNT(*) as C, SUM(PlayDuration) as D FROM PlaybackActivity {full_where} GROUP BY ItemName ORDER BY C DESC LIMIT 8"
-            top_list = query_db(sql, params)
+            top_list = [dict(r) for r in (query_db(sql, params) or [])]
 
-        try: font_lg = ImageFont.truetype(FONT_PATH, 60); font_md = ImageFont.truetype(FONT_PATH, 40); font_sm = ImageFont.truetype(FONT_PATH, 28); font_xs = ImageFont.truetype(FONT_PATH, 22)
-        except: font_lg = font_md = font_sm = font_xs = ImageFont.load_default()
+        return {"user_name": user_name, "title_period": title_period, "plays": plays, "hours": hours, "top_list": top_list}
 
-        img = Image.new('RGB', (width, height), theme['bg'])
-        draw = ImageDraw.Draw(img)
-        
-        draw.text((40, 60), user_name, font=font_lg, fill=theme['text'])
-        draw.text((40, 140), f"{title_period}", font=font_sm, fill=theme['text'])
-        
-        self.draw_rounded_rect(draw, (40, 220, 390, 370), theme['card'])
-        draw.text((70, 250), str(plays), font=font_lg, fill=theme['highlight'])
-        draw.text((70, 320), "播放次数", font=font_sm, fill=theme['text'])
-        
-        self.draw_rounded_rect(draw, (410, 220, 760, 370), theme['card'])
-        draw.text((440, 250), str(hours), font=font_lg, fill=theme['highlight'])
-        draw.text((440, 320), "专注时长(H)", font=font_sm, fill=theme['text'])
+    def collect_batch_data(self, period, user_ids=None, top_n=8):
+        """
+        批量聚合：一次 GROUP BY UserId 取全部用户的播放次数/时长，
+        再用窗口函数一次取出每个用户的 Top N，返回 {user_id: data}
+        """
+        where, params = get_base_filter('all')
+        date_filter, title_period = period_filter(period)
+        where += date_filter
+        if user_ids:
+            where += f" AND UserId IN ({','.join(['?'] * len(user_ids))})"
+            params = params + list(user_ids)
 
-        list_y = 420
-        draw.text((40, list_y), "🏆 内容风云榜", font=font_md, fill=theme['text'])
-        item_y = list_y + 70
-        
-        if top_list:
-            for i, item in enumerate(top_list):
-                self.draw_rounded_rect(draw, (40, item_y, 760, item_y+60), theme['card'], radius=10)
-                name = item['ItemName'][:20]
-                draw.text((60, item_y+15), str(i+1), font=font_sm, fill=theme['highlight'])
-                draw.text((120, item_y+15), name, font=font_sm, fill=theme['text'])
-                item_y += 70
-        else:
-            draw.text((300, item_y+50), "暂无数据", font=font_md, fill=(100,100,100))
-
-        draw.text((250, 1150), "Generated by EmbyPulse", font=font_xs, fill=(80, 80, 80))
-
-        output = io.BytesIO()
-        img.save(output, format='JPEG', quality=95)
-        output.seek(0)
-        return output
-
-report_gen = ReportGenerator()
\ No newline at end of file
+        totals = query_db(f"SELECT UserId, COUNT(*) as c, SUM(PlayDuration) as d FROM PlaybackActivity {where} GROUP BY UserId", params)
+        if not totals: return {}
+
+        sql = f"""
+            SELECT UserId, ItemName, ItemId, C, D FROM (
+                SELECT UserId, ItemName, MAX(ItemId) as ItemId, COUNT(*) as C, SUM(PlayDuration) as D,
+                       ROW_NUMBER() OVER (PARTITION BY UserId ORDER BY COUNT(*) DESC) as rn
+                FROM PlaybackActivity {where}
+                GROUP BY UserId, ItemName
+            ) WHERE rn <= ? ORDER BY UserId, rn
+        """
+        tops = {}
+        for r in query_db(sql, params + [top_n]) or []:
+            tops.setdefault(r['UserId'], []).append({"ItemName": r['ItemName'], "ItemId": r['ItemId'], "C": r['C'], "D": r['D']})
+
+        user_map = get_user_map_internal()
+        result = {}
+        for r in totals:
+            uid = r['UserId']
+            result[uid] = {
+                "user_name": user_map.get(uid, "User"), "title_period": title_period,
+                "plays": r['c'], "hours": round((r['d'] or 0) / 3600, 1), "top_list": tops.get(uid, [])
+            }
+        return result
+
+    def generate_batch(self, period, theme_name="black_gold", user_ids=None, layout="list", preset="jpeg"):
+        """
+        批量生成全服个人报表，返回 {user_id: (data, 图片字节, 编码信息)}
+        查询只跑两条，渲染并行分发到进程池；结果不写入渲染缓存
+        (成百上千张个人报表会把交互请求的缓存全部挤掉，且之后很少再被单独请求)
+        """
+        if not HAS_PIL: return {}
+        if theme_name not in THEMES: theme_name = "black_gold"
+        datas = self.collect_batch_data(period, user_ids)
+        if layout == "poster" and datas: self.attach_posters(*datas.values())
+        futures = {uid: self.pool.submit(d, theme_name, layout, preset) for uid, d in datas.items()}
+
+        results = {}
+        for uid, future in futures.items():
+            rendered = None
+            if future:
+                try: rendered = future.result(timeout=120)
+                except Exception as e: print(f"⚠️ Batch Render Error ({uid}): {e}")
+            if rendered is None: rendered = report_render.render_report(datas[uid], theme_name, True, layout, preset)
+            if not rendered: continue
+            self.encode_stats.record(rendered[1])
+            results[uid] = (datas[uid],) + tuple(rendered)
+        return results
+
+    def _cacheable(self, data=None):
+        # 字体未就绪时的兜底渲染、封面超时 (None) 的海报墙不入缓存，下次再补全；
+        # 确实没有封面 (b"") 的位置是确定结果，照常缓存
+        if data and None in (data.get("posters") or []): return False
+        if not font_manager.ready():
+            # 字体由后台线程准备，首次渲染时顺带触发
+            font_manager.ensure_async()
+            return False
+        return True
+
+    def _collect(self, user_id, period, layout):
+        data = self.collect_data(user_id, period)
+        if layout == "poster": self.attach_posters(data)
+        return data
+
+    def _finish(self, key, data, rendered):
+        if not rendered: return None
+        payload, meta = rendered
+        self.encode_stats.record(meta)
+        logger.info(f"🖼️ Report {key[0]}/{key[1]} [{meta['preset']}] {meta['bytes'] // 1024}KB q={meta['quality']} in {meta['encode_ms']}ms")
+        if self._cacheable(data): self.cache.put(key, rendered)
+        return rendered
+
+    def render_report(self, user_id, period, theme_name="black_gold", layout="list", preset="jpeg"):
+        """返回 (图片字节, 编码信息)，命中缓存时直接返回字节，跳过查询与绘制"""
+        if not HAS_PIL: return None
+        if theme_name not in THEMES: theme_name = "black_gold"
+        key = self.cache_key(user_id, period, theme_name, layout, preset)
+        cached = self.cache.get(key)
+        if cached: return cached
+
+        data = self._collect(user_id, period, layout)
+        return self._finish(key, data, self.pool.render(data, theme_name, layout, preset))
+
+    async def arender_report(self, user_id, period, theme_name="black_gold", layout="list", preset="jpeg"):
+        """异步版本：查询走线程池，绘制走进程池，事件循环全程不被阻塞"""
+        if not HAS_PIL: return None
+        if theme_name not in THEMES: theme_name = "black_gold"
+        loop = asyncio.get_running_loop()
+        key = await loop.run_in_executor(None, self.cache_key, user_id, period, theme_name, layout, preset)
+        cached = self.cache.get(key)
+        if cached: return cached
+
+        data = await loop.run_in_executor(None, self._collect, user_id, period, layout)
+        return self._finish(key, data, await self.pool.render_async(data, theme_name, layout, preset))
+
+    def generate_report(self, user_id, period, theme_name="black_gold", layout="list", preset="jpeg"):
+        rendered = self.render_report(user_id, period, theme_name, layout, preset)
+        return io.BytesIO(rendered[0]) if rendered else None
+
+report_gen = ReportGenerator()
@@ -0,0 +1,290 @@
+"""
+本地媒体库搜索索引 (SQLite FTS5)
+/search 与网页搜索直接查本地索引，毫秒级返回，只有最终海报才访问 Emby
+- 索引字段：标题、原名、排序名、别名 (去符号)、拼音全拼/首字母 (安装 pypinyin 时)
+- trigram 分词支持中文任意子串；不足 3 个字符的关键词改走 LIKE
+- 维护：首次启动全量同步；入库/删除 webhook 增量更新；计划任务按 DateLastSaved 增量同步，每天全量对账一次
+"""
+import re
+import time
+import json
+import datetime
+import threading
+import logging
+import importlib.util
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import cfg
+from app.core.database import local_connect
+
+# pypinyin 导入时要加载词典 (约 0.3 秒)，推迟到首次生成拼音时
+HAS_PINYIN = importlib.util.find_spec("pypinyin") is not None
+_PINYIN = None
+
+logger = logging.getLogger("uvicorn")
+
+ITEM_TYPES = "Movie,Series"
+FIELDS = "OriginalTitle,SortName,ProductionYear,CommunityRating,Overview,Genres,RecursiveItemCount,MediaSources,DateLastSaved,ImageTags"
+PAGE_SIZE = 200
+FULL_SYNC_INTERVAL = 86400
+
+def extract_tech_info(item):
+    sources = item.get("MediaSources", [])
+    if not sources: return "📼 未知信息"
+
+    info_parts = []
+    # 1. 视频流信息
+    video = next((s for s in sources[0].get("MediaStreams", []) if s.get("Type") == "Video"), None)
+    if video:
+        w = video.get("Width", 0)
+        # 分辨率判断
+        if w >= 3800: res = "4K"
+        elif w >= 1900: res = "1080P"
+        elif w >= 1200: res = "720P"
+        else: res = "SD"
+
+        # 特效判断 (HDR/DoVi)
+        extra = []
+        v_range = video.get("VideoRange", "")
+        title = video.get("DisplayTitle", "").upper()
+        if "HDR" in v_range or "HDR" in title: extra.append("HDR")
+        if "DOVI" in title or "DOLBY VISION" in title: extra.append("DoVi")
+
+        res_str = f"{res}"
+        if extra: res_str += f" {' '.join(extra)}"
+        info_parts.append(res_str)
+
+        # 码率判断
+        bitrate = sources[0].get("Bitrate", 0)
+        if bitrate > 0:
+            mbps = round(bitrate / 1000000, 1)
+            info_parts.append(f"{mbps}Mbps")
+
+    return " | ".join(info_parts) if info_parts else "📼 未知信息"
+
+def _plain(text):
+    """去掉标点空白，便于 "复仇者联盟4" 匹配 "复仇者联盟 4：终局之战" 这类写法"""
+    return re.sub(r"[\W_]+", "", (text or "").lower())
+
+def _pinyin(text):
+    global _PINYIN
+    if not HAS_PINYIN or not text: return "", ""
+    if _PINYIN is None:
+        from pypinyin import lazy_pinyin, Style
+        _PINYIN = (lazy_pinyin, Style.FIRST_LETTER)
+    lazy_pinyin, first_letter = _PINYIN
+    full = lazy_pinyin(text, errors="ignore")
+    initials = lazy_pinyin(text, style=first_letter, errors="ignore")
+    return "".join(full).lower(), "".join(initials).lower()
+
+class SearchIndex:
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._tech_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="search-tech")
+        self._tokenizer = None
+        self.stats = {"queries": 0, "last_ms": 0, "last_sync": None, "last_full_sync": None, "synced": 0}
+
+    # ---------------- 存储 ----------------
+    def _db(self):
+        if not self._conn:
+            conn = local_connect()
+            # 显式 INTEGER 主键：rowid 稳定 (VACUUM 不会重排)，全文表以它关联
+            conn.execute('''CREATE TABLE IF NOT EXISTS search_items (
+                                id INTEGER PRIMARY KEY,
+                                item_id TEXT NOT NULL UNIQUE,
+                                type TEXT, name TEXT, original_title TEXT, sort_name TEXT,
+                                year INTEGER, rating REAL, overview TEXT, genres TEXT,
+                                episode_count INTEGER, tech TEXT, server_id TEXT, image_tag TEXT,
+                                plain TEXT, pinyin TEXT, initials TEXT, synced_at REAL
+                            )''')
+            conn.execute("CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value TEXT)")
+            exists = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'search_fts'").fetchone()
+            if not exists:
+                # 优先 trigram (SQLite >= 3.34)，否则退回 unicode61
+                for tokenizer in ("trigram", "unicode61"):
+                    try:
+                        conn.execute(f"CREATE VIRTUAL TABLE search_fts USING fts5(item_id UNINDEXED, name, original_title, sort_name, plain, pinyin, initials, tokenize='{tokenizer}')")
+                        break
+                    except Exception: continue
+                exists = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'search_fts'").fetchone()
+            self._tokenizer = "trigram" if exists and "trigram" in exists['sql'] else "unicode61"
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _meta(self, key, value=None):
+        with self._lock:
+            if value is None:
+                row = self._db().execute("SELECT value FROM search_meta WHERE key = ?", (key,)).fetchone()
+                return row['value'] if row else None
+            self._db().execute("INSERT OR REPLACE INTO search_meta (key, value) VALUES (?, ?)", (key, str(value)))
+            self._db().commit()
+
+    def count(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) as c FROM search_items").fetchone()['c']
+
+    def _row(self, item):
+        name = item.get("Name") or ""; original = item.get("OriginalTitle") or ""
+        py, initials = _pinyin(name)
+        is_movie = item.get("Type") == "Movie"
+        return {
+            "item_id": item["Id"], "type": item.get("Type"), "name": name, "original_title": original,
+            "sort_name": item.get("SortName") or "", "year": item.get("ProductionYear"), "rating": item.get("CommunityRating"),
+            "overview": item.get("Overview") or "", "genres": json.dumps(item.get("Genres") or [], ensure_ascii=False),
+            "episode_count": item.get("RecursiveItemCount") if not is_movie else None,
+            "tech": extract_tech_info(item) if is_movie and item.get("MediaSources") else None,
+            "server_id": item.get("ServerId"), "image_tag": (item.get("ImageTags") or {}).get("Primary"),
+            "plain": " ".join(x for x in {_plain(name), _plain(original)} if x), "pinyin": py, "initials": initials,
+            "synced_at": time.time()
+        }
+
+    def upsert_items(self, items):
+        rows = [self._row(i) for i in items if i.get("Id") and i.get("Type") in ("Movie", "Series")]
+        if not rows: return 0
+        with self._lock:
+            conn = self._db()
+            for r in rows:
+                # 全文表 rowid 即条目表 id，更新时按它删除旧索引行
+                old = conn.execute("SELECT id, tech FROM search_items WHERE item_id = ?", (r["item_id"],)).fetchone()
+                if old:
+                    # 剧集的技术信息来自样本集，同步时不覆盖已有值
+                    if r["tech"] is None: r["tech"] = old["tech"]
+                    conn.execute(f"UPDATE search_items SET {', '.join(k + ' = ?' for k in r)} WHERE id = ?", tuple(r.values()) + (old["id"],))
+                    conn.execute("DELETE FROM search_fts WHERE rowid = ?", (old["id"],))
+                    rowid = old["id"]
+                else:
+                    rowid = conn.execute(f"INSERT INTO search_items ({','.join(r)}) VALUES ({','.join('?' * len(r))})", tuple(r.values())).lastrowid
+                conn.execute("INSERT INTO search_fts (rowid, item_id, name, original_title, sort_name, plain, pinyin, initials) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (rowid, r["item_id"], r["name"], r["original_title"], r["sort_name"], r["plain"], r["pinyin"], r["initials"]))
+            conn.commit()
+        return len(rows)
+
+    def remove(self, item_ids):
+        with self._lock:
+            conn = self._db()
+            for item_id in item_ids:
+                old = conn.execute("SELECT id FROM search_items WHERE item_id = ?", (item_id,)).fetchone()
+                if not old: continue
+                conn.execute("DELETE FROM search_fts WHERE rowid = ?", (old["id"],))
+                conn.execute("DELETE FROM search_items WHERE id = ?", (old["id"],))
+            conn.commit()
+
+    # ---------------- 同步 ----------------
+    def _fetch(self, **params):
+        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        if not host or not key: raise Exception("Emby 未配置")
+        start = 0
+        while True:
+            query = {"Recursive": "true", "IncludeItemTypes": ITEM_TYPES, "Fields": FIELDS, "StartIndex": start, "Limit": PAGE_SIZE, "api_key": key, **params}
+            res = requests.get(f"{host}/emby/Items", params=query, timeout=60)
+            res.raise_for_status()
+            items = res.json().get("Items", [])
+            yield items
+            start += len(items)
+            if len(items) < PAGE_SIZE: break
+
+    def sync(self, full=None):
+        """增量同步；full=None 时距上次全量超过一天自动做全量对账 (清理已删除条目)"""
+        if not self._sync_lock.acquire(blocking=False): return {"status": "busy"}
+        try:
+            last_full = float(self._meta("last_full_sync") or 0)
+            last_sync = self._meta("last_sync")
+            if full is None: full = not last_sync or time.time() - last_full > FULL_SYNC_INTERVAL
+            started = time.time(); started_iso = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            params = {} if full else {"MinDateLastSaved": last_sync}
+            seen = set(); total = 0
+            for page in self._fetch(**params):
+                total += self.upsert_items(page)
+                seen.update(i["Id"] for i in page if i.get("Id"))
+            removed = 0
+            if full:
+                with self._lock:
+                    stale = [r['item_id'] for r in self._db().execute("SELECT item_id FROM search_items") if r['item_id'] not in seen]
+                self.remove(stale); removed = len(stale)
+                self._meta("last_full_sync", started)
+            # 以同步开始时间为下次增量起点，同步期间的改动下次会再取一遍
+            self._meta("last_sync", started_iso)
+            self.stats.update(last_sync=started_iso, synced=total)
+            if full: self.stats["last_full_sync"] = started_iso
+            logger.info(f"🔎 Search index {'full' if full else 'delta'} sync: {total} items, {removed} removed in {time.time() - started:.1f}s")
+            return {"status": "success", "full": full, "items": total, "removed": removed}
+        finally:
+            self._sync_lock.release()
+
+    def sync_async(self, full=None):
+        threading.Thread(target=self._safe_sync, args=(full,), name="search-sync", daemon=True).start()
+
+    def _safe_sync(self, full=None):
+        try: self.sync(full)
+        except Exception as e: logger.error(f"Search Sync Error: {e}")
+
+    def ensure_ready(self):
+        """索引为空时后台全量构建"""
+        if self.count() == 0: self.sync_async(full=True)
+
+    def index_item(self, item_id):
+        """webhook 入库事件：单条拉取详情写入索引"""
+        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        try:
+            res = requests.get(f"{host}/emby/Items", params={"Ids": item_id, "Fields": FIELDS, "api_key": key}, timeout=10)
+            if res.status_code == 200: self.upsert_items(res.json().get("Items", []))
+        except Exception as e:
+            logger.error(f"Search Index Item Error: {e}")
+
+    def _fill_series_tech(self, item_id):
+        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        try:
+            res = requests.get(f"{host}/emby/Items", params={"ParentId": item_id, "Recursive": "true", "IncludeItemTypes": "Episode",
+                                                            "Limit": 1, "Fields": "MediaSources", "api_key": key}, timeout=10)
+            items = res.json().get("Items", []) if res.status_code == 200 else []
+            if not items: return
+            with self._lock:
+                self._db().execute("UPDATE search_items SET tech = ? WHERE item_id = ?", (extract_tech_info(items[0]), item_id))
+                self._db().commit()
+        except Exception as e:
+            logger.error(f"Search Tech Fill Error: {e}")
+
+    # ---------------- 查询 ----------------
+    @staticmethod
+    def _tokens(query):
+        return [t for t in re.split(r"\s+", (query or "").strip().lower()) if t]
+
+    def search(self, query, limit=10, item_type=None):
+        start = time.perf_counter()
+        tokens = self._tokens(query)
+        if not tokens: return [], 0.0
+        q = " ".join(tokens)
+        type_sql = " AND s.type = ?" if item_type else ""
+        type_args = [item_type] if item_type else []
+        # 完全匹配 > 前缀匹配 > 相关度，其次评分
+        order = "(lower(s.name) = ? OR lower(s.original_title) = ?) DESC, (lower(s.name) LIKE ? OR s.pinyin LIKE ? OR s.initials = ?) DESC"
+        order_args = [q, q, q + "%", _plain(q) + "%", _plain(q)]
+        use_fts = self._tokenizer != "trigram" or all(len(t) >= 3 for t in tokens)
+        with self._lock:
+            conn = self._db()
+            if use_fts:
+                match = " AND ".join('"' + t.replace('"', '""') + '"' + ("*" if self._tokenizer != "trigram" else "") for t in tokens)
+                sql = f"""SELECT s.* FROM search_fts f JOIN search_items s ON s.id = f.rowid
+                          WHERE search_fts MATCH ?{type_sql}
+                          ORDER BY {order}, bm25(search_fts, 0, 10.0, 6.0, 3.0, 4.0, 2.0, 2.0), s.rating DESC LIMIT ?"""
+                rows = conn.execute(sql, [match] + type_args + order_args + [limit]).fetchall()
+            else:
+                conds = []; args = []
+                for t in tokens:
+                    conds.append("(lower(s.name) LIKE ? OR lower(s.original_title) LIKE ? OR s.plain LIKE ? OR s.pinyin LIKE ? OR s.initials LIKE ?)")
+                    args += [f"%{t}%"] * 5
+                sql = f"SELECT s.* FROM search_items s WHERE {' AND '.join(conds)}{type_sql} ORDER BY {order}, s.rating DESC LIMIT ?"
+                rows = conn.execute(sql, args + type_args + order_args + [limit]).fetchall()
+        results = []
+        for r in rows:
+            d = dict(r); d["genres"] = json.loads(d["genres"] or "[]")
+            if d["type"] == "Series" and not d["tech"]: self._tech_pool.submit(self._fill_series_tech, d["item_id"])
+            results.append(d)
+        took = round((time.perf_counter() - start) * 1000, 2)
+        self.stats["queries"] += 1; self.stats["last_ms"] = took
+        return results, took
+
+search_index = SearchIndex()
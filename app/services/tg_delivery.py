@@ -0,0 +1,337 @@
+"""
+Telegram 出站投递队列
+所有机器人消息先落盘 (本地 SQLite)，由调度线程按令牌桶限速分发给发送线程：
+- 全局 / 单聊天两级令牌桶，遵守 Telegram 的频率限制
+- 429 按 retry_after 暂停该聊天，网络错误/5xx 指数退避重试
+- 同一聊天严格按入队顺序发送；重启后未发送的消息继续投递
+"""
+import json
+import time
+import random
+import threading
+import logging
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import cfg
+from app.core.database import local_connect
+
+logger = logging.getLogger("uvicorn")
+
+MAX_ATTEMPTS = 6
+DEFAULT_API_BASE = "https://api.telegram.org"
+
+def api_url(method, token=None):
+    """Bot API 地址，tg_api_base 可指向自建 Bot API 服务或本地测试桩"""
+    base = (cfg.get("tg_api_base") or DEFAULT_API_BASE).rstrip("/")
+    return f"{base}/bot{token or cfg.get('tg_bot_token')}/{method}"
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate; self.capacity = burst
+        self.tokens = burst; self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """取得一个令牌还需等待的秒数，0 表示可立即发送"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class DeliveryQueue:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._db_lock = threading.Lock()
+        self._conn = None
+        self._thread = None
+        self._executor = None
+        self.running = False
+        self._inflight_chats = set()
+        self._global_bucket = TokenBucket(25, 25)            # 全局约 30 条/秒，留余量
+        self._chat_buckets = {}
+        self._chat_paused = {}                               # chat_id -> 429 解除时间
+        self._listeners = []
+        self._failure_listeners = []
+        self.stats = {"enqueued": 0, "sent": 0, "failed": 0, "retried": 0, "rate_limited": 0}
+        self._latency = deque(maxlen=500)                    # 入队 -> 发送成功 (秒)
+        self._send_ms = deque(maxlen=500)
+
+    # ---------------- 存储 ----------------
+    def _db(self):
+        if not self._conn:
+            self._conn = local_connect()
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS tg_outbox (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    chat_id TEXT NOT NULL,
+                                    method TEXT NOT NULL,
+                                    params TEXT NOT NULL,
+                                    files TEXT,
+                                    fallback TEXT,
+                                    meta TEXT,
+                                    status TEXT NOT NULL DEFAULT 'pending',
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    next_at REAL NOT NULL,
+                                    created_at REAL NOT NULL,
+                                    last_error TEXT
+                                )''')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS tg_outbox_files (
+                                    job_id INTEGER NOT NULL,
+                                    field TEXT NOT NULL,
+                                    filename TEXT,
+                                    mime TEXT,
+                                    data BLOB
+                                )''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tg_outbox_status ON tg_outbox(status, next_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tg_outbox_chat ON tg_outbox(status, chat_id, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tg_outbox_files_job ON tg_outbox_files(job_id)")
+            # 上次进程退出时正在发送的消息重新排队 (至少一次投递)
+            self._conn.execute("UPDATE tg_outbox SET status = 'pending' WHERE status = 'sending'")
+            self._conn.commit()
+        return self._conn
+
+    def enqueue(self, method, chat_id, params, files=None, fallback=None, meta=None):
+        """
+        files: {"photo": (filename, bytes, mime)}
+        fallback: 本条最终失败时改发的 {"method", "params"} (如图片失败改发纯文字)
+        meta: 附加信息，发送成功后原样交给监听者
+        """
+        now = time.time()
+        with self._db_lock:
+            conn = self._db()
+            cur = conn.execute("INSERT INTO tg_outbox (chat_id, method, params, files, fallback, meta, next_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (str(chat_id), method, json.dumps(params, ensure_ascii=False),
+                                json.dumps(list(files.keys())) if files else None,
+                                json.dumps(fallback, ensure_ascii=False) if fallback else None,
+                                json.dumps(meta, ensure_ascii=False) if meta else None, now, now))
+            job_id = cur.lastrowid
+            for field, (filename, data, mime) in (files or {}).items():
+                conn.execute("INSERT INTO tg_outbox_files (job_id, field, filename, mime, data) VALUES (?, ?, ?, ?, ?)",
+                             (job_id, field, filename, mime, sqlite_blob(data)))
+            conn.commit()
+        self.stats["enqueued"] += 1
+        with self._cond: self._cond.notify()
+        return job_id
+
+    def add_listener(self, func):
+        """发送成功回调: func(method, meta, result)"""
+        self._listeners.append(func)
+
+    def add_failure_listener(self, func):
+        """最终失败回调: func(job, error) -> True 表示已自行补救，不再改发 fallback"""
+        self._failure_listeners.append(func)
+
+    # ---------------- 调度 ----------------
+    def start(self):
+        if self.running: return
+        self.running = True
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(cfg.get("tg_delivery_workers") or 2)), thread_name_prefix="tg-send")
+        self._thread = threading.Thread(target=self._dispatch_loop, name="tg-dispatch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        with self._cond: self._cond.notify_all()
+        if self._executor: self._executor.shutdown(wait=False)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if not bucket:
+            # 群组 (负数 ID) 20 条/分钟，私聊约 1 条/秒
+            bucket = TokenBucket(20 / 60, 3) if chat_id.startswith("-") else TokenBucket(1, 3)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _dispatch_loop(self):
+        while self.running:
+            wait = 5.0
+            try:
+                wait = self._dispatch_ready()
+            except Exception as e:
+                logger.error(f"TG Dispatch Error: {e}")
+            with self._cond:
+                if self.running: self._cond.wait(timeout=max(0.05, wait))
+
+    def _dispatch_ready(self):
+        """分发所有当前可发送的消息，返回距下一次可发送的等待秒数"""
+        now = time.time(); mono = time.monotonic()
+        # 每个聊天只取队首一条：同一聊天必须按顺序发送，某个聊天积压再多也不会占满候选窗口、饿死其他聊天
+        with self._db_lock:
+            rows = self._db().execute("""SELECT o.id, o.chat_id, o.next_at FROM tg_outbox o
+                                         JOIN (SELECT MIN(id) AS id FROM tg_outbox WHERE status = 'pending' GROUP BY chat_id) h ON o.id = h.id
+                                         ORDER BY o.id""").fetchall()
+        wait = 5.0
+        for r in rows:
+            chat_id = r['chat_id']
+            # 同一聊天只允许一条在途；队首未到期时整个聊天等待
+            if chat_id in self._inflight_chats: continue
+            if r['next_at'] > now:
+                wait = min(wait, r['next_at'] - now); continue
+            paused = self._chat_paused.get(chat_id, 0) - now
+            if paused > 0:
+                wait = min(wait, paused); continue
+            delay = max(self._global_bucket.wait_time(mono), self._chat_bucket(chat_id).wait_time(mono))
+            if delay > 0:
+                wait = min(wait, delay); continue
+            self._global_bucket.take(mono); self._chat_bucket(chat_id).take(mono)
+            self._inflight_chats.add(chat_id)
+            with self._db_lock:
+                self._db().execute("UPDATE tg_outbox SET status = 'sending' WHERE id = ?", (r['id'],))
+                self._db().commit()
+            self._executor.submit(self._send_job, r['id'], chat_id)
+        return wait
+
+    # ---------------- 发送 ----------------
+    def _load_job(self, job_id):
+        with self._db_lock:
+            conn = self._db()
+            row = conn.execute("SELECT * FROM tg_outbox WHERE id = ?", (job_id,)).fetchone()
+            if not row: return None
+            job = dict(row)
+            files = conn.execute("SELECT field, filename, mime, data FROM tg_outbox_files WHERE job_id = ?", (job_id,)).fetchall()
+        job['params'] = json.loads(job['params'])
+        job['meta'] = json.loads(job['meta']) if job['meta'] else None
+        job['fallback'] = json.loads(job['fallback']) if job['fallback'] else None
+        job['files'] = {f['field']: (f['filename'], bytes(f['data']), f['mime']) for f in files}
+        return job
+
+    def _post(self, method, params, files):
+        token = cfg.get("tg_bot_token")
+        if not token: raise PermanentError("Bot token not configured")
+        proxy = cfg.get("proxy_url")
+        proxies = {"http": proxy, "https": proxy} if proxy else None
+        url = api_url(method, token)
+        if files:
+            data = {k: (json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v) for k, v in params.items()}
+            return requests.post(url, data=data, files=files, proxies=proxies, timeout=60)
+        return requests.post(url, json=params, proxies=proxies, timeout=20)
+
+    def _send_job(self, job_id, chat_id):
+        job = None
+        try:
+            try: job = self._load_job(job_id)
+            except ValueError as e: return self._load_failed(job_id, f"Bad payload: {e}", permanent=True)
+            except Exception as e: return self._load_failed(job_id, str(e))
+            if not job: return   # 已被删除
+            start = time.time()
+            res = self._post(job['method'], job['params'], job['files'])
+            self._send_ms.append((time.time() - start) * 1000)
+            body = {}
+            try: body = res.json()
+            except Exception: pass
+
+            if res.status_code == 200 and body.get("ok", True):
+                self._finish(job, body.get("result"))
+            elif res.status_code == 429:
+                retry_after = (body.get("parameters") or {}).get("retry_after", 5)
+                self.stats["rate_limited"] += 1
+                self._chat_paused[job['chat_id']] = time.time() + retry_after
+                self._reschedule(job, retry_after, f"429 retry_after={retry_after}", count_attempt=False)
+            elif res.status_code >= 500:
+                self._retry(job, f"HTTP {res.status_code}")
+            else:
+                # 4xx 重试也不会成功 (参数错误/被拉黑/文件失效)
+                self._fail(job, f"HTTP {res.status_code}: {body.get('description', '')}")
+        except PermanentError as e:
+            if job: self._fail(job, str(e))
+        except Exception as e:
+            if job: self._retry(job, str(e))
+            else: logger.error(f"TG Delivery Load Error ({job_id}): {e}")
+        finally:
+            # 无论载入是否成功都要释放聊天，否则该聊天的队列会一直卡住
+            self._inflight_chats.discard(chat_id)
+            with self._cond: self._cond.notify()
+
+    def _load_failed(self, job_id, error, permanent=False):
+        """载入失败 (载荷损坏 / 库被锁)：损坏的直接作废，其余退回 pending 稍后重试，不能停在 sending"""
+        logger.error(f"TG Delivery Load Error ({job_id}): {error}")
+        with self._db_lock:
+            conn = self._db()
+            row = conn.execute("SELECT attempts FROM tg_outbox WHERE id = ?", (job_id,)).fetchone()
+            if not row: return
+            attempts = row['attempts'] + 1
+            if permanent or attempts >= MAX_ATTEMPTS:
+                self.stats["failed"] += 1
+                conn.execute("UPDATE tg_outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?", (attempts, error, job_id))
+                conn.execute("DELETE FROM tg_outbox_files WHERE job_id = ?", (job_id,))
+            else:
+                delay = min(300, 2 ** attempts) * (0.8 + random.random() * 0.4)
+                conn.execute("UPDATE tg_outbox SET status = 'pending', attempts = ?, next_at = ?, last_error = ? WHERE id = ?",
+                             (attempts, time.time() + delay, error, job_id))
+            conn.commit()
+
+    def _delete(self, job_id):
+        with self._db_lock:
+            conn = self._db()
+            conn.execute("DELETE FROM tg_outbox WHERE id = ?", (job_id,))
+            conn.execute("DELETE FROM tg_outbox_files WHERE job_id = ?", (job_id,))
+            conn.commit()
+
+    def _finish(self, job, result):
+        self._delete(job['id'])
+        self.stats["sent"] += 1
+        self._latency.append(time.time() - job['created_at'])
+        for func in self._listeners:
+            try: func(job['method'], job['meta'], result)
+            except Exception as e: logger.error(f"TG Delivery Listener Error: {e}")
+
+    def _reschedule(self, job, delay, error, count_attempt=True):
+        with self._db_lock:
+            self._db().execute("UPDATE tg_outbox SET status = 'pending', next_at = ?, attempts = attempts + ?, last_error = ? WHERE id = ?",
+                               (time.time() + delay, 1 if count_attempt else 0, error, job['id']))
+            self._db().commit()
+
+    def _retry(self, job, error):
+        if job['attempts'] + 1 >= MAX_ATTEMPTS: return self._fail(job, error)
+        self.stats["retried"] += 1
+        delay = min(300, 2 ** (job['attempts'] + 1)) * (0.8 + random.random() * 0.4)
+        logger.warning(f"TG Delivery Retry #{job['attempts'] + 1} in {delay:.0f}s: {error}")
+        self._reschedule(job, delay, error)
+
+    def _fail(self, job, error):
+        self.stats["failed"] += 1
+        logger.error(f"TG Delivery Failed ({job['method']} -> {job['chat_id']}): {error}")
+        with self._db_lock:
+            conn = self._db()
+            conn.execute("UPDATE tg_outbox SET status = 'dead', last_error = ? WHERE id = ?", (error, job['id']))
+            conn.execute("DELETE FROM tg_outbox_files WHERE job_id = ?", (job['id'],))
+            # 只保留最近 200 条失败记录
+            conn.execute("DELETE FROM tg_outbox WHERE status = 'dead' AND id NOT IN (SELECT id FROM tg_outbox WHERE status = 'dead' ORDER BY id DESC LIMIT 200)")
+            conn.commit()
+        handled = False
+        for func in self._failure_listeners:
+            try: handled = func(job, error) or handled
+            except Exception as e: logger.error(f"TG Delivery Failure Listener Error: {e}")
+        fb = job.get('fallback')
+        if fb and not handled: self.enqueue(fb['method'], job['chat_id'], fb['params'], meta=job['meta'])
+
+    # ---------------- 指标 ----------------
+    def metrics(self):
+        with self._db_lock:
+            conn = self._db()
+            counts = {r['status']: r['c'] for r in conn.execute("SELECT status, COUNT(*) as c FROM tg_outbox GROUP BY status")}
+            oldest = conn.execute("SELECT MIN(created_at) as t FROM tg_outbox WHERE status IN ('pending', 'sending')").fetchone()['t']
+        lat = sorted(self._latency); sms = list(self._send_ms)
+        return {
+            "depth": counts.get("pending", 0) + counts.get("sending", 0),
+            "in_flight": counts.get("sending", 0),
+            "dead": counts.get("dead", 0),
+            "oldest_age_sec": round(time.time() - oldest, 1) if oldest else 0,
+            "latency_avg_sec": round(sum(lat) / len(lat), 2) if lat else 0,
+            "latency_p95_sec": round(lat[int(len(lat) * 0.95) - 1], 2) if lat else 0,
+            "send_avg_ms": round(sum(sms) / len(sms), 1) if sms else 0,
+            **self.stats
+        }
+
+class PermanentError(Exception):
+    pass
+
+def sqlite_blob(data):
+    return memoryview(data) if data is not None else None
+
+delivery = DeliveryQueue()
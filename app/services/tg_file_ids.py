@@ -0,0 +1,82 @@
+"""
+Telegram file_id 映射
+图片首次上传后 Telegram 会返回可复用的 file_id，同一张海报/报表再次发送时直接引用，
+不必再从 Emby 下载、也不必重新上传
+键: emby:{item_id}:{图片类型}:{tag} / report:{渲染缓存键摘要} / url:{地址}
+"""
+import time
+import hashlib
+import threading
+import logging
+from app.core.database import local_connect
+
+logger = logging.getLogger("uvicorn")
+
+TAGLESS_TTL = 7 * 86400      # 无 tag 的海报可能被替换，只复用 7 天
+REPORT_TTL = 2 * 86400       # 报表随数据版本变化，旧键很快失效
+MAX_AGE = 90 * 86400
+
+class FileIdStore:
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+
+    def _db(self):
+        if not self._conn:
+            self._conn = local_connect()
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS tg_file_ids (
+                                    cache_key TEXT PRIMARY KEY,
+                                    file_id TEXT NOT NULL,
+                                    created_at REAL NOT NULL
+                                )''')
+            now = time.time()
+            self._conn.execute("DELETE FROM tg_file_ids WHERE created_at < ? OR (cache_key LIKE 'report:%' AND created_at < ?)",
+                               (now - MAX_AGE, now - REPORT_TTL))
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def emby_key(item_id, img_type='Primary', image_tag=None):
+        return f"emby:{item_id}:{img_type}:{image_tag or ''}"
+
+    @staticmethod
+    def report_key(render_key):
+        return "report:" + hashlib.sha1(repr(render_key).encode()).hexdigest()
+
+    @staticmethod
+    def max_age_for(key):
+        if key.startswith("report:"): return REPORT_TTL
+        if key.startswith("emby:") and key.endswith(":"): return TAGLESS_TTL
+        return MAX_AGE
+
+    def get(self, key):
+        if not key: return None
+        with self._lock:
+            row = self._db().execute("SELECT file_id, created_at FROM tg_file_ids WHERE cache_key = ?", (key,)).fetchone()
+        if row and time.time() - row['created_at'] < self.max_age_for(key):
+            self.stats["hits"] += 1
+            return row['file_id']
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, file_id):
+        if not key or not file_id: return
+        with self._lock:
+            self._db().execute("INSERT OR REPLACE INTO tg_file_ids (cache_key, file_id, created_at) VALUES (?, ?, ?)", (key, file_id, time.time()))
+            self._db().commit()
+        self.stats["stored"] += 1
+
+    def forget(self, key):
+        with self._lock:
+            self._db().execute("DELETE FROM tg_file_ids WHERE cache_key = ?", (key,))
+            self._db().commit()
+        self.stats["invalidated"] += 1
+
+    @staticmethod
+    def largest_photo(message):
+        """从 sendPhoto 返回的 Message 中取最大尺寸的 file_id"""
+        photos = (message or {}).get("photo") or []
+        return photos[-1].get("file_id") if photos else None
+
+file_ids = FileIdStore()
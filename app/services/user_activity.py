@@ -0,0 +1,50 @@
+"""
+用户活跃度汇总 (用户管理列表用)
+一条 SQL 只扫一遍 PlaybackActivity：先按 (用户, 设备) 分组，再用窗口函数汇总到用户
+(最后播放、总播放次数、近 30 天时长、播放最多的设备)；结果按数据版本缓存，数据不变时不再扫表
+"""
+import threading
+import logging
+from app.core.database import query_db, get_data_version
+
+logger = logging.getLogger("uvicorn")
+
+ACTIVITY_SQL = """
+    WITH per_device AS (
+        SELECT UserId, COALESCE(DeviceName, ClientName, 'Unknown') AS device,
+               MAX(DateCreated) AS last_play, COUNT(*) AS plays,
+               SUM(CASE WHEN DateCreated > date('now', '-30 days') THEN PlayDuration ELSE 0 END) AS recent_seconds
+        FROM PlaybackActivity GROUP BY UserId, device
+    )
+    SELECT UserId, user_last_play AS last_play, user_plays AS plays, user_recent AS recent_seconds, device AS top_device FROM (
+        SELECT UserId, device,
+               MAX(last_play) OVER w AS user_last_play, SUM(plays) OVER w AS user_plays, SUM(recent_seconds) OVER w AS user_recent,
+               ROW_NUMBER() OVER (PARTITION BY UserId ORDER BY plays DESC) AS rn
+        FROM per_device WINDOW w AS (PARTITION BY UserId)
+    ) WHERE rn = 1
+"""
+
+class UserActivity:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = {}
+
+    def get(self):
+        """{user_id: {"last_play", "plays", "recent_hours", "top_device"}}"""
+        version = get_data_version()
+        if version == self._version: return self._data
+        with self._lock:
+            # 并发请求只让一个去扫表
+            if version == self._version: return self._data
+            rows = query_db(ACTIVITY_SQL)
+            if rows is None:
+                logger.warning("User activity query failed")
+                return self._data
+            self._data = {r["UserId"]: {"last_play": r["last_play"], "plays": r["plays"] or 0,
+                                        "recent_hours": round((r["recent_seconds"] or 0) / 3600, 1),
+                                        "top_device": r["top_device"]} for r in rows}
+            self._version = version
+            return self._data
+
+user_activity = UserActivity()
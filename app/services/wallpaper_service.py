@@ -0,0 +1,144 @@
+"""
+登录页壁纸
+后台按 TTL 拉取 TMDB 本周热门，下载一组适合屏幕尺寸的背景图 (默认 w1280) 到 config/wallpapers，
+由本服务直接提供 (长缓存)；登录页加载时不再访问 TMDB，浏览器也不再下载 original 原图
+缓存过期时先返回旧图，同时在后台刷新
+"""
+import os
+import re
+import json
+import time
+import random
+import threading
+import logging
+import requests
+from app.core.config import cfg, CONFIG_DIR, TMDB_FALLBACK_POOL
+
+logger = logging.getLogger("uvicorn")
+
+WALLPAPER_DIR = os.path.join(CONFIG_DIR, "wallpapers")
+MANIFEST = os.path.join(WALLPAPER_DIR, "manifest.json")
+TMDB_IMAGE_BASE = "https://image.tmdb.org/t/p"
+KEEP = 8                     # 轮换的壁纸数量
+TTL = 12 * 3600              # 热门列表刷新间隔
+RETRY_INTERVAL = 300         # 刷新失败后的最短重试间隔 (上游不可达时不随登录页访问反复请求)
+FILE_RE = re.compile(r"^[A-Za-z0-9_-]+\.jpg$")
+
+class WallpaperService:
+    def __init__(self):
+        self._items = []
+        self._refreshed_at = 0
+        self._attempted_at = 0                    # 最近一次尝试刷新 (无论成败)
+        self._refreshing = threading.Lock()
+        self.stats = {"refreshes": 0, "downloads": 0, "bytes": 0, "errors": 0}
+        self._load_manifest()
+        cfg.subscribe({"tmdb_api_key", "proxy_url"}, lambda keys: self.refresh_async(force=True))
+
+    def _load_manifest(self):
+        try:
+            with open(MANIFEST, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._items = [i for i in data.get("items", []) if os.path.exists(os.path.join(WALLPAPER_DIR, i["file"]))]
+            self._refreshed_at = data.get("refreshed_at", 0)
+        except (OSError, ValueError, KeyError): pass
+
+    def _proxies(self):
+        proxy = cfg.get("proxy_url")
+        return {"http": proxy, "https": proxy} if proxy else None
+
+    @staticmethod
+    def _size():
+        return cfg.get("wallpaper_size") or "w1280"
+
+    # ---------------- 刷新 ----------------
+    def refresh_async(self, force=False):
+        now = time.time()
+        if not force and (now - self._refreshed_at < TTL or now - self._attempted_at < RETRY_INTERVAL): return
+        self._attempted_at = now
+        threading.Thread(target=self.refresh, name="wallpaper-refresh", daemon=True).start()
+
+    def _trending(self):
+        """[(backdrop_path, title)]；没有 TMDB 密钥或请求失败时用内置图库"""
+        key = cfg.get("tmdb_api_key")
+        if key:
+            try:
+                url = f"https://api.themoviedb.org/3/trending/all/week?api_key={key}&language=zh-CN"
+                res = requests.get(url, timeout=8, proxies=self._proxies())
+                if res.status_code == 200:
+                    results = [i for i in res.json().get("results", []) if i.get("backdrop_path")]
+                    if results: return [(i["backdrop_path"], i.get("title") or i.get("name")) for i in results]
+            except Exception as e: logger.warning(f"Wallpaper Trending Error: {e}")
+        return [("/" + url.rsplit("/", 1)[-1], "Cinematic Collection") for url in TMDB_FALLBACK_POOL]
+
+    def _download(self, path, size):
+        """下载到临时文件再改名，文件名取自 TMDB 路径 (内容不变，可长期缓存)"""
+        name = f"{size}_{path.strip('/').rsplit('.', 1)[0]}.jpg"
+        if not FILE_RE.match(name): return None
+        target = os.path.join(WALLPAPER_DIR, name)
+        if os.path.exists(target): return name
+        res = requests.get(f"{TMDB_IMAGE_BASE}/{size}{path}", timeout=20, proxies=self._proxies())
+        if res.status_code != 200 or not res.content: raise Exception(f"HTTP {res.status_code}")
+        tmp = target + ".tmp"
+        with open(tmp, "wb") as f: f.write(res.content)
+        os.replace(tmp, target)
+        self.stats["downloads"] += 1; self.stats["bytes"] += len(res.content)
+        return name
+
+    def refresh(self):
+        if not self._refreshing.acquire(blocking=False): return False
+        self._attempted_at = time.time()
+        try:
+            os.makedirs(WALLPAPER_DIR, exist_ok=True)
+            candidates = self._trending()
+            random.shuffle(candidates)
+            size = self._size(); items = []
+            for path, title in candidates:
+                if len(items) >= KEEP: break
+                try:
+                    name = self._download(path, size)
+                    if name: items.append({"file": name, "title": title})
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logger.warning(f"Wallpaper Download Error ({path}): {e}")
+            if not items: return False
+            self._items = items; self._refreshed_at = time.time()
+            tmp = MANIFEST + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"refreshed_at": self._refreshed_at, "items": items}, f, ensure_ascii=False)
+            os.replace(tmp, MANIFEST)
+            # 清理不再轮换的旧图
+            keep = {i["file"] for i in items}
+            for name in os.listdir(WALLPAPER_DIR):
+                if name.endswith(".jpg") and name not in keep:
+                    try: os.remove(os.path.join(WALLPAPER_DIR, name))
+                    except OSError: pass
+            self.stats["refreshes"] += 1
+            logger.info(f"🖼️ Wallpapers refreshed: {len(items)} images ({size})")
+            return True
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Wallpaper Refresh Error: {e}")
+            return False
+        finally:
+            self._refreshing.release()
+
+    # ---------------- 读取 ----------------
+    def pick(self):
+        """随机一张本地壁纸 {"url", "title"}；过期时顺带触发后台刷新，缓存为空时返回 None"""
+        self.refresh_async()
+        if not self._items: return None
+        item = random.choice(self._items)
+        return {"url": f"/api/wallpaper/img/{item['file']}", "title": item["title"]}
+
+    @staticmethod
+    def path_of(name):
+        if not FILE_RE.match(name or ""): return None
+        path = os.path.join(WALLPAPER_DIR, name)
+        return path if os.path.exists(path) else None
+
+    def status(self):
+        return {"count": len(self._items), "size": self._size(),
+                "refreshed_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._refreshed_at)) if self._refreshed_at else None,
+                **self.stats}
+
+wallpapers = WallpaperService()
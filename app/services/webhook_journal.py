@@ -0,0 +1,258 @@
+"""
+Webhook 接收日志
+Emby 推来的事件先原样追加到独立的本地 WAL 库，立即返回 202，再由工作线程池处理：
+- 至少一次：处理前先租约 (lease)，进程崩溃后租约过期的事件重新处理；失败指数退避重试，多次失败转入 dead
+- 幂等：按载荷内容计算幂等键，Emby 重发的相同事件只处理一次
+- 顺序：同一分区 (播放会话 / 媒体库) 的事件按到达顺序逐个处理，不同分区并行
+- 背压：积压超过 webhook_queue_max 时拒绝新事件 (503 + Retry-After)
+"""
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import cfg, CONFIG_DIR
+from app.core.database import local_connect
+
+logger = logging.getLogger("uvicorn")
+
+JOURNAL_DB_PATH = os.path.join(CONFIG_DIR, "webhook_journal.db")
+LEASE_SECONDS = 120         # 单个事件处理超过此时长视为工作线程已失效，重新派发
+MAX_ATTEMPTS = 5
+DONE_KEEP = 86400           # 已处理事件保留的秒数 (用于幂等去重)，载荷处理完即清空
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"webhook queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class WebhookJournal:
+    def __init__(self):
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._handler = None
+        self._executor = None
+        self._thread = None
+        self.running = False
+        self._inflight = set()                   # 正在处理的分区
+        self._depth = None                       # 未处理完的事件数 (内存计数，避免每次请求 COUNT)
+        self._last_purge = 0
+        self.stats = {"received": 0, "duplicates": 0, "rejected": 0, "processed": 0, "retried": 0, "failed": 0}
+        self._lag = deque(maxlen=500)            # 接收 -> 处理完成 (秒)
+        self._run_ms = deque(maxlen=500)
+
+    # ---------------- 存储 ----------------
+    def _db(self):
+        if not self._conn:
+            self._conn = local_connect(JOURNAL_DB_PATH)
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS webhook_events (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    idem_key TEXT NOT NULL UNIQUE,
+                                    event TEXT NOT NULL,
+                                    partition TEXT NOT NULL,
+                                    payload TEXT,
+                                    status TEXT NOT NULL DEFAULT 'pending',
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    next_at REAL NOT NULL,
+                                    lease_until REAL,
+                                    received_at REAL NOT NULL,
+                                    processed_at REAL,
+                                    last_error TEXT
+                                )''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_status ON webhook_events(status, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_partition ON webhook_events(status, partition, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_processed ON webhook_events(processed_at) WHERE status = 'done'")
+            # 上次退出时正在处理的事件重新排队
+            self._conn.execute("UPDATE webhook_events SET status = 'pending', lease_until = NULL WHERE status = 'processing'")
+            self._conn.commit()
+            self._depth = self._conn.execute("SELECT COUNT(*) FROM webhook_events WHERE status = 'pending'").fetchone()[0]
+        return self._conn
+
+    @staticmethod
+    def idempotency_key(event, data):
+        """相同事件的重发载荷完全一致，取规范化 JSON 的摘要"""
+        raw = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha1(f"{event}\n{raw}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def partition_of(event, data):
+        """播放事件按会话串行 (start/stop 顺序有意义)，媒体库事件按剧集/条目串行"""
+        if event.startswith("playback."):
+            session = data.get("Session") or {}
+            return "session:" + str(session.get("Id") or session.get("DeviceId") or (data.get("User") or {}).get("Id"))
+        item = data.get("Item") or {}
+        target = item.get("SeriesId") or item.get("Id")
+        return f"item:{target}" if target else (event.split(".", 1)[0] or "other")
+
+    def _limit(self):
+        try: return max(1, int(cfg.get("webhook_queue_max") or 10000))
+        except (TypeError, ValueError): return 10000
+
+    def append(self, event, data):
+        """写入日志；返回 (事件 id, 是否重复)。积压过多时抛出 QueueFull"""
+        now = time.time()
+        key = self.idempotency_key(event, data)
+        with self._db_lock:
+            conn = self._db()
+            if self._depth >= self._limit():
+                self.stats["rejected"] += 1
+                raise QueueFull(self._retry_after())
+            cur = conn.execute('''INSERT OR IGNORE INTO webhook_events (idem_key, event, partition, payload, next_at, received_at)
+                                  VALUES (?, ?, ?, ?, ?, ?)''',
+                               (key, event, self.partition_of(event, data), json.dumps(data, ensure_ascii=False), now, now))
+            if not cur.rowcount:
+                self.stats["duplicates"] += 1
+                return conn.execute("SELECT id FROM webhook_events WHERE idem_key = ?", (key,)).fetchone()[0], True
+            conn.commit()
+            self._depth += 1
+        self.stats["received"] += 1
+        with self._cond: self._cond.notify()
+        return cur.lastrowid, False
+
+    def _retry_after(self):
+        """按最近处理速度估算积压消化时间"""
+        recent = [t for t in self._run_ms]
+        per_event = (sum(recent) / len(recent) / 1000) if recent else 0.05
+        return int(min(300, max(5, self._depth * per_event / self._workers())))
+
+    # ---------------- 处理 ----------------
+    def register(self, handler):
+        """handler(event, data)；抛出异常即视为失败并重试"""
+        self._handler = handler
+
+    def _workers(self):
+        try: return max(1, int(cfg.get("webhook_workers") or 4))
+        except (TypeError, ValueError): return 4
+
+    def start(self):
+        if self.running: return
+        with self._db_lock: self._db()
+        self.running = True
+        self._executor = ThreadPoolExecutor(max_workers=self._workers(), thread_name_prefix="webhook")
+        self._thread = threading.Thread(target=self._dispatch_loop, name="webhook-dispatch", daemon=True)
+        self._thread.start()
+        if self._depth: logger.info(f"📥 Webhook journal: resuming {self._depth} pending events")
+
+    def stop(self):
+        self.running = False
+        with self._cond: self._cond.notify_all()
+        if self._executor: self._executor.shutdown(wait=False)
+
+    def _dispatch_loop(self):
+        while self.running:
+            wait = 5.0
+            try:
+                wait = self._dispatch_ready()
+                if time.time() - self._last_purge > 600: self._maintain()
+            except Exception as e:
+                logger.error(f"Webhook Dispatch Error: {e}")
+            with self._cond:
+                if self.running: self._cond.wait(timeout=max(0.05, wait))
+
+    def _dispatch_ready(self):
+        """为每个空闲分区租出最早的一条待处理事件，返回下一次检查前的等待秒数"""
+        now = time.time()
+        # 每个分区只取最早的一条 (保证顺序)：某个剧集批量入库积压再多，也不会占满候选窗口、饿死其他会话的播放事件
+        with self._db_lock:
+            rows = self._db().execute("""SELECT e.id, e.partition, e.next_at FROM webhook_events e
+                                         JOIN (SELECT MIN(id) AS id FROM webhook_events WHERE status = 'pending' GROUP BY partition) h ON e.id = h.id
+                                         ORDER BY e.id""").fetchall()
+        wait = 5.0; claimed = []
+        for r in rows:
+            part = r["partition"]
+            if part in self._inflight: continue
+            if r["next_at"] > now:
+                wait = min(wait, r["next_at"] - now); continue
+            self._inflight.add(part); claimed.append(r["id"])
+        if claimed:
+            with self._db_lock:
+                self._db().executemany("UPDATE webhook_events SET status = 'processing', lease_until = ? WHERE id = ?",
+                                       [(now + LEASE_SECONDS, i) for i in claimed])
+                self._db().commit()
+            for i in claimed: self._executor.submit(self._process, i)
+        return wait
+
+    def _process(self, event_id):
+        row = None
+        try:
+            with self._db_lock:
+                row = self._db().execute("SELECT * FROM webhook_events WHERE id = ?", (event_id,)).fetchone()
+            if not row or row["status"] != "processing": return
+            start = time.time()
+            try:
+                if self._handler: self._handler(row["event"], json.loads(row["payload"]))
+            except Exception as e:
+                self._run_ms.append((time.time() - start) * 1000)
+                return self._retry(row, str(e))
+            self._run_ms.append((time.time() - start) * 1000)
+            done = time.time()
+            with self._db_lock:
+                cur = self._db().execute("UPDATE webhook_events SET status = 'done', payload = NULL, lease_until = NULL, processed_at = ? WHERE id = ? AND status = 'processing'", (done, event_id))
+                self._db().commit()
+                if cur.rowcount: self._depth -= 1
+            self.stats["processed"] += 1
+            self._lag.append(done - row["received_at"])
+        except Exception as e:
+            logger.error(f"Webhook Journal Error ({event_id}): {e}")
+        finally:
+            if row: self._inflight.discard(row["partition"])
+            with self._cond: self._cond.notify()
+
+    def _retry(self, row, error):
+        attempts = row["attempts"] + 1
+        with self._db_lock:
+            if attempts >= MAX_ATTEMPTS:
+                self._db().execute("UPDATE webhook_events SET status = 'dead', attempts = ?, lease_until = NULL, last_error = ? WHERE id = ?", (attempts, error, row["id"]))
+                self._depth -= 1
+                self.stats["failed"] += 1
+                logger.error(f"Webhook Event Failed ({row['event']} #{row['id']}): {error}")
+            else:
+                delay = min(300, 2 ** attempts) * (0.8 + random.random() * 0.4)
+                self._db().execute("UPDATE webhook_events SET status = 'pending', attempts = ?, next_at = ?, lease_until = NULL, last_error = ? WHERE id = ?",
+                                   (attempts, time.time() + delay, error, row["id"]))
+                self.stats["retried"] += 1
+                logger.warning(f"Webhook Event Retry #{attempts} in {delay:.0f}s ({row['event']}): {error}")
+            self._db().commit()
+
+    def _maintain(self):
+        """回收租约过期的事件 (工作线程卡死)，清理过期的已处理记录"""
+        now = time.time(); self._last_purge = now
+        with self._db_lock:
+            conn = self._db()
+            stale = conn.execute("SELECT id, partition FROM webhook_events WHERE status = 'processing' AND lease_until < ?", (now,)).fetchall()
+            if stale:
+                conn.executemany("UPDATE webhook_events SET status = 'pending', lease_until = NULL WHERE id = ?", [(r["id"],) for r in stale])
+                logger.warning(f"Webhook journal: reclaimed {len(stale)} expired leases")
+            conn.execute("DELETE FROM webhook_events WHERE status = 'done' AND processed_at < ?", (now - DONE_KEEP,))
+            conn.execute("DELETE FROM webhook_events WHERE status = 'dead' AND id NOT IN (SELECT id FROM webhook_events WHERE status = 'dead' ORDER BY id DESC LIMIT 200)")
+            conn.commit()
+        for r in stale: self._inflight.discard(r["partition"])
+
+    # ---------------- 指标 ----------------
+    def metrics(self):
+        with self._db_lock:
+            conn = self._db()
+            counts = {r["status"]: r["c"] for r in conn.execute("SELECT status, COUNT(*) AS c FROM webhook_events GROUP BY status")}
+            oldest = conn.execute("SELECT MIN(received_at) FROM webhook_events WHERE status IN ('pending', 'processing')").fetchone()[0]
+            errors = [dict(r) for r in conn.execute("SELECT id, event, attempts, last_error, received_at FROM webhook_events WHERE status = 'dead' ORDER BY id DESC LIMIT 10")]
+        lag = sorted(self._lag); run = sorted(self._run_ms)
+        pct = lambda arr, p: round(arr[min(len(arr) - 1, int(len(arr) * p))], 3) if arr else 0
+        return {
+            "pending": counts.get("pending", 0),
+            "processing": counts.get("processing", 0),
+            "dead": counts.get("dead", 0),
+            "done_retained": counts.get("done", 0),
+            "limit": self._limit(),
+            "oldest_pending_age_sec": round(time.time() - oldest, 1) if oldest else 0,
+            "lag_p50_sec": pct(lag, 0.5), "lag_p95_sec": pct(lag, 0.95),
+            "run_p50_ms": pct(run, 0.5), "run_p95_ms": pct(run, 0.95),
+            "recent_failures": errors,
+            **self.stats
+        }
+
+webhook_journal = WebhookJournal()
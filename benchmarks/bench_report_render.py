@@ -0,0 +1,33 @@
+"""
+报表渲染基准：逐主题对比「整图重绘」与「静态图层 + 动态文字」的单次渲染耗时
+
+    python -m benchmarks.bench_report_render [次数]
+"""
+import sys
+import time
+from app.core.config import THEMES
+from app.services import report_render
+
+SAMPLE = {
+    "user_name": "Emby Server", "title_period": "本周观影周报", "plays": 1234, "hours": 567.8,
+    "top_list": [{"ItemName": f"示例影片 Sample Title {i}", "ItemId": str(i), "C": 100 - i, "D": 3600} for i in range(8)]
+}
+
+def bench(theme_name, use_layers, rounds):
+    report_render.render_report(SAMPLE, theme_name, use_layers=use_layers)  # 预热 (字体/图层)
+    start = time.perf_counter()
+    for _ in range(rounds): report_render.render_report(SAMPLE, theme_name, use_layers=use_layers)
+    return (time.perf_counter() - start) / rounds * 1000
+
+def main():
+    if not report_render.HAS_PIL:
+        print("Pillow not installed"); return
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if not report_render.fonts_ready(): report_render.preload()
+    print(f"{'theme':<12}{'redraw ms':>12}{'layered ms':>12}{'speedup':>10}")
+    for name in THEMES:
+        before = bench(name, False, rounds); after = bench(name, True, rounds)
+        print(f"{name:<12}{before:>12.2f}{after:>12.2f}{before / after:>9.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Telegram 收发链路自测：本地启动一个假的 Bot API，分别以 polling / webhook 两种模式启动机器人，
+验证更新能经过同一条处理流程 (管理员过滤 -> 指令分发器 -> 投递队列) 并收到回复
+
+    python -m tools.tg_harness
+
+需要完整运行环境 (requirements.txt + httpx)；使用临时数据库，不会修改 config.json
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ADMIN_CHAT = "42"
+
+class FakeTelegram:
+    """记录所有 Bot API 调用；getUpdates 从 updates 列表取数据，setWebhook/deleteWebhook 只记录状态"""
+    def __init__(self):
+        self.calls = []
+        self.updates = []
+        self.webhook = None
+        self._cond = threading.Condition()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+
+            def _reply(self, result):
+                body = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _params(self):
+                url = urllib.parse.urlparse(self.path)
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                ctype = self.headers.get("Content-Type", "")
+                if "json" in ctype and raw: params.update(json.loads(raw))
+                elif "x-www-form-urlencoded" in ctype: params.update({k: v[0] for k, v in urllib.parse.parse_qs(raw.decode()).items()})
+                elif "multipart" in ctype: params["_multipart"] = len(raw)
+                return url.path.rsplit("/", 1)[-1], params
+
+            def do_GET(self): self._handle()
+            def do_POST(self): self._handle()
+
+            def _handle(self):
+                method, params = self._params()
+                self._reply(fake.handle(method, params))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, method, params):
+        with self._cond:
+            self.calls.append((method, params))
+            self._cond.notify_all()
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            deadline = time.time() + min(1.0, float(params.get("timeout") or 0))
+            with self._cond:
+                while True:
+                    ready = [u for u in self.updates if u["update_id"] >= offset]
+                    if ready or time.time() >= deadline: return ready
+                    self._cond.wait(timeout=deadline - time.time())
+        if method == "setWebhook":
+            self.webhook = params; return True
+        if method == "deleteWebhook":
+            self.webhook = None; return True
+        if method == "getWebhookInfo":
+            return {"url": (self.webhook or {}).get("url", "")}
+        return {"message_id": len(self.calls), "chat": {"id": params.get("chat_id")}}
+
+    def push(self, update):
+        with self._cond:
+            self.updates.append(update)
+            self._cond.notify_all()
+
+    def wait_for(self, method, pred=lambda p: True, timeout=10):
+        deadline = time.time() + timeout
+        with self._cond:
+            while time.time() < deadline:
+                for m, p in self.calls:
+                    if m == method and pred(p): return p
+                self._cond.wait(timeout=0.2)
+        return None
+
+    def count(self, method, pred=lambda p: True):
+        with self._cond:
+            return sum(1 for m, p in self.calls if m == method and pred(p))
+
+def make_update(update_id, chat_id, text):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": int(chat_id)}, "text": text}}
+
+def to_chat(chat_id):
+    return lambda p: str(p.get("chat_id")) == str(chat_id)
+
+def setup(fake):
+    from app.core.config import cfg
+    from app.core import database
+    from app.services import tg_delivery, delayed_jobs, tg_file_ids
+    cfg._write = lambda data: None   # 不写回真实配置
+    cfg.config.update(tg_bot_token="123:TEST", tg_chat_id=ADMIN_CHAT, tg_api_base=fake.base, proxy_url="",
+                      tg_mode="polling", tg_webhook_url="", tg_webhook_secret="")
+    db_path = os.path.join(tempfile.mkdtemp(prefix="tg-harness-"), "harness.db")
+    for module in (tg_delivery, delayed_jobs, tg_file_ids):
+        module.local_connect = lambda: database.local_connect(db_path)
+    tg_delivery.delivery.start()
+    return cfg
+
+def check(results, name, ok):
+    results.append(ok)
+    print(f"{'PASS' if ok else 'FAIL'}  {name}")
+
+def run_polling(fake, cfg, bot, results):
+    fake.push(make_update(1, 99, "/help"))          # 非管理员聊天，应被忽略
+    fake.push(make_update(2, ADMIN_CHAT, "/help"))
+    bot.start()
+    check(results, "polling: deleteWebhook before getUpdates", fake.wait_for("deleteWebhook") is not None)
+    reply = fake.wait_for("sendMessage", to_chat(ADMIN_CHAT))
+    check(results, "polling: /help answered", bool(reply and "/search" in reply.get("text", "")))
+    time.sleep(1)
+    check(results, "polling: other chats ignored", fake.count("sendMessage", to_chat(99)) == 0)
+    bot.stop()
+
+def run_webhook(fake, cfg, bot, results):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from app.routers import bot as bot_router
+
+    cfg.config.update(tg_mode="webhook", tg_webhook_url="https://pulse.example.com")
+    before = fake.count("sendMessage", to_chat(ADMIN_CHAT))
+    bot.start()
+    check(results, "webhook: secret set before start returns", bool(cfg.get("tg_webhook_secret")))
+    hook = fake.wait_for("setWebhook")
+    check(results, "webhook: setWebhook registered", bool(hook and hook["url"] == "https://pulse.example.com/api/bot/webhook"))
+    secret = (hook or {}).get("secret_token", "")
+    check(results, "webhook: secret token generated", bool(secret) and secret == cfg.get("tg_webhook_secret"))
+
+    app = FastAPI(); app.include_router(bot_router.router)
+    client = TestClient(app)
+    res = client.post("/api/bot/webhook", json=make_update(10, ADMIN_CHAT, "/help"), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    check(results, "webhook: wrong secret rejected (403)", res.status_code == 403)
+    res = client.post("/api/bot/webhook", json=make_update(10, ADMIN_CHAT, "/help"))
+    check(results, "webhook: missing secret rejected (403)", res.status_code == 403)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    res = client.post("/api/bot/webhook", json=make_update(11, ADMIN_CHAT, "/help"), headers=headers)
+    check(results, "webhook: update accepted (200)", res.status_code == 200)
+    client.post("/api/bot/webhook", json=make_update(11, ADMIN_CHAT, "/help"), headers=headers)   # Telegram 重投
+    deadline = time.time() + 10
+    while time.time() < deadline and fake.count("sendMessage", to_chat(ADMIN_CHAT)) <= before: time.sleep(0.1)
+    time.sleep(1)
+    check(results, "webhook: /help answered once", fake.count("sendMessage", to_chat(ADMIN_CHAT)) == before + 1)
+    polls = fake.count("getUpdates"); time.sleep(1.5)
+    check(results, "webhook: no long polling", fake.count("getUpdates") == polls)
+    bot.stop()
+    check(results, "webhook: stop deregisters webhook", fake.webhook is None)
+    res = client.post("/api/bot/webhook", json=make_update(12, ADMIN_CHAT, "/help"), headers=headers)
+    check(results, "webhook: disabled bot returns 404", res.status_code == 404)
+
+def main():
+    fake = FakeTelegram()
+    cfg = setup(fake)
+    from app.services.bot_service import bot
+    results = []
+    run_polling(fake, cfg, bot, results)
+    run_webhook(fake, cfg, bot, results)
+    print(f"\n{sum(results)}/{len(results)} checks passed")
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == "__main__":
+    main()